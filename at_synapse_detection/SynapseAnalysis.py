@@ -2,10 +2,13 @@
 import os
 import numpy as np
 import pandas as pd
-from skimage import measure
 from at_synapse_detection import SynapseDetection as syn
 from at_synapse_detection import dataAccess as da
 from at_synapse_detection import antibodyAnalysis as aa
+from at_synapse_detection import preprocessCache as pc
+from at_synapse_detection import queryPlanner as qp
+from at_synapse_detection import sparseVolume
+from at_synapse_detection import componentStats as cs
 from PIL import Image
 
 
@@ -29,14 +32,49 @@ def compute_measurements(resultvol, query, volume_um3, thresh):
     queryresult = SynapseAnalysis(query)
     queryresult.volume_um3 = volume_um3
 
-    label_vol = measure.label(resultvol > thresh)
-    stats = measure.regionprops(label_vol)
-    queryresult.synapse_density = len(stats) / queryresult.volume_um3
-    queryresult.num_synapses = len(stats)
+    if isinstance(resultvol, sparseVolume.SparseResultVolume):
+        # label the voxels above threshold without expanding the volume
+        num_synapses, _, _ = resultvol.label(thresh)
+    else:
+        _, num_synapses = cs.label_components(resultvol > thresh)
+    queryresult.synapse_density = num_synapses / queryresult.volume_um3
+    queryresult.num_synapses = num_synapses
 
     return queryresult
 
 
+def compute_threshold_sweep(resultvol, query, volume_um3, thresholds):
+    """
+    compute_measurements at several thresholds, the result volume is
+    labeled once for all of them (see sparseVolume.sweep_components)
+
+    Parameters
+    ------------
+    resultvol : 3D numpy array or SparseResultVolume
+    query : dict
+    volume_um3 : double
+    thresholds : list of floats
+
+    Returns
+    ------------
+    queryresults : list of SynapseAnalysis - one per threshold. Each also
+        has the threshold (thresh) and the mean and standard deviation of
+        the synapse size in voxels (synapse_size, synapse_size_std)
+    """
+    queryresults = []
+    for thresh, sizes in zip(thresholds, sparseVolume.sweep_components(resultvol, thresholds)):
+        queryresult = SynapseAnalysis(query)
+        queryresult.volume_um3 = volume_um3
+        queryresult.thresh = thresh
+        queryresult.num_synapses = len(sizes)
+        queryresult.synapse_density = len(sizes) / volume_um3
+        queryresult.synapse_size = np.mean(sizes) if len(sizes) > 0 else 0.0
+        queryresult.synapse_size_std = np.std(sizes) if len(sizes) > 0 else 0.0
+        queryresults.append(queryresult)
+
+    return queryresults
+
+
 def create_synapse_df(result_list, row_labels):
     """
 
@@ -87,15 +125,93 @@ def run_synapse_detection(atet_input):
     # Load the data
     synaptic_volumes = da.load_tiff_from_query(query, data_region_location)
 
+    # Load the layer 4 and DAPI masks
+    combined_mask, mask_files = load_combined_mask(
+        layer_mask_str, dapi_mask_str, mouse_number)
+
+    # Channels shared with other queries are only preprocessed once
+    source_ids = pc.get_source_ids(query, data_region_location, mask_files)
+
+    # Mask data
+    synaptic_volumes = mask_synaptic_volumes(synaptic_volumes, combined_mask)
+
+    volume_um3 = get_masked_volume(synaptic_volumes, combined_mask, resolution)
+    print(volume_um3)
+
+    return detect_and_measure(atet_input, synaptic_volumes, volume_um3, source_ids)
+
+
+def detect_and_measure(atet_input, synaptic_volumes, volume_um3, source_ids=None, astro=False):
+    """
+    Run synapse detection on loaded and masked volumes, save the result
+    volume and measure it
+
+    Parameters
+    -------------------
+    atet_input : dict - see run_synapse_detection. atet_input['thresh'] is
+        the threshold of the measurements (default 0.9)
+    synaptic_volumes : dict - masked volumes of the query, modified in place
+    volume_um3 : double - see get_masked_volume
+    source_ids : dict - see preprocessCache.get_source_ids (default None)
+    astro : bool - run getSynapseDetections_astro (default False)
+
+    Returns
+    -------------------
+    output_dict : dict
+    """
+    query = atet_input['query']
+    queryID = atet_input['queryID']
+
+    # Run Synapse Detection
+    print('running synapse detection')
+    if astro:
+        resultvol = syn.getSynapseDetections_astro(synaptic_volumes, query)
+    else:
+        resultvol = syn.getSynapseDetections(synaptic_volumes, query, sourceIds=source_ids)
+
+    # Save the probability map to file, if you want
+    outputNPYlocation = os.path.join(
+        atet_input['data_location'], atet_input['output_foldername'],
+        atet_input['region_name'])
+    output_fn = syn.saveresultvol(resultvol, outputNPYlocation, 'query_', queryID)
+
+    thresh = atet_input.get('thresh', 0.9)
+    queryresult = compute_measurements(
+        resultvol, query, volume_um3, thresh)
+
+    output_dict = {'queryID': queryID, 'query': query, 'queryresult': queryresult,
+                   'output_fn': output_fn}
+    return output_dict
+
+
+def load_combined_mask(layer_mask_str, dapi_mask_str, mouse_number):
+    """
+    Load the DAPI mask and, if given, the layer 4 mask and merge them
+
+    Parameters
+    -------------
+    layer_mask_str : str - layer mask filename, -1 if there is no layer mask
+    dapi_mask_str : str - folder of the DAPI mask
+    mouse_number : int
+
+    Returns
+    -------------
+    combined_mask : 3D array. ones - good regions (bool)
+    mask_files : list of strs - the mask files that were read
+    """
+    mask_files = []
+
     # Load layer mask
     if layer_mask_str != -1:
         layer_mask = Image.open(layer_mask_str)
         layer_mask = np.array(layer_mask)
+        mask_files.append(layer_mask_str)
 
     # Load DAPI mask
     dapi_mask_fn = os.path.join(dapi_mask_str, str(
         mouse_number) + 'ss-DAPI-mask.tiff')
     dapi_mask = da.imreadtiff(dapi_mask_fn)
+    mask_files.append(dapi_mask_fn)
 
     # Merge DAPI mask and Layer 4 mask
     if layer_mask_str != -1:
@@ -104,28 +220,89 @@ def run_synapse_detection(atet_input):
         dapi_mask = dapi_mask.astype(np.bool)
         combined_mask = np.logical_not(dapi_mask)  # keep portions without dapi
 
-    # Mask data
-    synaptic_volumes = mask_synaptic_volumes(synaptic_volumes, combined_mask)
+    return combined_mask, mask_files
 
-    volume_um3 = get_masked_volume(synaptic_volumes, combined_mask, resolution)
+
+def run_synapse_detection_region(region_input, listOfQueries):
+    """
+    Run synapse detection for every query of a region in a single pass.
+    Channels are loaded, masked and preprocessed once, no matter how many
+    queries use them (see queryPlanner). Same results as calling
+    run_synapse_detection for each query.
+
+    Parameters
+    -------------------
+    region_input : dict - same keys as the input of run_synapse_detection,
+        without 'query' and 'nQuery'. 'queryID' is the id of the first query
+    listOfQueries : list of dicts
+
+    Returns
+    -------------------
+    output_list : list of dicts - output of each query, in query order
+    """
+    first_queryID = region_input['queryID']
+    resolution = region_input['resolution']
+    data_region_location = region_input['data_region_location']
+    precision = listOfQueries[0].get('precision', 'float64') if listOfQueries else 'float64'
+
+    combined_mask, mask_files = load_combined_mask(
+        region_input['mask_str'], region_input['dapi_mask_str'],
+        region_input['mouse_number'])
+    volume_um3 = get_masked_volume(None, combined_mask, resolution)
     print(volume_um3)
 
-    # Run Synapse Detection
-    print('running synapse detection')
-    resultvol = syn.getSynapseDetections(synaptic_volumes, query)
+    def load_channel(channel):
+        volume = da.read_channel(data_region_location, channel, precision)
+        return syn.applyMask(volume, combined_mask)
 
-    # Save the probability map to file, if you want
-    outputNPYlocation = os.path.join(
-        data_location, output_foldername, region_name)
-    syn.saveresultvol(resultvol, outputNPYlocation, 'query_', queryID)
+    atet_inputs_list = []
+    for nQuery, query in enumerate(listOfQueries):
+        atet_input = dict(region_input)
+        atet_input.update({'query': query, 'queryID': first_queryID + nQuery, 'nQuery': nQuery})
+        atet_inputs_list.append(atet_input)
 
-    thresh = 0.9
-    queryresult = compute_measurements(
-        resultvol, query, volume_um3, thresh)
+    return run_query_plan(atet_inputs_list, load_channel, volume_um3, precision)
 
-    output_dict = {'queryID': queryID,
-                   'query': query, 'queryresult': queryresult}
-    return output_dict
+
+def run_query_plan(atet_inputs_list, load_channel, volume_um3, precision='float64'):
+    """
+    Run the queries of a region in a single pass (see queryPlanner), then
+    save and measure the result of each query
+
+    Parameters
+    -------------------
+    atet_inputs_list : list of dicts - inputs of run_synapse_detection of the
+        same region
+    load_channel : function - load_channel(channel) returns the masked volume
+    volume_um3 : double - see get_masked_volume
+    precision : str - dtype of the loaded volumes (default float64)
+
+    Returns
+    -------------------
+    output_list : list of dicts - output of each query, in input order
+    """
+    listOfQueries = [atet_input['query'] for atet_input in atet_inputs_list]
+    plan = qp.plan_queries(listOfQueries, load_channel, precision)
+
+    output_list = []
+
+    def save_query_result(key, resultvol):
+        atet_input = atet_inputs_list[key[1]]
+        outputNPYlocation = os.path.join(
+            atet_input['data_location'], atet_input['output_foldername'],
+            atet_input['region_name'])
+        output_fn = syn.saveresultvol(resultvol, outputNPYlocation, 'query_',
+                                      atet_input['queryID'])
+
+        queryresult = compute_measurements(
+            resultvol, atet_input['query'], volume_um3, atet_input.get('thresh', 0.9))
+        output_list.append({'queryID': atet_input['queryID'], 'query': atet_input['query'],
+                            'queryresult': queryresult, 'output_fn': output_fn})
+
+    print('running synapse detection')
+    plan.execute(save_query_result)
+
+    return output_list
 
 
 def merge_DAPI_L4_masks(layer_mask, dapi_mask):
@@ -147,12 +324,8 @@ def merge_DAPI_L4_masks(layer_mask, dapi_mask):
     layer_mask = layer_mask.astype(np.bool)
     # invert dapi mask
     dapi_mask = np.logical_not(dapi_mask)
-    # tile layer mask
-    layer_mask_3d = np.zeros(dapi_mask.shape, dtype=np.bool)
-    for n in range(0, layer_mask_3d.shape[2]):
-        layer_mask_3d[:, :, n] = layer_mask
-
-    combined_mask = np.logical_and(layer_mask_3d, dapi_mask)
+    # broadcast the 2D layer mask over every slice
+    combined_mask = np.logical_and(syn.getMaskView(layer_mask), dapi_mask)
 
     return combined_mask
 
@@ -199,22 +372,7 @@ def run_synapse_detection_astro(atet_input):
     volume_um3 = get_masked_volume(synaptic_volumes, combined_mask, resolution)
     print(volume_um3)
 
-    # Run Synapse Detection
-    print('running synapse detection')
-    resultvol = syn.getSynapseDetections_astro(synaptic_volumes, query)
-
-    # Save the probability map to file, if you want
-    outputNPYlocation = os.path.join(
-        data_location, output_foldername, region_name)
-    syn.saveresultvol(resultvol, outputNPYlocation, 'query_', queryID)
-
-    thresh = 0.9
-    queryresult = compute_measurements(
-        resultvol, query, volume_um3, thresh)
-
-    output_dict = {'queryID': queryID,
-                   'query': query, 'queryresult': queryresult}
-    return output_dict
+    return detect_and_measure(atet_input, synaptic_volumes, volume_um3, astro=True)
 
 
 def organize_result_lists(result_list):
@@ -236,31 +394,24 @@ def organize_result_lists(result_list):
 
 def mask_synaptic_volumes(synaptic_volumes, mask):
     """
-    Mask synaptic volumes 
+    Mask synaptic volumes in place, the volumes are not copied
 
     Parameters
     -------------
     synaptic_volumes : dict 
-    mask : 2D array 
+    mask : 2D or 3D array 
 
     Returns 
     --------------
     synaptic_volumes : dict 
     """
 
-    keys = synaptic_volumes.keys()
-    masked_synaptic_volumes = {key: [] for key in keys}
-
     for key in synaptic_volumes.keys():
         print(key)
         for volume in synaptic_volumes[key]:
-            maskedVol = np.zeros(volume.shape)
-            for sliceInd in range(0, volume.shape[2]):
-                maskedVol[:, :, sliceInd] = volume[:,
-                                                   :, sliceInd] * mask[:, :, sliceInd]
-            masked_synaptic_volumes[key].append(maskedVol)
+            syn.applyMask(volume, mask)
 
-    return masked_synaptic_volumes
+    return synaptic_volumes
 
 
 def get_masked_volume(synaptic_volumes, mask, resolution):
@@ -6,10 +6,36 @@ import math
 import numpy as np
 from scipy.stats import norm
 from scipy.stats import gamma
-from scipy import signal
 import scipy.ndimage as ndimage
+from scipy import special
+from concurrent.futures import ThreadPoolExecutor
 #from at_synapse_detection import synaptogram
 from at_synapse_detection import dataAccess as da
+from at_synapse_detection import synapseKernels
+from at_synapse_detection import preprocessCache
+from at_synapse_detection import sparseVolume
+
+# Backend used by the combine step.
+# 'python' - per voxel reference loop
+# 'numpy' - array level engine (combinePrePostVolumesVectorized)
+# 'numba' - compiled loops in synapseKernels, parallel over z
+KERNEL_BACKENDS = ['python', 'numpy', 'numba']
+KERNEL_BACKEND = os.environ.get('SYNAPSE_KERNEL_BACKEND', 'python')
+
+# Number of threads used by the probability map functions
+NUM_THREADS = int(os.environ.get('SYNAPSE_NUM_THREADS', 1))
+
+# Number of rows processed at a time by the whole volume reductions
+ROW_BLOCK_SIZE = 64
+
+# Number of rows computeFactor processes at a time
+FACTOR_ROW_CHUNK = 4
+
+# File format of saveresultvol, 'npy', 'h5' or 'sparse'
+RESULT_FORMAT = os.environ.get('SYNAPSE_RESULT_FORMAT', 'npy')
+
+# File extension of each result format
+RESULT_EXTENSIONS = {'npy': '.npy', 'h5': '.h5', 'sparse': '.npz'}
 
 # def calculateGammaParams(data):
 #     mean = np.mean(data)
@@ -44,12 +70,56 @@ from at_synapse_detection import dataAccess as da
 #     return data
 
 
-def getProbMap_rayleigh(data):
+def getRowBlocks(numRows, numThreads):
+    """
+    Split the rows of a volume into contiguous blocks
+
+    Parameters
+    ----------
+    numRows : int
+    numThreads : int
+
+    Returns
+    ----------
+    blocks : list of slices
+    """
+    blockSize = int(np.ceil(numRows / max(numThreads, 1)))
+    blockSize = max(blockSize, 1)
+    return [slice(start, min(start + blockSize, numRows))
+            for start in range(0, numRows, blockSize)]
+
+
+def applyToRowBlocks(func, data, numThreads=None):
+    """
+    Call func(rowSlice) for blocks of rows of data, on a thread pool if
+    numThreads > 1. The numpy/scipy ufuncs used by the probability maps
+    release the GIL, so the blocks run concurrently.
+
+    Parameters
+    ----------
+    func : function - takes a slice of rows and writes its output in place
+    data : 3D numpy array
+    numThreads : int (default NUM_THREADS)
+    """
+    if numThreads is None:
+        numThreads = NUM_THREADS
+
+    if numThreads <= 1:
+        func(slice(0, data.shape[0]))
+        return
+
+    blocks = getRowBlocks(data.shape[0], numThreads)
+    with ThreadPoolExecutor(max_workers=numThreads) as executor:
+        list(executor.map(func, blocks))
+
+
+def getProbMap_rayleigh(data, numThreads=None):
     """
     Returns probability map of input image
     Parameters
     ----------
     data : 3D numpy - input volume
+    numThreads : int (default NUM_THREADS)
 
     Returns
     ----------
@@ -57,26 +127,42 @@ def getProbMap_rayleigh(data):
         output volume with values scaled between 0 to 1
     """
 
-    for zInd in range(0, data.shape[2]):
-
-        # The maximum likelihood estimate has a simple form
-        phat = np.sqrt(0.5 * np.mean(np.power(data[:, :, zInd], 2)))
-        output = 1 - \
-            np.exp(-1 * np.power(data[:, :, zInd],
-                                 2) / (2 * np.power(phat, 2)))
-
-        # Calculate foreground probabilities
-        data[:, :, zInd] = output
+    # The maximum likelihood estimate has a simple form
+    meanSquares = np.zeros(data.shape[2])
+    for rows in getRowBlocks(data.shape[0], int(np.ceil(data.shape[0] / ROW_BLOCK_SIZE))):
+        block = np.asarray(data[rows], dtype=np.float64)
+        meanSquares += np.sum(np.square(block), axis=(0, 1))
+    meanSquares = meanSquares / (data.shape[0] * data.shape[1])
+    phat = np.sqrt(0.5 * meanSquares)
+    scale = 2 * np.power(phat, 2)
+
+    # Calculate foreground probabilities
+    def rayleighBlock(rows):
+        block = data[rows]
+        np.square(block, out=block)
+        np.negative(block, out=block)
+        np.divide(block, scale, out=block)
+        np.exp(block, out=block)
+        np.subtract(1, block, out=block)
+
+    applyToRowBlocks(rayleighBlock, data, numThreads)
 
     return data
 
 
-def getProbMap(data):
+def getProbMap(data, sliceStatistics=None, numThreads=None, out=None):
     """
     Returns probability map of input image
     Parameters
     ----------
     data : 3D numpy - input volume
+    sliceStatistics : tuple (means, stds) of 1D arrays - per slice statistics to
+        use instead of the ones of data, see getSliceStatistics (default None)
+    numThreads : int (default NUM_THREADS)
+    out : 3D numpy array - same shape as data, receives the probability map
+        and data is left unchanged (default None, data is overwritten unless
+        it is read only, e.g. a volume in shared memory, then a new array
+        is allocated)
 
     Returns
     ----------
@@ -86,106 +172,242 @@ def getProbMap(data):
 
     if len(data.shape) == 2:
         data = scipy.stats.norm.cdf(data, np.mean(data), np.std(data))
-    else:
-        for zInd in range(0, data.shape[2]):
-            # Calculate foreground probabilities
-            data[:, :, zInd] = scipy.stats.norm.cdf(
-                data[:, :, zInd], np.mean(data[:, :, zInd]), np.std(data[:, :, zInd]))
-    return data
+        return data
+
+    if sliceStatistics is None:
+        sliceStatistics = getSliceStatistics(data)
+    means, stds = sliceStatistics
 
+    # norm.cdf is undefined for a zero standard deviation
+    stds = np.where(stds > 0, stds, np.nan)
+    if out is None:
+        out = data if data.flags.writeable else np.empty_like(data)
 
-def convolveVolume(vol, kernelLength):
+    # Calculate foreground probabilities, norm.cdf(x, mean, std) == ndtr((x - mean) / std)
+    def probBlock(rows):
+        block = out[rows]
+        np.subtract(data[rows], means, out=block)
+        np.divide(block, stds, out=block)
+        special.ndtr(block, out=block)
+
+    applyToRowBlocks(probBlock, data, numThreads)
+
+    return out
+
+
+def getMaskView(mask):
     """
-    Returns convolved volume
+    View of a mask that broadcasts against a (rows, cols, slices) volume
+
+    Parameters
+    ----------
+    mask : 2D (rows, cols) or 3D array - nonzero voxels are kept
+
+    Returns
+    ----------
+    mask : 3D numpy array
+    """
+    mask = np.asarray(mask)
+    if mask.ndim == 2:
+        return mask[:, :, np.newaxis]
+    return mask
+
+
+def applyMask(vol, mask):
+    """
+    Zero the masked out voxels of a volume in place, the 2D mask of a layer
+    is broadcast over every slice
+
+    Parameters
+    ----------
+    vol : 3D numpy array
+    mask : 2D or 3D array - nonzero voxels are kept
+
+    Returns
+    ----------
+    vol : 3D numpy array
+    """
+    return np.multiply(vol, getMaskView(mask), out=vol)
+
+
+def getSliceStatistics(vol, mask=None):
+    """
+    Per slice mean and standard deviation, as used by getProbMap.
+    Reads ROW_BLOCK_SIZE rows at a time so vol can be a memory mapped array.
+
+    Parameters
+    ----------
+    vol : 3D array
+    mask : 2D or 3D array - statistics of the masked volume, vol is not
+        modified (default None)
+
+    Returns
+    ----------
+    means : 1D numpy array
+    stds : 1D numpy array
+    """
+    numPixels = vol.shape[0] * vol.shape[1]
+    rowBlocks = getRowBlocks(vol.shape[0], int(np.ceil(vol.shape[0] / ROW_BLOCK_SIZE)))
+
+    def readBlock(rows):
+        block = np.asarray(vol[rows], dtype=np.float64)
+        if mask is not None:
+            block = block * getMaskView(mask[rows])
+        return block
+
+    sums = np.zeros(vol.shape[2])
+    for rows in rowBlocks:
+        sums += np.sum(readBlock(rows), axis=(0, 1))
+    means = sums / numPixels
+
+    squaredDiffs = np.zeros(vol.shape[2])
+    for rows in rowBlocks:
+        block = readBlock(rows) - means
+        squaredDiffs += np.sum(np.square(block), axis=(0, 1))
+    stds = np.sqrt(squaredDiffs / numPixels)
+
+    return means, stds
+
+
+def convolveVolume(vol, kernelLength, inplace=False):
+    """
+    Returns convolved volume - every slice is averaged over a
+    kernelLength x kernelLength box in log space. The box filter is separable
+    and uses running sums over the whole volume, so the cost does not
+    depend on kernelLength. Even kernels cover [i - k/2 + 1, i + k/2],
+    the same alignment as the cropped 'full' convolution.
+
     Parameters
     ----------
     vol : 3D numpy volume
     kernelLength : ind - minimum blob size
+    inplace : bool - overwrite vol instead of allocating new volumes (default False)
 
     Returns
     ----------
     vol : 3D numpy volume
     """
-    vol = np.log(vol)
+    if inplace and len(vol.shape) == 3:
+        vol = np.log(vol, out=vol)
+    else:
+        vol = np.log(vol)
 
-    kernel = np.ones([kernelLength, kernelLength])
     if len(vol.shape) == 2:
-        vol_expanded = np.zeros((vol.shape[0], vol.shape[1], 1))
-        vol_expanded[:, :, 0] = vol
-        vol = vol_expanded
-
-    for n in range(0, vol.shape[2]):
-        img = vol[:, :, n]
+        vol = vol[:, :, np.newaxis]
+
+    # -inf (zero probability) and nan can not go through a running sum,
+    # their windows are tracked separately
+    neginf = np.isneginf(vol)
+    nans = np.isnan(vol)
+    hasneginf = np.any(neginf)
+    hasnans = np.any(nans)
+    if hasneginf or hasnans:
+        vol[neginf | nans] = 0
+
+    size = (kernelLength, kernelLength, 1)
+    origin = 0
+    if (kernelLength % 2 == 0):
+        origin = -1
+    origins = (origin, origin, 0)
+
+    ndimage.uniform_filter(vol, size, output=vol, mode='constant', cval=0.0, origin=origins)
+
+    if hasneginf:
+        neginf = ndimage.maximum_filter(neginf, size, mode='constant', cval=0, origin=origins)
+        vol[neginf] = -np.inf
+    if hasnans:
+        nans = ndimage.maximum_filter(nans, size, mode='constant', cval=0, origin=origins)
+        vol[nans] = np.nan
+
+    vol = np.exp(vol, out=vol)
 
-        if (kernelLength % 2 == 0):
-            img = signal.convolve2d(img, kernel, 'full')
+    return vol
 
-            rstartInd = int(kernelLength / 2)
-            rendInd = img.shape[0] - kernelLength / 2 + 1
-            rendInd = int(rendInd)
 
-            # Python3 division is converted to float
-            cstartInd = int(kernelLength / 2)
-            cendInd = img.shape[1] - kernelLength / 2 + 1
-            cendInd = int(cendInd)
+def getFactorOffsets(numslices):
+    """
+    z offsets of the neighbouring slices that a slice is compared against
+    in computeFactor. A span of numslices covers (numslices - 1) // 2
+    slices before and numslices // 2 slices after the current slice, so
+    2 -> [1], 3 -> [1, -1], 4 -> [1, -1, 2], 5 -> [1, -1, 2, -2]
 
-            Csame = img[rstartInd:rendInd, cstartInd:cendInd]
-            vol[:, :, n] = Csame
+    Parameters
+    ----------
+    numslices: int - number of slices to span
 
-        else:
-            img = signal.convolve2d(img, kernel, 'same')
-            vol[:, :, n] = img
+    Returns
+    ----------
+    offsets : list of ints
+    """
+    offsets = []
+    for dist in range(1, numslices // 2 + 1):
+        offsets.append(dist)
+        if dist <= (numslices - 1) // 2:
+            offsets.append(-dist)
 
-    kernelsize = np.prod(kernel.shape)
-    vol = np.divide(vol, kernelsize)
-    vol = np.exp(vol)
+    return offsets
 
-    return vol
 
-
-def computeFactor(vol, numslices):
+def computeFactor(vol, numslices, out=None, numThreads=None):
     """
     Returns convolved volume
     Parameters
     ----------
     vol : 3D numpy volume
-    numslices: int - number of slices to span
-        note from anish: numslices can only be 2 or 3.
-        todo - add more slices
+    numslices: int - number of slices to span. Each slice is compared
+        against the other slices of its span (see getFactorOffsets), slices
+        past the edge of the volume are left out. If no slice of the span
+        is inside the volume the previous slice is used instead
+    out : 3D numpy volume - preallocated buffer for factorVol (default None)
+    numThreads : int (default NUM_THREADS)
     Returns
     ----------
     factorVol : 3D numpy volume
     """
 
-    factorVol = np.ones(vol.shape)
+    if out is None:
+        factorVol = np.empty(vol.shape, dtype=vol.dtype)
+    else:
+        factorVol = out
 
-    if (numslices == 1):
+    numZ = vol.shape[2]
+    if (numslices <= 1) or (numZ == 1):
+        factorVol[:] = 1
         return factorVol
 
-    for n in range(0, vol.shape[2]):
-
-        # Edge cases
-        # First Slice
-        # print(vol.shape)
-        if n == 0:
-            # print(n)
-            diff = np.exp(-1 *
-                          (np.power((vol[:, :, n] - vol[:, :, n + 1]), 2)))
-
-        # Last slice
-        elif n == (vol.shape[2] - 1):
-            diff = np.exp(-1 *
-                          (np.power((vol[:, :, n] - vol[:, :, n - 1]), 2)))
-        # Middle slices
-        else:
-            if (numslices == 3):
-                diff = np.exp((-1 * (np.power((vol[:, :, n] - vol[:, :, n + 1]), 2) +
-                                     np.power((vol[:, :, n] - vol[:, :, n - 1]), 2))))
-            elif (numslices == 2):
-                diff = np.exp(-1 *
-                              (np.power((vol[:, :, n] - vol[:, :, n + 1]), 2)))
-
-        factorVol[:, :, n] = diff
+    # Slices without a neighbour in their span (the last slice when
+    # numslices is 2) are compared to the previous slice
+    offsets = [offset for offset in getFactorOffsets(numslices) if abs(offset) < numZ]
+    hasNeighbour = np.zeros(numZ, dtype=bool)
+    for offset in offsets:
+        hasNeighbour[max(-offset, 0):numZ - max(offset, 0)] = True
+    noNeighbour = np.flatnonzero(~hasNeighbour)
+
+    def factorBlock(rows):
+        # Small chunks of rows keep the intermediate arrays in cache
+        diff = np.empty((FACTOR_ROW_CHUNK, vol.shape[1], numZ - 1), dtype=factorVol.dtype)
+        for start in range(rows.start, rows.stop, FACTOR_ROW_CHUNK):
+            chunk = slice(start, min(start + FACTOR_ROW_CHUNK, rows.stop))
+            volChunk = vol[chunk]
+            factorChunk = factorVol[chunk]
+
+            # Sum of squared differences to the neighbouring slices
+            factorChunk[:] = 0
+            for offset in offsets:
+                zInds = slice(max(-offset, 0), numZ - max(offset, 0))
+                neighbourInds = slice(max(offset, 0), numZ - max(-offset, 0))
+                d = diff[:factorChunk.shape[0], :, :numZ - abs(offset)]
+                np.subtract(volChunk[:, :, zInds], volChunk[:, :, neighbourInds], out=d)
+                np.square(d, out=d)
+                factorChunk[:, :, zInds] += d
+
+            for n in noNeighbour:
+                factorChunk[:, :, n] = np.square(volChunk[:, :, n] - volChunk[:, :, n - 1])
+
+            np.negative(factorChunk, out=factorChunk)
+            np.exp(factorChunk, out=factorChunk)
+
+    applyToRowBlocks(factorBlock, vol, numThreads)
 
     return factorVol
 
@@ -242,6 +464,50 @@ def computeFactor(vol, numslices):
 #     return factorVol
 
 
+def setKernelBackend(backend):
+    """
+    Set the default backend used by the combine step
+
+    Parameters
+    ----------
+    backend : str - one of KERNEL_BACKENDS
+    """
+    global KERNEL_BACKEND
+    if backend not in KERNEL_BACKENDS:
+        raise ValueError('unknown kernel backend: ' + str(backend))
+    KERNEL_BACKEND = backend
+
+
+def getKernelBackend(query=None):
+    """
+    Resolve which backend to use. query['backend'] takes precedence over
+    the module default, query['vectorized'] = True is the same as 'numpy'.
+    Falls back to the python loop if numba is not installed.
+
+    Parameters
+    ----------
+    query : dict (default None)
+
+    Returns
+    ----------
+    backend : str
+    """
+    backend = KERNEL_BACKEND
+    if query is not None:
+        if query.get('vectorized', False):
+            backend = 'numpy'
+        backend = query.get('backend', backend)
+
+    if backend not in KERNEL_BACKENDS:
+        raise ValueError('unknown kernel backend: ' + str(backend))
+
+    if backend == 'numba' and not synapseKernels.NUMBA_AVAILABLE:
+        print('numba is not installed, using the python backend')
+        backend = 'python'
+
+    return backend
+
+
 def loadQueriesJSON(fileName):
     """
     Load query file (in JSON format).
@@ -378,7 +644,8 @@ def searchColocalizeChannel(baseVolList, search_win, cInd, rInd, zInd):
     return output
 
 
-def combinePrePostVolumes(baseVolList, adjacentVolList, edge_win, search_win):
+def combinePrePostVolumes(baseVolList, adjacentVolList, edge_win, search_win, backend=None,
+                          lookupTables=False):
     """
     Combines Volumes
     Parameters
@@ -389,12 +656,26 @@ def combinePrePostVolumes(baseVolList, adjacentVolList, edge_win, search_win):
     baseThresh : float - minimum probability value to consider
     edge_win : int - edge to ignore
     search_win - search_win must be even
+    backend : str - one of KERNEL_BACKENDS (default KERNEL_BACKEND)
+    lookupTables : bool - baseVolList[1:] and adjacentVolList already hold
+        float64 lookup tables (see createLookupTables), the inputs are then
+        left unchanged (default False)
 
     Returns
     ----------
     outputVol : 3D Numpy Array - Final Probability Map
     """
 
+    if backend is None:
+        backend = getKernelBackend()
+
+    if backend == 'numpy':
+        return combinePrePostVolumesVectorized(
+            baseVolList, adjacentVolList, edge_win, search_win, lookupTables=lookupTables)
+    elif backend == 'numba':
+        return synapseKernels.combinePrePostVolumes(
+            baseVolList, adjacentVolList, edge_win, search_win, lookupTables)
+
     if len(baseVolList) == 1 and len(adjacentVolList) == 0:
         print('return input')
         return baseVolList[0]
@@ -403,11 +684,11 @@ def combinePrePostVolumes(baseVolList, adjacentVolList, edge_win, search_win):
     outputVol = np.zeros(baseVolList[0].shape)
 
     # If there are multiple volumes associated with the same synaptic side
-    if len(baseVolList) > 1:
+    if len(baseVolList) > 1 and not lookupTables:
         baseVolList[1:] = createLookupTables(baseVolList[1:])
 
     # Create lookup tables
-    if len(adjacentVolList) > 0:
+    if len(adjacentVolList) > 0 and not lookupTables:
         adjacentVolList = createLookupTables(adjacentVolList)
 
     #print('starting to loop through each slice')
@@ -447,7 +728,8 @@ def combinePrePostVolumes(baseVolList, adjacentVolList, edge_win, search_win):
     return outputVol
 
 
-def combinePrePostVolumes_astro(baseVolList, adjacentVolList, glialvolumes, edge_win, search_win):
+def combinePrePostVolumes_astro(baseVolList, adjacentVolList, glialvolumes, edge_win, search_win,
+                                backend=None):
     """
     Combines Volumes
     Parameters
@@ -458,11 +740,22 @@ def combinePrePostVolumes_astro(baseVolList, adjacentVolList, glialvolumes, edge
     baseThresh : float - minimum probability value to consider
     edge_win : int - edge to ignore
     search_win - search_win must be even
+    backend : str - one of KERNEL_BACKENDS (default KERNEL_BACKEND)
 
     Returns
     ----------
     outputVol : 3D Numpy Array - Final Probability Map
     """
+    if backend is None:
+        backend = getKernelBackend()
+
+    if backend == 'numpy':
+        return combinePrePostVolumesVectorized(
+            baseVolList, adjacentVolList, edge_win, search_win, glialvolumes=glialvolumes)
+    elif backend == 'numba':
+        return synapseKernels.combinePrePostVolumes_astro(
+            baseVolList, adjacentVolList, glialvolumes, edge_win, search_win)
+
     # Allocate memory
     outputVol = np.zeros(baseVolList[0].shape)
 
@@ -518,7 +811,352 @@ def combinePrePostVolumes_astro(baseVolList, adjacentVolList, glialvolumes, edge
     return outputVol
 
 
-def getSynapseDetections(synapticVolumes, query, blobsize=2, edge_win=3):
+def getSearchIndices(inds, search_win, offset):
+    """
+    Compute the lookup table indices of the search boxes along one axis,
+    mirroring the index arithmetic of searchAdjacentChannel/searchColocalizeChannel
+
+    Parameters
+    ----------
+    inds : 1D numpy array - row or column indices of the center points
+    search_win : ind - search window
+    offset : float - distance from the center point to the first box corner
+
+    Returns
+    ----------
+    startList : list of 1D int arrays - lower box corner, one per box
+    endList : list of 1D int arrays - upper box corner, one per box
+    """
+    startList = []
+    endList = []
+    start = inds - offset
+    for n in range(0, 3):
+        startList.append(np.trunc(start).astype(int))
+        endList.append(np.trunc(start + search_win).astype(int))
+        start = start + search_win
+
+    return startList, endList
+
+
+def getBoxMeans(lookupTable, rstart, rend, cstart, cend, search_win):
+    """
+    Mean value of a box for every center point of a slice, read from
+    a summed area table
+
+    Parameters
+    ----------
+    lookupTable : 2D numpy array - output of createLookupTables for one slice
+    rstart, rend : 1D int arrays - box row corners
+    cstart, cend : 1D int arrays - box column corners
+    search_win : ind - search window
+
+    Returns
+    ----------
+    boxMeans : 2D numpy array
+    """
+    sumIF1 = lookupTable[np.ix_(rend, cend)] + \
+        lookupTable[np.ix_(rstart, cstart)] - \
+        lookupTable[np.ix_(rend, cstart)] - \
+        lookupTable[np.ix_(rstart, cend)]
+
+    return sumIF1 / (search_win * search_win)
+
+
+def getLookupTableSlice(vol, zInd, isLookupTable=True):
+    """
+    Lookup table of a single slice
+
+    Parameters
+    ----------
+    vol : 3D numpy array
+    zInd : ind
+    isLookupTable : bool - vol already holds lookup tables (createLookupTables).
+        Otherwise the table is accumulated in float64 from vol[:, :, zInd]
+
+    Returns
+    ----------
+    lookupTable : 2D numpy array
+    """
+    if isLookupTable:
+        return vol[:, :, zInd]
+    return np.cumsum(np.cumsum(vol[:, :, zInd], 1, dtype=np.float64), 0)
+
+
+def searchAdjacentChannelSlice(adjacentVolList, search_win, cInds, rInds, zInd,
+                               isLookupTable=True):
+    """
+    Array version of searchAdjacentChannel - searches adjacent channels
+    for every (rInds x cInds) center point of slice zInd at once
+
+    Parameters
+    ----------
+    adjacentVolList : list of numpy 3D volumes (lookup tables)
+    search_win : ind - search window
+    cInds : 1D numpy array - column indices
+    rInds : 1D numpy array - row indices
+    zInd : ind
+    isLookupTable : bool - see getLookupTableSlice (default True)
+
+    Returns
+    ----------
+    result : 2D numpy array - max signal in the 3D search region
+    """
+    numSlices = adjacentVolList[0].shape[2]
+    if (zInd == 0):
+        zrange = [0, 1]
+    elif (zInd == (numSlices - 1)):
+        zrange = range(numSlices - 2, numSlices)
+    else:
+        zrange = range(zInd - 1, zInd + 2)
+
+    if numSlices == 1:
+        zrange = [0]
+
+    rstartList, rendList = getSearchIndices(rInds, search_win, 1.5 * search_win)
+    cstartList, cendList = getSearchIndices(cInds, search_win, 1.5 * search_win)
+
+    # Running argmax over the 27 grid cells of the first channel. Cells
+    # outside of zrange are zero in the loop version, so they are kept
+    # as candidates to match np.argmax exactly.
+    gridShape = (len(rInds), len(cInds))
+    maxVal = None
+    result = np.zeros(gridShape)
+    for zItr in zrange:
+        slices = [getLookupTableSlice(vol, zItr, isLookupTable) for vol in adjacentVolList]
+        for row in range(0, 3):
+            for col in range(0, 3):
+                cellVal = getBoxMeans(slices[0], rstartList[row], rendList[row],
+                                      cstartList[col], cendList[col], search_win)
+                cellProd = cellVal
+                for volItr in range(1, len(slices)):
+                    cellProd = cellProd * getBoxMeans(
+                        slices[volItr], rstartList[row], rendList[row],
+                        cstartList[col], cendList[col], search_win)
+
+                if maxVal is None:
+                    maxVal = cellVal
+                    result = cellProd
+                    continue
+
+                update = (cellVal > maxVal) | \
+                    (np.isnan(cellVal) & ~np.isnan(maxVal))
+                maxVal = np.where(update, cellVal, maxVal)
+                result = np.where(update, cellProd, result)
+
+    # Grid cells outside of zrange are left at zero in the loop version
+    if len(zrange) < 3:
+        result = np.where(maxVal < 0, 0.0, result)
+
+    return result
+
+
+def searchColocalizeChannelSlice(baseVolList, search_win, cInds, rInds, zInd,
+                                 isLookupTable=True):
+    """
+    Array version of searchColocalizeChannel for every (rInds x cInds)
+    center point of slice zInd
+
+    Parameters
+    ----------
+    baseVolList : list of volumes who's markers are supposed to colocalize with each other
+    search_win : ind - search window
+    cInds : 1D numpy array - column indices
+    rInds : 1D numpy array - row indices
+    zInd : ind
+    isLookupTable : bool - see getLookupTableSlice (default True)
+
+    Returns
+    ----------
+    output : 2D numpy array - product of colocalization across channels
+    """
+    rstartList, rendList = getSearchIndices(rInds, search_win, search_win / 2)
+    cstartList, cendList = getSearchIndices(cInds, search_win, search_win / 2)
+
+    output = np.ones((len(rInds), len(cInds)))
+    for volItr in range(1, len(baseVolList)):
+        lookupTable = getLookupTableSlice(baseVolList[volItr], int(zInd), isLookupTable)
+        output = output * getBoxMeans(lookupTable,
+                                      rstartList[0], rendList[0],
+                                      cstartList[0], cendList[0], search_win)
+
+    return output
+
+
+def combinePrePostVolumesVectorized(baseVolList, adjacentVolList, edge_win, search_win,
+                                    glialvolumes=None, lookupTables=False):
+    """
+    Array level engine for combinePrePostVolumes and combinePrePostVolumes_astro.
+    Every voxel of a slice is processed at once from the summed area tables;
+    the output is identical to the per voxel loop. float64 volumes are turned
+    into lookup tables in place, lower precision volumes are left untouched
+    and their lookup tables are accumulated in float64 one slice at a time.
+
+    Parameters
+    ----------
+    baseVolList : list of 3D numpy arrays
+    adjacentVolList : Adjacent volumes list. pass empty array if no
+                      adjacent synaptic volumes are present in the dataset
+    edge_win : int - edge to ignore
+    search_win - search_win must be even
+    glialvolumes : list of 3D numpy arrays - only used by the astro queries (default None)
+    lookupTables : bool - the float64 volumes that are searched are already
+        lookup tables (default False)
+
+    Returns
+    ----------
+    outputVol : 3D Numpy Array - Final Probability Map
+    """
+
+    if glialvolumes is None and len(baseVolList) == 1 and len(adjacentVolList) == 0:
+        print('return input')
+        return baseVolList[0]
+
+    # Allocate memory
+    outputVol = np.zeros(baseVolList[0].shape, dtype=baseVolList[0].dtype)
+    isLookupTable = all(vol.dtype == np.float64 for vol in
+                        baseVolList + adjacentVolList + (glialvolumes or []))
+
+    if isLookupTable and not lookupTables:
+        # If there are multiple volumes associated with the same synaptic side
+        if len(baseVolList) > 1:
+            baseVolList[1:] = createLookupTables(baseVolList[1:])
+
+        # Create lookup tables
+        if len(adjacentVolList) > 0:
+            adjacentVolList = createLookupTables(adjacentVolList)
+            if glialvolumes is not None:
+                glialvolumes = createLookupTables(glialvolumes)
+
+    baseVol = baseVolList[0]
+    rInds = np.arange(edge_win, baseVol.shape[0] - edge_win)
+    cInds = np.arange(edge_win, baseVol.shape[1] - edge_win)
+    if len(rInds) == 0 or len(cInds) == 0:
+        return outputVol
+
+    # For each z slice
+    for zInd in range(0, baseVol.shape[2]):
+        print("starting z ind: " + str(zInd))
+
+        baseSlice = baseVol[rInds[0]:rInds[-1] + 1, cInds[0]:cInds[-1] + 1, zInd]
+        keep = ~(baseSlice < 0.5)
+        if not np.any(keep):
+            continue
+
+        # Only search the bounding box of the candidate voxels, e.g. the
+        # regions outside of a DAPI mask are never above threshold
+        keepRows = np.flatnonzero(np.any(keep, axis=1))
+        keepCols = np.flatnonzero(np.any(keep, axis=0))
+        rSlice = slice(keepRows[0], keepRows[-1] + 1)
+        cSlice = slice(keepCols[0], keepCols[-1] + 1)
+        baseSlice = baseSlice[rSlice, cSlice]
+        keep = keep[rSlice, cSlice]
+        rBox = rInds[rSlice]
+        cBox = cInds[cSlice]
+
+        if len(adjacentVolList) > 0:
+            adjResult = searchAdjacentChannelSlice(
+                adjacentVolList, search_win, cBox, rBox, zInd, isLookupTable)
+            if glialvolumes is not None:
+                adjResult2 = searchAdjacentChannelSlice(
+                    glialvolumes, search_win, cBox, rBox, zInd, isLookupTable)
+                result = baseSlice * adjResult * adjResult2
+            elif len(baseVolList) > 1:
+                coresult = searchColocalizeChannelSlice(
+                    baseVolList, search_win, cBox, rBox, zInd, isLookupTable)
+                result = baseSlice * coresult * adjResult
+            else:
+                result = baseSlice * adjResult
+        else:
+            coresult = searchColocalizeChannelSlice(
+                baseVolList, search_win, cBox, rBox, zInd, isLookupTable)
+            result = baseSlice * coresult
+
+        outputSlice = outputVol[rBox[0]:rBox[-1] + 1, cBox[0]:cBox[-1] + 1, zInd]
+        outputSlice[keep] = result[keep]
+
+    return outputVol
+
+
+def processSynapticVolume(vol, blobsize, IF_z, sliceStatistics=None, workBuffer=None,
+                          sourceId=None, keepInput=False):
+    """
+    Steps 1-3 of probabilistic synapse detection for a single channel
+
+    Parameters
+    ----------
+    vol : 3D numpy array - raw channel data
+    blobsize : int - minimum 2D blob size
+    IF_z : int - number of slices each blob should span
+    sliceStatistics : tuple - see getProbMap (default None)
+    workBuffer : 3D numpy array - same shape and dtype as vol. If given, every
+        step runs in place and the buffer holds the factor volume (default None)
+    sourceId : tuple - identifies the raw data (see preprocessCache.get_source_ids).
+        If given, the result is looked up in / stored to the preprocessing
+        cache. Ignored for tiles, which carry sliceStatistics (default None)
+    keepInput : bool - leave vol unchanged, e.g. to measure the raw data
+        afterwards. Step 1 writes to a new array instead of vol. Read only
+        volumes are always left unchanged (default False)
+
+    Returns
+    ----------
+    vol : 3D numpy array
+    """
+    cache = preprocessCache.get_default_cache()
+    key = None
+    if cache is not None and sourceId is not None and sliceStatistics is None:
+        key = preprocessCache.make_key(sourceId, blobsize, IF_z, 'normal', vol.dtype)
+        cachedVol = cache.get(key)
+        if cachedVol is not None:
+            print('using cached preprocessed volume')
+            return cachedVol
+
+    vol = getProbMap(vol, sliceStatistics, out=np.empty_like(vol) if keepInput else None)  # Step 1
+    vol = convolveVolume(vol, blobsize, inplace=workBuffer is not None)  # Step 2
+
+    if IF_z > 1:
+        factorVol = computeFactor(vol, int(IF_z), out=workBuffer)  # Step 3
+        if workBuffer is None:
+            vol = vol * factorVol
+        else:
+            np.multiply(vol, factorVol, out=vol)
+
+    if key is not None:
+        cache.put(key, vol)
+
+    return vol
+
+
+def getPrecisionBuffers(synapticVolumes, query):
+    """
+    Cast the channels to query['precision'] and allocate the shared work
+    buffer used by processSynapticVolume. float64 (the default) keeps the
+    original, allocating pipeline.
+
+    Parameters
+    ----------
+    synapticVolumes : dict - lists of 3D numpy arrays, modified in place
+    query : dict
+
+    Returns
+    ----------
+    workBuffer : 3D numpy array or None
+    """
+    precision = np.dtype(query.get('precision', 'float64'))
+    if precision == np.float64:
+        return None
+
+    workBuffer = None
+    for key in synapticVolumes.keys():
+        for n, vol in enumerate(synapticVolumes[key]):
+            synapticVolumes[key][n] = vol.astype(precision, copy=False)
+            if workBuffer is None:
+                workBuffer = np.empty(vol.shape, dtype=precision)
+
+    return workBuffer
+
+
+def getSynapseDetections(synapticVolumes, query, blobsize=2, edge_win=3, sliceStatistics=None,
+                         sourceIds=None):
     """
     This function calls the functions needed to run probabilistic synapse detection
 
@@ -527,12 +1165,21 @@ def getSynapseDetections(synapticVolumes, query, blobsize=2, edge_win=3):
     synapticVolumes : dict
         has two keys (presynaptic,postsynaptic) which contain lists of 3D numpy arrays
     query : dict
-        contains the minumum slice information for each channel
+        contains the minumum slice information for each channel.
+        query['backend'] selects the kernel backend (see getKernelBackend).
+        query['precision'] = 'float32' keeps the channels in float32 and runs
+        every step in place on shared buffers (see getPrecisionDeviation)
     blobsize : int
         Minimum 2D Blob Size (default 2)
     edge_win: int
         Edge window (default is 1.5*blobsize)
-
+    sliceStatistics : dict
+        same layout as synapticVolumes, holds the getSliceStatistics output
+        of each channel. Used when synapticVolumes is a tile (default None)
+    sourceIds : dict
+        same layout as synapticVolumes, output of preprocessCache.get_source_ids.
+        Preprocessed channels are shared across queries through the
+        preprocessing cache (default None)
 
     Returns
     ----------
@@ -544,6 +1191,14 @@ def getSynapseDetections(synapticVolumes, query, blobsize=2, edge_win=3):
         blobsize = query['punctumSize']
         edge_win = int(np.ceil(blobsize * 1.5))
 
+    backend = getKernelBackend(query)
+    workBuffer = getPrecisionBuffers(synapticVolumes, query)
+    if workBuffer is not None and backend != 'numpy':
+        # lower precision lookup tables are only accumulated in float64
+        # by the numpy engine
+        print('precision mode uses the numpy backend')
+        backend = 'numpy'
+
     # Data
     presynapticVolumes = synapticVolumes['presynaptic']
     postsynapticVolumes = synapticVolumes['postsynaptic']
@@ -553,37 +1208,259 @@ def getSynapseDetections(synapticVolumes, query, blobsize=2, edge_win=3):
     postIF_z = query['postIF_z']
 
     for n in range(0, len(presynapticVolumes)):
+        stats = None
+        if sliceStatistics is not None:
+            stats = sliceStatistics['presynaptic'][n]
+        sourceId = None
+        if sourceIds is not None:
+            sourceId = sourceIds['presynaptic'][n]
 
-        presynapticVolumes[n] = getProbMap(presynapticVolumes[n])  # Step 1
-        presynapticVolumes[n] = convolveVolume(
-            presynapticVolumes[n], blobsize)  # Step 2
-
-        if preIF_z[n] > 1:
-            factorVol = computeFactor(
-                presynapticVolumes[n], int(preIF_z[n]))  # Step 3
-            presynapticVolumes[n] = presynapticVolumes[n] * factorVol
+        presynapticVolumes[n] = processSynapticVolume(
+            presynapticVolumes[n], blobsize, preIF_z[n], stats, workBuffer, sourceId)
 
     for n in range(0, len(postsynapticVolumes)):
+        stats = None
+        if sliceStatistics is not None:
+            stats = sliceStatistics['postsynaptic'][n]
+        sourceId = None
+        if sourceIds is not None:
+            sourceId = sourceIds['postsynaptic'][n]
 
-        postsynapticVolumes[n] = getProbMap(postsynapticVolumes[n])  # Step 1
-        postsynapticVolumes[n] = convolveVolume(
-            postsynapticVolumes[n], blobsize)  # Step 2
-
-        if postIF_z[n] > 1:
-            factorVol = computeFactor(
-                postsynapticVolumes[n], int(postIF_z[n]))  # Step 3
-            postsynapticVolumes[n] = postsynapticVolumes[n] * factorVol
+        postsynapticVolumes[n] = processSynapticVolume(
+            postsynapticVolumes[n], blobsize, postIF_z[n], stats, workBuffer, sourceId)
 
     if len(postsynapticVolumes) == 0:
         resultVol = combinePrePostVolumes(
-            presynapticVolumes, postsynapticVolumes, edge_win, blobsize)
+            presynapticVolumes, postsynapticVolumes, edge_win, blobsize, backend)
     else:
         resultVol = combinePrePostVolumes(
-            postsynapticVolumes, presynapticVolumes, edge_win, blobsize)
+            postsynapticVolumes, presynapticVolumes, edge_win, blobsize, backend)
 
     return resultVol
 
 
+def getPrecisionDeviation(synapticVolumes, query, precision='float32'):
+    """
+    Run getSynapseDetections in float64 and in the given precision and
+    report the maximum absolute difference between the two result volumes
+
+    Parameters
+    ----------
+    synapticVolumes : dict - not modified
+    query : dict
+    precision : str (default 'float32')
+
+    Returns
+    ----------
+    maxDeviation : float
+    """
+    results = []
+    for dtype in ['float64', precision]:
+        volumes = {key: [np.array(vol) for vol in synapticVolumes[key]]
+                   for key in synapticVolumes.keys()}
+        precisionQuery = dict(query)
+        precisionQuery['precision'] = dtype
+        results.append(getSynapseDetections(volumes, precisionQuery))
+
+    maxDeviation = float(np.max(np.abs(results[0] - results[1].astype(np.float64))))
+    print('maximum deviation from float64: ', maxDeviation)
+
+    return maxDeviation
+
+
+def getTileHalo(blobsize, edge_win, numslices=3):
+    """
+    Padding needed around a tile so that its interior matches the untiled
+    result. In x,y this covers the edge window / 3x3 box search of the
+    combine step plus the convolution kernel. In z computeFactor reaches
+    numslices // 2 slices and the 3 slice search in searchAdjacentChannel
+    one more.
+
+    Parameters
+    ----------
+    blobsize : int
+    edge_win : int
+    numslices : int - largest slice span of the query (default 3)
+
+    Returns
+    ----------
+    halo_xy : int
+    halo_z : int
+    """
+    halo_xy = max(edge_win, int(np.ceil(blobsize * 1.5))) + int(np.ceil(blobsize / 2))
+    halo_z = max(int(numslices) // 2, 1) + 1
+
+    return halo_xy, halo_z
+
+
+def getTileShape(volShape, numChannels, halo, memory_budget_gb, precision='float64'):
+    """
+    Largest tile whose padded size fits the memory budget. Tiles span the
+    full z range unless that leaves too small of a tile in x,y.
+
+    Parameters
+    ----------
+    volShape : tuple - shape of the full volume
+    numChannels : int
+    halo : tuple - (halo_xy, halo_z)
+    memory_budget_gb : float
+    precision : str - query['precision'] (default 'float64')
+
+    Returns
+    ----------
+    tileShape : tuple - (rows, cols, slices), not including the halo
+    """
+    halo_xy, halo_z = halo
+
+    # each channel is held as float64 plus ~4 volume sized temporaries
+    # while it is being processed and the tile result
+    bytesPerVoxel = 8 * (numChannels + 4)
+    if precision != 'float64':
+        # float32 channels, one shared work buffer and the result
+        bytesPerVoxel = np.dtype(precision).itemsize * (numChannels + 2)
+    maxVoxels = memory_budget_gb * 1e9 / bytesPerVoxel
+
+    tile_z = volShape[2]
+    tile_xy = int(np.sqrt(maxVoxels / tile_z)) - 2 * halo_xy
+
+    minTile = 4 * halo_xy
+    if tile_xy < minTile and volShape[2] > 1:
+        tile_xy = minTile
+        tile_z = int(maxVoxels / (tile_xy + 2 * halo_xy) ** 2) - 2 * halo_z
+        tile_z = min(max(tile_z, 1), volShape[2])
+
+    if tile_xy < 1:
+        print('memory budget is too small, using the smallest tile size')
+        tile_xy = 1
+
+    return (min(tile_xy, volShape[0]), min(tile_xy, volShape[1]), tile_z)
+
+
+def getTiles(volShape, tileShape, halo):
+    """
+    Split a volume into overlapping tiles
+
+    Parameters
+    ----------
+    volShape : tuple
+    tileShape : tuple - (rows, cols, slices)
+    halo : tuple - (halo_xy, halo_z)
+
+    Returns
+    ----------
+    tiles : list of (readInds, writeInds, cropInds) tuples of slices.
+        readInds - padded tile in the volume
+        writeInds - tile interior in the volume
+        cropInds - tile interior in the padded tile
+    """
+    halo_xy, halo_z = halo
+    axisTiles = []
+    for dim, tileLength, pad in zip(volShape, tileShape, [halo_xy, halo_xy, halo_z]):
+        ranges = []
+        for start in range(0, dim, tileLength):
+            end = min(start + tileLength, dim)
+            readStart = max(start - pad, 0)
+            readEnd = min(end + pad, dim)
+            ranges.append((slice(readStart, readEnd), slice(start, end),
+                           slice(start - readStart, end - readStart)))
+        axisTiles.append(ranges)
+
+    tiles = []
+    for rows in axisTiles[0]:
+        for cols in axisTiles[1]:
+            for slices in axisTiles[2]:
+                readInds = (rows[0], cols[0], slices[0])
+                writeInds = (rows[1], cols[1], slices[1])
+                cropInds = (rows[2], cols[2], slices[2])
+                tiles.append((readInds, writeInds, cropInds))
+
+    return tiles
+
+
+def getSynapseDetectionsTiled(synapticVolumes, query, memory_budget_gb=4.0, tileShape=None,
+                              outputVol=None, blobsize=2, edge_win=3, mask=None):
+    """
+    Tiled version of getSynapseDetections for volumes that do not fit in
+    memory. Each overlapping tile is run through the full pipeline and its
+    interior is written into the result volume. The probability map uses
+    the statistics of the full slices, so the result matches
+    getSynapseDetections up to floating point rounding in the lookup tables.
+
+    A mask is applied to each tile as it is read, which gives the same
+    result as masking the volumes first without modifying or copying
+    them. Tiles whose padded region is entirely masked out are skipped and
+    left at zero.
+
+    Parameters
+    ----------
+    synapticVolumes : dict
+        has two keys (presynaptic,postsynaptic) which contain lists of 3D arrays.
+        Anything that supports numpy slicing works, e.g. np.load(fn, mmap_mode='r');
+        the volumes are not modified
+    query : dict
+    memory_budget_gb : float - approximate peak memory of a tile (default 4.0)
+    tileShape : tuple - (rows, cols, slices) tile size, overrides memory_budget_gb (default None)
+    outputVol : 3D array - preallocated result, e.g. a np.memmap (default None)
+    blobsize : int
+        Minimum 2D Blob Size (default 2)
+    edge_win: int
+        Edge window (default is 1.5*blobsize)
+    mask : 2D or 3D array - nonzero voxels are kept (default None)
+
+    Returns
+    ----------
+    outputVol : 3D numpy array - final probability map
+    """
+
+    # Check to see if user supplied blobsize
+    if 'punctumSize' in query.keys():
+        blobsize = query['punctumSize']
+        edge_win = int(np.ceil(blobsize * 1.5))
+
+    keys = ['presynaptic', 'postsynaptic']
+    precision = query.get('precision', 'float64')
+    volList = synapticVolumes['presynaptic'] + synapticVolumes['postsynaptic']
+    volShape = volList[0].shape
+
+    numslices = max(list(query['preIF_z']) + list(query['postIF_z']) + [1])
+    halo = getTileHalo(blobsize, edge_win, numslices)
+    if tileShape is None:
+        tileShape = getTileShape(volShape, len(volList), halo, memory_budget_gb, precision)
+    print('tile shape: ', tileShape)
+
+    # Probability maps are computed from whole slice statistics
+    sliceStatistics = {key: [getSliceStatistics(vol, mask) for vol in synapticVolumes[key]]
+                       for key in keys}
+
+    if outputVol is None:
+        outputVol = np.zeros(volShape)
+
+    tiles = getTiles(volShape, tileShape, halo)
+    for n, (readInds, writeInds, cropInds) in enumerate(tiles):
+        if mask is not None:
+            tileMask = np.asarray(mask[readInds[:np.ndim(mask)]])
+            if not np.any(tileMask):
+                print('skipping masked tile ' + str(n + 1) + ' of ' + str(len(tiles)))
+                continue
+        print('starting tile ' + str(n + 1) + ' of ' + str(len(tiles)))
+
+        zInds = readInds[2]
+        tileVolumes = {key: [np.array(vol[readInds], dtype=precision)
+                             for vol in synapticVolumes[key]] for key in keys}
+        if mask is not None:
+            for key in keys:
+                for vol in tileVolumes[key]:
+                    applyMask(vol, tileMask)
+        tileStatistics = {key: [(means[zInds], stds[zInds])
+                                for means, stds in sliceStatistics[key]] for key in keys}
+
+        tileResult = getSynapseDetections(
+            tileVolumes, query, blobsize, edge_win, tileStatistics)
+        outputVol[writeInds] = tileResult[cropInds]
+
+    return outputVol
+
+
 def getSynapseDetections_astro(synapticVolumes, query, blobsize=2, edge_win=3):
     """
     This function calls the functions needed to run probabilistic synapse detection
@@ -593,7 +1470,9 @@ def getSynapseDetections_astro(synapticVolumes, query, blobsize=2, edge_win=3):
     synapticVolumes : dict
         has two keys (presynaptic,postsynaptic) which contain lists of 3D numpy arrays
     query : dict
-        contains the minumum slice information for each channel
+        contains the minumum slice information for each channel.
+        query['backend'] selects the kernel backend (see getKernelBackend).
+        query['precision'] = 'float32' runs in reduced precision (see getSynapseDetections)
     blobsize : int
         Minimum 2D Blob Size (default 2)
     edge_win: int
@@ -610,6 +1489,12 @@ def getSynapseDetections_astro(synapticVolumes, query, blobsize=2, edge_win=3):
         blobsize = query['punctumSize']
         edge_win = int(np.ceil(blobsize * 1.5))
 
+    backend = getKernelBackend(query)
+    workBuffer = getPrecisionBuffers(synapticVolumes, query)
+    if workBuffer is not None and backend != 'numpy':
+        print('precision mode uses the numpy backend')
+        backend = 'numpy'
+
     # Data
     presynapticVolumes = synapticVolumes['presynaptic']
     postsynapticVolumes = synapticVolumes['postsynaptic']
@@ -621,44 +1506,23 @@ def getSynapseDetections_astro(synapticVolumes, query, blobsize=2, edge_win=3):
     glialIF_z = query['glialIF_z']
 
     for n in range(0, len(presynapticVolumes)):
-
-        presynapticVolumes[n] = getProbMap(presynapticVolumes[n])  # Step 1
-        presynapticVolumes[n] = convolveVolume(
-            presynapticVolumes[n], blobsize)  # Step 2
-
-        if preIF_z[n] > 1:
-            factorVol = computeFactor(
-                presynapticVolumes[n], int(preIF_z[n]))  # Step 3
-            presynapticVolumes[n] = presynapticVolumes[n] * factorVol
+        presynapticVolumes[n] = processSynapticVolume(
+            presynapticVolumes[n], blobsize, preIF_z[n], workBuffer=workBuffer)
 
     for n in range(0, len(postsynapticVolumes)):
-
-        postsynapticVolumes[n] = getProbMap(postsynapticVolumes[n])  # Step 1
-        postsynapticVolumes[n] = convolveVolume(
-            postsynapticVolumes[n], blobsize)  # Step 2
-
-        if postIF_z[n] > 1:
-            factorVol = computeFactor(
-                postsynapticVolumes[n], int(postIF_z[n]))  # Step 3
-            postsynapticVolumes[n] = postsynapticVolumes[n] * factorVol
+        postsynapticVolumes[n] = processSynapticVolume(
+            postsynapticVolumes[n], blobsize, postIF_z[n], workBuffer=workBuffer)
 
     for n in range(0, len(glialVolumes)):
-
-        glialVolumes[n] = getProbMap(glialVolumes[n])  # Step 1
-        glialVolumes[n] = convolveVolume(
-            glialVolumes[n], blobsize)  # Step 2
-
-        if glialIF_z[n] > 1:
-            factorVol = computeFactor(
-                glialVolumes[n], int(glialIF_z[n]))  # Step 3
-            glialVolumes[n] = glialVolumes[n] * factorVol
+        glialVolumes[n] = processSynapticVolume(
+            glialVolumes[n], blobsize, glialIF_z[n], workBuffer=workBuffer)
 
     if len(postsynapticVolumes) == 0:
         resultVol = combinePrePostVolumes_astro(
-            presynapticVolumes, postsynapticVolumes, glialVolumes, edge_win, blobsize)
+            presynapticVolumes, postsynapticVolumes, glialVolumes, edge_win, blobsize, backend)
     else:
         resultVol = combinePrePostVolumes_astro(
-            postsynapticVolumes, presynapticVolumes, glialVolumes, edge_win, blobsize)
+            postsynapticVolumes, presynapticVolumes, glialVolumes, edge_win, blobsize, backend)
 
     return resultVol
 
@@ -678,7 +1542,7 @@ def loadMetadata(fn):
     return data
 
 
-def saveresultvol(vol, datalocation, filename, n):
+def saveresultvol(vol, datalocation, filename, n, fileFormat=None):
     """
     save result volume
     Parameters
@@ -687,10 +1551,107 @@ def saveresultvol(vol, datalocation, filename, n):
     datalocation : str
     filename : str
     n : int
+    fileFormat : str - 'npy', 'h5' or 'sparse' (default RESULT_FORMAT). 'h5'
+        writes a chunked, compressed HDF5 file with a single 'resultvol'
+        dataset, 'sparse' writes the coordinates and float32 values of the
+        non-zero voxels to an .npz file (see sparseVolume). Results of
+        the same query in the other formats are removed
+
+    Returns
+    -------------
+    fn : str - the file that was written
     """
+    if fileFormat is None:
+        fileFormat = RESULT_FORMAT
+    if fileFormat not in RESULT_EXTENSIONS:
+        raise ValueError('unknown result format: ' + str(fileFormat))
+
     if not os.path.isdir(datalocation):
         os.makedirs(datalocation)
 
     fn = os.path.join(datalocation, filename)
-    fn = fn + str(n) + '.npy'
-    np.save(fn, vol)
+    fn = fn + str(n)
+
+    # an older result in another format would otherwise be loaded instead
+    # of this one, see loadresultvol
+    for extension in RESULT_EXTENSIONS.values():
+        if os.path.isfile(fn + extension):
+            os.remove(fn + extension)
+
+    if fileFormat == 'h5':
+        # one file per result so parallel workers never share a writer
+        da.write_h5_volume(fn + '.h5', 'resultvol', vol)
+        return fn + '.h5'
+    elif fileFormat == 'npy':
+        np.save(fn + '.npy', vol)
+        return fn + '.npy'
+    else:
+        if not isinstance(vol, sparseVolume.SparseResultVolume):
+            vol = sparseVolume.SparseResultVolume.from_dense(vol)
+        vol.save(fn + '.npz')
+        return fn + '.npz'
+
+
+def loadresultvol(datalocation, filename, n, sparse=False):
+    """
+    load a result volume written by saveresultvol, in any format. If
+    there are files in several formats the newest one is loaded
+    Parameters
+    -------------
+    datalocation : str
+    filename : str
+    n : int
+    sparse : bool - return a SparseResultVolume instead of a dense array
+        (default False)
+
+    Returns
+    -------------
+    vol : numpy 3D array or SparseResultVolume
+    """
+    fn = os.path.join(datalocation, filename)
+    fn = fn + str(n)
+    fns = [fn + extension for extension in RESULT_EXTENSIONS.values()
+           if os.path.isfile(fn + extension)]
+    if len(fns) == 0:
+        raise FileNotFoundError('no result volume ' + fn + '.*')
+    fn = max(fns, key=lambda name: os.stat(name).st_mtime_ns)
+
+    if fn.endswith('.npz'):
+        vol = sparseVolume.SparseResultVolume.load(fn)
+        if sparse:
+            return vol
+        return vol.to_dense()
+
+    if fn.endswith('.h5'):
+        vol = da.imreadh5(fn, 'resultvol')
+    else:
+        vol = np.load(fn)
+
+    if sparse:
+        return sparseVolume.SparseResultVolume.from_dense(vol)
+    return vol
+
+
+def loadthresholdedresultvols(datalocation, filename, listOfQueryNumbers, listOfThresholds):
+    """
+    union of thresholded result volumes. The volumes are thresholded in
+    their sparse form, only the combined mask is dense
+    Parameters
+    -------------
+    datalocation : str
+    filename : str
+    listOfQueryNumbers : list of ints
+    listOfThresholds : list of floats - one per query
+
+    Returns
+    -------------
+    mask : boolean numpy 3D array
+    """
+    mask = None
+    for queryNum, thresh in zip(listOfQueryNumbers, listOfThresholds):
+        vol = loadresultvol(datalocation, filename, queryNum, sparse=True).threshold(thresh)
+        if mask is None:
+            mask = np.zeros(vol.shape, dtype=bool)
+        mask[vol.rows, vol.cols, vol.zs] = True
+
+    return mask
@@ -0,0 +1,119 @@
+"""
+Columnar bounds of annotations (lists of AreaList dicts, see
+AnnotationJsonSchema) and the edge classification of the evaluation,
+computed with array operations over every area at once instead of shapely
+polygons per annotation.
+"""
+import numpy as np
+import pandas as pd
+from at_synapse_detection import annotationTable as at
+
+
+def get_area_bounds(annotations):
+    """
+    Bounds of every area of a list of annotations
+
+    Parameters
+    ----------
+    annotations : list of dicts or AnnotationTable - AreaList dicts
+
+    Returns
+    ----------
+    area_bounds : DataFrame - one row per area with the columns
+        annotation : int - index of the annotation in the list
+        z, minX, minY, maxX, maxY : float
+        zero_area : bool - the path encloses no area
+    """
+    return at.AnnotationTable.from_area_lists(annotations).area_bounds()
+
+
+def get_annotation_bounds(area_bounds, num_annotations):
+    """
+    Bounding box of each annotation
+
+    Parameters
+    ----------
+    area_bounds : DataFrame - see get_area_bounds
+    num_annotations : int
+
+    Returns
+    ----------
+    bounds : DataFrame - columns minX, minY, minZ, maxX, maxY, maxZ, one row
+        per annotation, NaN for annotations without areas
+    """
+    owners = area_bounds['annotation'].values.astype(np.int64)
+    bounds = {}
+    for column, source, reduce in [('minX', 'minX', np.fmin), ('minY', 'minY', np.fmin),
+                                   ('minZ', 'z', np.fmin), ('maxX', 'maxX', np.fmax),
+                                   ('maxY', 'maxY', np.fmax), ('maxZ', 'z', np.fmax)]:
+        values = np.full(num_annotations, np.nan)
+        reduce.at(values, owners, area_bounds[source].values)
+        bounds[column] = values
+
+    return pd.DataFrame(bounds, columns=['minX', 'minY', 'minZ', 'maxX', 'maxY', 'maxZ'])
+
+
+def get_edge_annotations(annotations, ann_minX, ann_maxX, ann_minY, ann_maxY, ann_minZ,
+                         ann_maxZ, distance=100, min_edge_sections=4, area_bounds=None):
+    """
+    Which annotations are near the 'edge' of a dataset, the same as
+    evaluate_synapse_detection.is_annotation_near_edge for every annotation.
+
+    An annotation is near the edge if one of its areas is not inside the
+    data bounding box shrunk by distance, or if it is in fewer than
+    min_edge_sections sections and in the first or last section
+
+    Parameters
+    ----------
+    annotations : list of dicts or AnnotationTable - AreaList dicts
+    ann_minX, ann_maxX, ann_minY, ann_maxY, ann_minZ, ann_maxZ : float -
+        bounding box of the data
+    distance : int - x,y distance from edge to be considered near edge (default 100)
+    min_edge_sections : int (default 4)
+    area_bounds : DataFrame - get_area_bounds(annotations) if already
+        computed (default None)
+
+    Returns
+    ----------
+    is_edge : 1D bool numpy array
+    """
+    if area_bounds is None:
+        area_bounds = get_area_bounds(annotations)
+
+    is_edge = np.zeros(len(annotations), dtype=bool)
+    if len(area_bounds) == 0:
+        return is_edge
+    owners = area_bounds['annotation'].values.astype(np.int64)
+
+    # The shrunk box is a rectangle, an area is inside it if its bounds
+    # are. As for shapely's contains, an area that encloses nothing must not
+    # touch the border of the box
+    inner_minX = ann_minX + distance
+    inner_maxX = ann_maxX - distance
+    inner_minY = ann_minY + distance
+    inner_maxY = ann_maxY - distance
+    if inner_minX >= inner_maxX or inner_minY >= inner_maxY:
+        outside = np.ones(len(area_bounds), dtype=bool)
+    else:
+        minX = area_bounds['minX'].values
+        maxX = area_bounds['maxX'].values
+        minY = area_bounds['minY'].values
+        maxY = area_bounds['maxY'].values
+        outside = (minX < inner_minX) | (maxX > inner_maxX) | \
+            (minY < inner_minY) | (maxY > inner_maxY)
+        touches = (minX == inner_minX) | (maxX == inner_maxX) | \
+            (minY == inner_minY) | (maxY == inner_maxY)
+        outside |= touches & area_bounds['zero_area'].values.astype(bool)
+    is_edge[owners[outside]] = True
+
+    # distinct sections of each annotation
+    sections = np.unique(np.stack([owners, area_bounds['z'].values], axis=1), axis=0)
+    section_owners = sections[:, 0].astype(np.int64)
+    num_sections = np.bincount(section_owners, minlength=len(annotations))
+    touches_z = (sections[:, 1] == ann_minZ) | (sections[:, 1] == ann_maxZ)
+    on_z_edge = np.zeros(len(annotations), dtype=bool)
+    on_z_edge[section_owners[touches_z]] = True
+
+    is_edge |= on_z_edge & (num_sections < min_edge_sections)
+
+    return is_edge
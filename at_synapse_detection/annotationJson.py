@@ -0,0 +1,193 @@
+"""
+Reader and writer of annotation files (see AnnotationJsonSchema).
+
+Files are parsed straight into an AnnotationTable: the points of all the
+areas are converted to one numpy array in a single call, instead of loading
+every AreaList through the marshmallow schema. orjson is used for parsing
+and writing when it is installed.
+
+Validation is opt-in, set by the validate argument or the
+SYNAPSE_ANNOTATION_VALIDATION environment variable:
+    'none' - only what is needed to build the table
+    'basic' - integer ids, finite Nx2 paths
+    'schema' - the marshmallow AnnotationFile schema, as before
+
+Detections are written one AreaList at a time with AnnotationWriter, so the
+whole area_lists dict of a volume is never held in memory. The file only
+appears once it is complete, a writer stopped by an exception leaves
+nothing behind.
+"""
+import os
+import gc
+import json
+import numpy as np
+from at_synapse_detection import annotationTable as at
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+VALIDATION_LEVELS = ['none', 'basic', 'schema']
+VALIDATION = os.environ.get('SYNAPSE_ANNOTATION_VALIDATION', 'none')
+
+
+def _json_default(obj):
+    """
+    numpy values for the json module
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+
+def loads(raw):
+    """
+    Parse json bytes or str
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def dumps(obj):
+    """
+    json bytes of an object, numpy arrays and scalars are written as lists
+    and numbers
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=_json_default).encode('utf-8')
+
+
+def validate_schema(annotation_d):
+    """
+    Check the contents of an annotation file with the AnnotationFile schema
+
+    Raises
+    ----------
+    ValueError - the schema errors
+    """
+    # argschema is only needed for this level
+    from at_synapse_detection.AnnotationJsonSchema import AnnotationFile
+
+    errors = AnnotationFile().validate(annotation_d)
+    if len(errors) > 0:
+        raise ValueError('invalid annotation file: ' + str(errors))
+
+
+def read_annotation_file(fn, validate=None):
+    """
+    Read an annotation file into an AnnotationTable
+
+    Parameters
+    ----------
+    fn : str - json file with an area_lists list
+    validate : str - one of VALIDATION_LEVELS (default VALIDATION)
+
+    Returns
+    ----------
+    table : AnnotationTable
+    """
+    if validate is None:
+        validate = VALIDATION
+    if validate not in VALIDATION_LEVELS:
+        raise ValueError('validate must be one of ' + str(VALIDATION_LEVELS))
+
+    with open(fn, 'rb') as f:
+        raw = f.read()
+
+    # the parsed file is millions of small lists that are all freed together,
+    # the garbage collector passes triggered while building them only cost time
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        annotation_d = loads(raw)
+        if validate == 'schema':
+            validate_schema(annotation_d)
+        table = at.AnnotationTable.from_area_lists(annotation_d['area_lists'], validate)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return table
+
+
+class AnnotationWriter:
+    """
+    Write an annotation file one AreaList at a time
+
+        with AnnotationWriter(fn) as writer:
+            for al in detections:
+                writer.write(al)
+
+    The AreaLists go to a temporary file next to fn, which is renamed to fn
+    when the with block ends without an exception and removed otherwise
+    """
+
+    def __init__(self, fn):
+        """
+        Parameters
+        ----------
+        fn : str - output json file
+        """
+        self.fn = fn
+        self.tmp_fn = fn + '.' + str(os.getpid()) + '.tmp'
+        self.num_written = 0
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.tmp_fn, 'wb')
+        self._file.write(b'{"area_lists": [')
+        return self
+
+    def write(self, al):
+        """
+        Append an AreaList dict, paths can be lists or numpy arrays
+        """
+        if self.num_written > 0:
+            self._file.write(b', ')
+        self._file.write(dumps(al))
+        self.num_written += 1
+
+    def write_all(self, area_lists):
+        """
+        Append every AreaList of a list of dicts or an AnnotationTable
+        """
+        for al in area_lists:
+            self.write(al)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._file.write(b']}')
+            self._file.close()
+        finally:
+            self._file = None
+            if exc_type is None:
+                os.replace(self.tmp_fn, self.fn)
+            elif os.path.isfile(self.tmp_fn):
+                os.remove(self.tmp_fn)
+        return False
+
+
+def write_annotation_file(fn, annotations):
+    """
+    Write annotations to a json file
+
+    Parameters
+    ----------
+    fn : str
+    annotations : list of dicts or AnnotationTable
+
+    Returns
+    ----------
+    num_written : int - number of AreaLists written
+    """
+    with AnnotationWriter(fn) as writer:
+        writer.write_all(annotations)
+
+    return writer.num_written
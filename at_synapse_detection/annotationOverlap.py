@@ -0,0 +1,117 @@
+"""
+Overlap tests between two sets of annotations (lists of AreaList dicts, see
+AnnotationJsonSchema), as used to evaluate LM detections against the EM
+ground truth.
+
+Two annotations overlap if any of their areas in the same z section
+intersect. The shapely polygon of every area is built once per annotation
+set, the areas of each z section are held in an in memory STRtree, and all
+the areas of a section are tested against the tree in one bulk query. The
+sections are independent and are queried on a thread pool (shapely releases
+the GIL).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shapely
+from shapely import STRtree
+from at_synapse_detection import annotationTable as at
+
+# Number of z sections tested at the same time
+EVAL_THREADS = int(os.environ.get('SYNAPSE_EVAL_THREADS', 4))
+
+
+class AnnotationGeometries:
+    """
+    Polygons of the areas of a set of annotations, grouped by z section
+    """
+
+    def __init__(self, annotations):
+        """
+        Parameters
+        ----------
+        annotations : list of dicts or AnnotationTable - AreaList dicts
+        """
+        table = at.AnnotationTable.from_area_lists(annotations)
+        self.num_annotations = len(table)
+
+        # all the polygons are built in one vectorized call from the flat
+        # coordinates of the table
+        self.sections = {}
+        if table.num_areas > 0:
+            rings = shapely.linearrings(
+                table.coords, indices=np.repeat(np.arange(table.num_areas),
+                                                np.diff(table.area_offsets)))
+            polygons = shapely.polygons(rings)
+            zs = table.area_z.astype(np.int64)
+            owners = table.area_owner
+            for z in np.unique(zs):
+                in_section = zs == z
+                self.sections[int(z)] = (polygons[in_section], owners[in_section])
+        self._trees = {}
+
+    def __len__(self):
+        return self.num_annotations
+
+    def get_tree(self, z):
+        """
+        STRtree of the areas of a z section, built on first use
+        """
+        if z not in self._trees:
+            self._trees[z] = STRtree(self.sections[z][0])
+        return self._trees[z]
+
+
+def get_geometries(annotations):
+    """
+    AnnotationGeometries of a list of annotations, geometries that are
+    already built are reused
+    """
+    if isinstance(annotations, AnnotationGeometries):
+        return annotations
+    return AnnotationGeometries(annotations)
+
+
+def compute_overlap_matrix(annotations1, annotations2, num_threads=None):
+    """
+    Which annotations of two sets overlap, the same as calling
+    evaluate_synapse_detection.do_annotations_overlap on every pair
+
+    Parameters
+    ----------
+    annotations1 : list of dicts, AnnotationTable or AnnotationGeometries
+    annotations2 : list of dicts, AnnotationTable or AnnotationGeometries
+    num_threads : int (default EVAL_THREADS)
+
+    Returns
+    ----------
+    overlap_matrix : 2D bool numpy array - (len(annotations1), len(annotations2))
+    """
+    if num_threads is None:
+        num_threads = EVAL_THREADS
+
+    geometries1 = get_geometries(annotations1)
+    geometries2 = get_geometries(annotations2)
+    overlap_matrix = np.zeros((len(geometries1), len(geometries2)), dtype=bool)
+
+    def query_section(z):
+        polygons1, owners1 = geometries1.sections[z]
+        _, owners2 = geometries2.sections[z]
+        pairs = geometries2.get_tree(z).query(polygons1, predicate='intersects')
+        return owners1[pairs[0]], owners2[pairs[1]]
+
+    common_z = sorted(set(geometries1.sections) & set(geometries2.sections))
+    # build the trees up front, the threads only query them
+    for z in common_z:
+        geometries2.get_tree(z)
+
+    if num_threads > 1 and len(common_z) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(query_section, common_z))
+    else:
+        results = [query_section(z) for z in common_z]
+
+    for inds1, inds2 in results:
+        overlap_matrix[inds1, inds2] = True
+
+    return overlap_matrix
@@ -0,0 +1,237 @@
+"""
+Columnar storage of annotations. The annotation files (see
+AnnotationJsonSchema) hold a list of AreaList dicts, each with a list of
+areas made of a z value and a global_path list of points. An
+AnnotationTable keeps the same data in flat arrays:
+
+    coords : (num_points, 2) float array - the points of every area
+    area_offsets : (num_areas + 1,) int array - area i is
+        coords[area_offsets[i]:area_offsets[i + 1]]
+    area_z : (num_areas,) float array
+    annotation_offsets : (num_annotations + 1,) int array - the areas of
+        annotation j are annotation_offsets[j] to annotation_offsets[j + 1]
+    oids, ids : (num_annotations,) arrays
+
+Indexing a table gives an AreaList dict whose paths are views of coords, so
+code written for the list of dicts reads a table unchanged. Only the z and
+global_path of the areas are kept.
+"""
+from itertools import chain
+import numpy as np
+import pandas as pd
+
+
+class AnnotationTable:
+    """
+    Columnar container of a list of annotations
+    """
+
+    def __init__(self, coords, area_offsets, area_z, annotation_offsets, oids, ids):
+        """
+        Parameters
+        ----------
+        coords : (num_points, 2) float array
+        area_offsets : (num_areas + 1,) int array
+        area_z : (num_areas,) float array
+        annotation_offsets : (num_annotations + 1,) int array
+        oids : (num_annotations,) array of strs
+        ids : (num_annotations,) int array
+        """
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.area_offsets = np.asarray(area_offsets, dtype=np.int64)
+        self.area_z = np.asarray(area_z, dtype=np.float64)
+        self.annotation_offsets = np.asarray(annotation_offsets, dtype=np.int64)
+        self.oids = np.asarray(oids, dtype=object)
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    @classmethod
+    def from_area_lists(cls, area_lists, validate='none'):
+        """
+        Parameters
+        ----------
+        area_lists : list of dicts - AreaList dicts, global_path as lists or
+            numpy arrays. Areas without a z get NaN
+        validate : str - 'none' or 'basic', integer ids and finite Nx2
+            paths (default 'none')
+
+        Returns
+        ----------
+        table : AnnotationTable
+        """
+        if isinstance(area_lists, AnnotationTable):
+            return area_lists
+
+        paths = []
+        area_z = []
+        num_areas = np.zeros(len(area_lists) + 1, dtype=np.int64)
+        for ind, al in enumerate(area_lists):
+            areas = al['areas']
+            num_areas[ind + 1] = len(areas)
+            for area in areas:
+                paths.append(area['global_path'])
+                area_z.append(area.get('z', np.nan))
+
+        lengths = np.fromiter(map(len, paths), dtype=np.int64, count=len(paths))
+        try:
+            if all(isinstance(path, list) for path in paths):
+                # parsed json, all the points are converted in a single call
+                coords = np.array(list(chain.from_iterable(paths)), dtype=np.float64)
+            else:
+                coords = np.concatenate([np.asarray(path, dtype=np.float64).reshape(-1, 2)
+                                         for path in paths] + [np.zeros((0, 2))])
+        except ValueError:
+            raise ValueError('global_path points must be [x, y] pairs')
+        coords = coords.reshape(-1, 2) if coords.size == 0 else coords
+        if coords.ndim != 2 or coords.shape[1] != 2 or len(coords) != np.sum(lengths):
+            raise ValueError('global_path points must be [x, y] pairs')
+
+        ids = [al['id'] for al in area_lists]
+        if validate == 'basic':
+            if not all(isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+                       for value in ids):
+                raise ValueError('AreaList ids must be integers')
+            if not np.all(np.isfinite(coords)):
+                raise ValueError('global_path points must be finite')
+
+        area_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        area_offsets[1:] = np.cumsum(lengths)
+
+        return cls(coords, area_offsets, area_z, np.cumsum(num_areas),
+                   [al.get('oid') for al in area_lists], ids)
+
+    @classmethod
+    def from_json_dict(cls, annotation_d):
+        """
+        Table of the contents of an annotation file, {'area_lists': [...]}
+        """
+        return cls.from_area_lists(annotation_d['area_lists'])
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        One table with the annotations of several tables, in order
+        """
+        tables = [cls.from_area_lists(table) for table in tables]
+        point_starts = np.cumsum([0] + [len(table.coords) for table in tables])
+        area_starts = np.cumsum([0] + [table.num_areas for table in tables])
+
+        area_offsets = [np.zeros(1, dtype=np.int64)] + \
+            [table.area_offsets[1:] + start for table, start in zip(tables, point_starts)]
+        annotation_offsets = [np.zeros(1, dtype=np.int64)] + \
+            [table.annotation_offsets[1:] + start for table, start in zip(tables, area_starts)]
+
+        return cls(np.concatenate([table.coords for table in tables] + [np.zeros((0, 2))]),
+                   np.concatenate(area_offsets),
+                   np.concatenate([table.area_z for table in tables] + [np.zeros(0)]),
+                   np.concatenate(annotation_offsets),
+                   np.concatenate([table.oids for table in tables] + [np.zeros(0, dtype=object)]),
+                   np.concatenate([table.ids for table in tables] + [np.zeros(0, dtype=np.int64)]))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_areas(self):
+        return len(self.area_z)
+
+    @property
+    def area_owner(self):
+        """
+        Index of the annotation of each area
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.annotation_offsets))
+
+    def get_path(self, area_ind):
+        """
+        Points of an area, a view of coords
+        """
+        return self.coords[self.area_offsets[area_ind]:self.area_offsets[area_ind + 1]]
+
+    def __getitem__(self, ind):
+        """
+        AreaList dict of an annotation, the paths are views of coords
+        """
+        if ind < 0:
+            ind = ind + len(self)
+        areas = [{'z': self.area_z[area_ind], 'global_path': self.get_path(area_ind)}
+                 for area_ind in range(self.annotation_offsets[ind],
+                                       self.annotation_offsets[ind + 1])]
+        return {'oid': self.oids[ind], 'id': int(self.ids[ind]), 'areas': areas}
+
+    def __iter__(self):
+        for ind in range(0, len(self)):
+            yield self[ind]
+
+    def select(self, inds):
+        """
+        New table of some of the annotations
+
+        Parameters
+        ----------
+        inds : 1D int array or bool mask
+
+        Returns
+        ----------
+        table : AnnotationTable
+        """
+        inds = np.arange(len(self))[inds]
+        area_counts = np.diff(self.annotation_offsets)[inds]
+        area_inds = np.concatenate(
+            [np.arange(self.annotation_offsets[ind], self.annotation_offsets[ind + 1])
+             for ind in inds] + [np.zeros(0, dtype=np.int64)])
+        point_counts = np.diff(self.area_offsets)[area_inds]
+        point_inds = np.concatenate(
+            [np.arange(self.area_offsets[area_ind], self.area_offsets[area_ind + 1])
+             for area_ind in area_inds] + [np.zeros(0, dtype=np.int64)])
+
+        return AnnotationTable(self.coords[point_inds],
+                               np.concatenate([[0], np.cumsum(point_counts)]),
+                               self.area_z[area_inds],
+                               np.concatenate([[0], np.cumsum(area_counts)]),
+                               self.oids[inds], self.ids[inds])
+
+    def area_bounds(self):
+        """
+        Bounds of every area, see annotationBounds.get_area_bounds
+        """
+        columns = ['annotation', 'z', 'minX', 'minY', 'maxX', 'maxY', 'zero_area']
+        if self.num_areas == 0:
+            empty = pd.DataFrame({column: np.zeros(0) for column in columns}, columns=columns)
+            return empty.astype({'annotation': np.int64, 'zero_area': bool})
+
+        starts = self.area_offsets[:-1]
+        ends = self.area_offsets[1:]
+        coords = self.coords
+
+        # shoelace formula, each point is paired with the next one of its area
+        next_inds = np.arange(1, len(coords) + 1)
+        next_inds[ends - 1] = starts
+        cross = coords[:, 0] * coords[next_inds, 1] - coords[next_inds, 0] * coords[:, 1]
+
+        return pd.DataFrame({'annotation': self.area_owner, 'z': self.area_z,
+                             'minX': np.minimum.reduceat(coords[:, 0], starts),
+                             'minY': np.minimum.reduceat(coords[:, 1], starts),
+                             'maxX': np.maximum.reduceat(coords[:, 0], starts),
+                             'maxY': np.maximum.reduceat(coords[:, 1], starts),
+                             'zero_area': np.add.reduceat(cross, starts) == 0},
+                            columns=columns)
+
+    def to_area_lists(self):
+        """
+        List of AreaList dicts with plain lists, as written to json
+        """
+        area_lists = []
+        for ind in range(0, len(self)):
+            areas = [{'z': float(self.area_z[area_ind]),
+                      'global_path': self.get_path(area_ind).tolist()}
+                     for area_ind in range(self.annotation_offsets[ind],
+                                           self.annotation_offsets[ind + 1])]
+            area_lists.append({'oid': self.oids[ind], 'id': int(self.ids[ind]), 'areas': areas})
+
+        return area_lists
+
+    def to_json_dict(self):
+        """
+        Contents of an annotation file, {'area_lists': [...]}
+        """
+        return {'area_lists': self.to_area_lists()}
@@ -6,9 +6,11 @@ import os
 import copy
 import numpy as np
 import pandas as pd
-from skimage import measure
 from at_synapse_detection import SynapseDetection as syn
 from at_synapse_detection import dataAccess as da
+from at_synapse_detection import preprocessCache as pc
+from at_synapse_detection import sparseVolume
+from at_synapse_detection import componentStats as cs
 
 
 def getdatavolume(synaptic_volumes, resolution):
@@ -123,37 +125,42 @@ def compute_single_channel_measurements(synaptic_volumes, antibody_measure, thre
     ab_measure : AntibodyAnalysis()
     """
 
-    if synaptic_side == 'presynaptic':
-        for n in range(0, len(synaptic_volumes)):
-            label_vol = measure.label(synaptic_volumes[n] > thresh)
-            stats = measure.regionprops(label_vol)
-            antibody_measure.presynaptic_list[n].puncta_density = len(
-                stats) / antibody_measure.volume_um3
-            antibody_measure.presynaptic_list[n].puncta_count = len(stats)
+    return compute_single_channel_sweep(synaptic_volumes, [antibody_measure], [thresh],
+                                        synaptic_side)[0]
 
-            arealist = []
-            for stat in stats:
-                arealist.append(stat.area)
 
-            antibody_measure.presynaptic_list[n].puncta_size = np.mean(
-                arealist)
-            antibody_measure.presynaptic_list[n].puncta_std = np.std(arealist)
+def compute_single_channel_sweep(synaptic_volumes, antibody_measures, thresholds, synaptic_side):
+    """Compute the single channel measurements at several thresholds, each
+    volume is labeled once for all of them
 
-    elif synaptic_side == 'postsynaptic':
-        for n in range(0, len(synaptic_volumes)):
-            label_vol = measure.label(synaptic_volumes[n] > thresh)
-            stats = measure.regionprops(label_vol)
-            antibody_measure.postsynaptic_list[n].puncta_density = len(
-                stats) / antibody_measure.volume_um3
-            antibody_measure.postsynaptic_list[n].puncta_count = len(stats)
-            arealist = []
-            for stat in stats:
-                arealist.append(stat.area)
-            antibody_measure.postsynaptic_list[n].puncta_size = np.mean(
-                arealist)
-            antibody_measure.postsynaptic_list[n].puncta_std = np.std(arealist)
+    Parameters
+    ---------------
+    synaptic_volumes : list
+    antibody_measures : list of AntibodyAnalysis() - one per threshold
+    thresholds : list of floats
+    synaptic_side : str - 'presynaptic' or 'postsynaptic'
 
-    return antibody_measure
+    Return
+    ---------------
+    antibody_measures : list of AntibodyAnalysis()
+    """
+
+    for n in range(0, len(synaptic_volumes)):
+        sizes_list = sparseVolume.sweep_components(synaptic_volumes[n], thresholds)
+        for antibody_measure, sizes in zip(antibody_measures, sizes_list):
+            if synaptic_side == 'presynaptic':
+                ab_measure = antibody_measure.presynaptic_list[n]
+            elif synaptic_side == 'postsynaptic':
+                ab_measure = antibody_measure.postsynaptic_list[n]
+            else:
+                continue
+
+            ab_measure.puncta_density = len(sizes) / antibody_measure.volume_um3
+            ab_measure.puncta_count = len(sizes)
+            ab_measure.puncta_size = np.mean(sizes)
+            ab_measure.puncta_std = np.std(sizes)
+
+    return antibody_measures
 
 
 def calculuate_target_ratio(antibody_measure, target_antibody_name):
@@ -186,7 +193,8 @@ def calculuate_target_ratio(antibody_measure, target_antibody_name):
     return antibody_measure
 
 
-def run_SACT(synaptic_volumes, query, thresh, resolution, target_antibody_name):
+def run_SACT(synaptic_volumes, query, thresh, resolution, target_antibody_name,
+             source_ids=None):
     """
     Run SACT. 
 
@@ -204,12 +212,38 @@ def run_SACT(synaptic_volumes, query, thresh, resolution, target_antibody_name):
     query : dict
     thresh : float
     resolution : dict
+    source_ids : dict - output of preprocessCache.get_source_ids, shares the
+        preprocessed channels with other queries (default None)
 
     Returns
     -----------
     antibody_measure : AntibodyAnalysis()
     """
 
+    return run_SACT_sweep(synaptic_volumes, query, [thresh], resolution,
+                          target_antibody_name, source_ids)[0]
+
+
+def run_SACT_sweep(synaptic_volumes, query, thresholds, resolution, target_antibody_name,
+                   source_ids=None):
+    """
+    Run SACT at several thresholds. The channels are processed and combined
+    once and each volume is labeled once for all the thresholds
+
+    Parameters
+    -----------
+    synaptic_volumes : dict - has two keys, 'postsynaptic' and 'presynaptic.' Each key contains a list of volumes. 
+    query : dict
+    thresholds : list of floats
+    resolution : dict
+    target_antibody_name : str
+    source_ids : dict - see run_SACT (default None)
+
+    Returns
+    -----------
+    antibody_measures : list of AntibodyAnalysis() - one per threshold
+    """
+
     antibody_measure = AntibodyAnalysis(query)
 
     # Get data volume
@@ -232,63 +266,55 @@ def run_SACT(synaptic_volumes, query, thresh, resolution, target_antibody_name):
     # Compute raw mean and standard deviation
     antibody_measure = compute_raw_measures(
         presynaptic_volumes, antibody_measure, 'presynaptic')
+    antibody_measure = compute_raw_measures(
+        postsynaptic_volumes, antibody_measure, 'postsynaptic')
 
-    # SNR test
-    raw_presynaptic_volumes = []
-    for vol in presynaptic_volumes:
-        raw_presynaptic_volumes.append(np.copy(vol))
+    # The raw measures are the same at every threshold
+    antibody_measures = [copy.deepcopy(antibody_measure) for thresh in thresholds]
+
+    # SNR test, the raw volumes are kept unchanged by the processing
+    raw_presynaptic_volumes = list(presynaptic_volumes)
 
     for n in range(0, len(presynaptic_volumes)):
-        presynaptic_volumes[n] = syn.getProbMap(
-            presynaptic_volumes[n])  # Step 1
-        presynaptic_volumes[n] = syn.convolveVolume(
-            presynaptic_volumes[n], blobsize)  # Step 2
-        if preIF_z[n] > 1:
-            factor_vol = syn.computeFactor(
-                presynaptic_volumes[n], int(preIF_z[n]))  # Step 3
-            presynaptic_volumes[n] = presynaptic_volumes[n] * factor_vol
+        source_id = None
+        if source_ids is not None:
+            source_id = source_ids['presynaptic'][n]
+        presynaptic_volumes[n] = syn.processSynapticVolume(
+            presynaptic_volumes[n], blobsize, preIF_z[n], sourceId=source_id,
+            keepInput=True)  # Steps 1-3
 
     # Compute single channel measurements
-    antibody_measure = compute_single_channel_measurements(
-        presynaptic_volumes, antibody_measure, thresh, 'presynaptic')
+    antibody_measures = compute_single_channel_sweep(
+        presynaptic_volumes, antibody_measures, thresholds, 'presynaptic')
 
     # SNR test
-    antibody_measure = compute_SNR_synapticside(raw_presynaptic_volumes,
-                                                presynaptic_volumes, thresh,
-                                                antibody_measure, 'presynaptic')
+    for thresh, antibody_measure in zip(thresholds, antibody_measures):
+        compute_SNR_synapticside(raw_presynaptic_volumes, presynaptic_volumes, thresh,
+                                 antibody_measure, 'presynaptic')
 
     print('Computed presynaptic single channel measurements')
 
-    # Compute raw mean and standard deviation
-    antibody_measure = compute_raw_measures(
-        postsynaptic_volumes, antibody_measure, 'postsynaptic')
-
-    # SNR test
-    raw_postsynaptic_volumes = []
-    for vol in postsynaptic_volumes:
-        raw_postsynaptic_volumes.append(np.copy(vol))
+    # SNR test, the raw volumes are kept unchanged by the processing
+    raw_postsynaptic_volumes = list(postsynaptic_volumes)
 
     for n in range(0, len(postsynaptic_volumes)):
-        postsynaptic_volumes[n] = syn.getProbMap(
-            postsynaptic_volumes[n])  # Step 1
-        postsynaptic_volumes[n] = syn.convolveVolume(
-            postsynaptic_volumes[n], blobsize)  # Step 2
-        if postIF_z[n] > 1:
-            factor_vol = syn.computeFactor(
-                postsynaptic_volumes[n], int(postIF_z[n]))  # Step 3
-            postsynaptic_volumes[n] = postsynaptic_volumes[n] * factor_vol
+        source_id = None
+        if source_ids is not None:
+            source_id = source_ids['postsynaptic'][n]
+        postsynaptic_volumes[n] = syn.processSynapticVolume(
+            postsynaptic_volumes[n], blobsize, postIF_z[n], sourceId=source_id,
+            keepInput=True)  # Steps 1-3
 
     # Compute single channel measurements
-    antibody_measure = compute_single_channel_measurements(
-        postsynaptic_volumes, antibody_measure, thresh, 'postsynaptic')
+    antibody_measures = compute_single_channel_sweep(
+        postsynaptic_volumes, antibody_measures, thresholds, 'postsynaptic')
 
     # SNR test
-    antibody_measure = compute_SNR_synapticside(raw_postsynaptic_volumes,
-                                                postsynaptic_volumes, thresh,
-                                                antibody_measure, 'postsynaptic')
+    for thresh, antibody_measure in zip(thresholds, antibody_measures):
+        compute_SNR_synapticside(raw_postsynaptic_volumes, postsynaptic_volumes, thresh,
+                                 antibody_measure, 'postsynaptic')
     print('Computed postsynaptic single channel measurements')
 
-    #"""
     if len(postsynaptic_volumes) == 0:
         resultVol = syn.combinePrePostVolumes(
             presynaptic_volumes, postsynaptic_volumes, edge_win, blobsize)
@@ -297,15 +323,14 @@ def run_SACT(synaptic_volumes, query, thresh, resolution, target_antibody_name):
             postsynaptic_volumes, presynaptic_volumes, edge_win, blobsize)
 
     # Compute whole statistics
-    label_vol = measure.label(resultVol > thresh)
-    stats = measure.regionprops(label_vol)
-    antibody_measure.synapse_density = len(stats) / antibody_measure.volume_um3
-    antibody_measure.synapse_count = len(stats)
+    sizes_list = sparseVolume.sweep_components(resultVol, thresholds)
+    for antibody_measure, sizes in zip(antibody_measures, sizes_list):
+        antibody_measure.synapse_density = len(sizes) / antibody_measure.volume_um3
+        antibody_measure.synapse_count = len(sizes)
 
-    antibody_measure = calculuate_target_ratio(
-        antibody_measure, target_antibody_name)
-    #"""
-    return antibody_measure
+        calculuate_target_ratio(antibody_measure, target_antibody_name)
+
+    return antibody_measures
 
 
 def compute_SNR_synapticside(raw_synaptic_volumes, synaptic_volumes, thresh, antibody_measure, synaptic_side):
@@ -330,29 +355,55 @@ def compute_SNR_synapticside(raw_synaptic_volumes, synaptic_volumes, thresh, ant
     return antibody_measure
 
 
-def compute_SNR(raw_synaptic_volume, synaptic_volume, thresh):
+def compute_SNR(raw_synaptic_volume, synaptic_volume, thresh, rowBlockSize=None):
     """ Compute SNR.  
-    Threshold 3D blobs, mask out raw data, compute mean blob intensity value
+    Threshold 3D blobs, mask out raw data, compute mean blob intensity value.
+    Zero valued raw voxels are left out. The volumes are read rowBlockSize
+    rows at a time and the running count, mean and sum of squared
+    differences of the blocks are merged (Chan et al.), so no full size
+    temporary volume is allocated
 
     Parameters
     ----------------
     raw_synaptic_volume : np array
-    synaptic_volume : list of np array
+    synaptic_volume : np array - processed volume, same shape
     thresh : float
-    synaptic_side : str
+    rowBlockSize : int (default SynapseDetection.ROW_BLOCK_SIZE)
 
     Return
     -----------------
-
+    signal_mean : float - nan if no voxel is above thresh
+    signal_std : float
     """
-    result = []
-    bw_vol = synaptic_volume > thresh
-    masked_vol = raw_synaptic_volume * bw_vol
-    flatvol = masked_vol.flatten()
-    zero_inds = np.where(flatvol == 0)
-    no_zeros_flatvol = np.delete(flatvol, zero_inds)
-    signal_mean = np.mean(no_zeros_flatvol)
-    signal_std = np.std(no_zeros_flatvol)
+    if rowBlockSize is None:
+        rowBlockSize = syn.ROW_BLOCK_SIZE
+
+    numRows = raw_synaptic_volume.shape[0]
+    count = 0
+    mean = 0.0
+    squaredDiffs = 0.0
+    for start in range(0, numRows, rowBlockSize):
+        rows = slice(start, min(start + rowBlockSize, numRows))
+        values = raw_synaptic_volume[rows][synaptic_volume[rows] > thresh]
+        values = values[values != 0]
+        if len(values) == 0:
+            continue
+
+        blockMean = np.mean(values, dtype=np.float64)
+        blockSquaredDiffs = np.sum(np.square(values - blockMean))
+
+        total = count + len(values)
+        delta = blockMean - mean
+        mean = mean + delta * len(values) / total
+        squaredDiffs = squaredDiffs + blockSquaredDiffs + \
+            delta * delta * count * len(values) / total
+        count = total
+
+    if count == 0:
+        return np.nan, np.nan
+
+    signal_mean = mean
+    signal_std = np.sqrt(squaredDiffs / count)
 
     return signal_mean, signal_std
 
@@ -470,10 +521,9 @@ def run_ab_analysis_rayleigh(synaptic_volumes, query, thresh, resolution, target
             postsynaptic_volumes, presynaptic_volumes, edge_win, blobsize)
 
     # Compute whole statistics
-    label_vol = measure.label(resultVol > thresh)
-    stats = measure.regionprops(label_vol)
-    antibody_measure.synapse_density = len(stats) / antibody_measure.volume_um3
-    antibody_measure.synapse_count = len(stats)
+    _, num_synapses = cs.label_components(resultVol > thresh)
+    antibody_measure.synapse_density = num_synapses / antibody_measure.volume_um3
+    antibody_measure.synapse_count = num_synapses
 
     antibody_measure = calculuate_target_ratio(
         antibody_measure, target_antibody_name)
@@ -555,8 +605,9 @@ def calculate_measure_lists(query_list, folder_names, base_dir, thresh,
 
         target_antibody_name = target_filenames[n]
         synaptic_volumes = da.load_tiff_from_query(query, data_location)
+        source_ids = pc.get_source_ids(query, data_location)
         measure = run_SACT(synaptic_volumes, query, thresh,
-                           resolution, target_antibody_name)
+                           resolution, target_antibody_name, source_ids)
 
         measure_list.append(measure)
 
@@ -789,11 +840,13 @@ def run_pairwise(query1, query2, target_antibody_name1, target_antibody_name2,
 
     synaptic_volumes1 = da.load_tiff_from_query(query1, base_dir)
     measure1 = run_SACT(
-        synaptic_volumes1, query1, thresh, resolution, target_antibody_name1)
+        synaptic_volumes1, query1, thresh, resolution, target_antibody_name1,
+        pc.get_source_ids(query1, base_dir))
 
     synaptic_volumes2 = da.load_tiff_from_query(query2, base_dir)
     measure2 = run_SACT(
-        synaptic_volumes2, query2, thresh, resolution, target_antibody_name2)
+        synaptic_volumes2, query2, thresh, resolution, target_antibody_name2,
+        pc.get_source_ids(query2, base_dir))
 
     return [measure1, measure2]
 
@@ -0,0 +1,379 @@
+"""
+Batch runs of many queries over many regions on one long lived worker
+pool. The channels of a region are read and masked once in the parent
+process and copied into multiprocessing.shared_memory blocks; the query
+tasks only carry the names of those blocks, so the volumes are neither
+pickled nor read again by every worker.
+
+At most MAX_LOADED_REGIONS regions are held in shared memory at a time,
+the next region is loaded while the queries of the current one run.
+"""
+import os
+import time
+import collections
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import dataAccess as da
+from at_synapse_detection import preprocessCache as pc
+
+# Number of regions kept in shared memory at the same time
+MAX_LOADED_REGIONS = int(os.environ.get('SYNAPSE_MAX_LOADED_REGIONS', 2))
+
+# Shared memory blocks attached by this (worker) process
+_attached = {}
+
+
+def share_volume(vol):
+    """
+    Copy a volume into a new shared memory block
+
+    Parameters
+    ----------
+    vol : numpy array
+
+    Returns
+    ----------
+    shm : SharedMemory - the block, the caller unlinks it
+    descriptor : dict - name, shape and dtype, see attach_volume
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(vol.nbytes, 1))
+    shared = np.ndarray(vol.shape, dtype=vol.dtype, buffer=shm.buf)
+    shared[...] = vol
+    descriptor = {'name': shm.name, 'shape': vol.shape, 'dtype': vol.dtype.str}
+    return shm, descriptor
+
+
+def attach_volume(descriptor):
+    """
+    Read only view of a volume shared by share_volume. The block stays
+    attached until release_attached is called
+
+    Parameters
+    ----------
+    descriptor : dict
+
+    Returns
+    ----------
+    vol : numpy array
+    """
+    name = descriptor['name']
+    if name not in _attached:
+        try:
+            # the parent owns the block, it must not be tracked here
+            _attached[name] = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            _attached[name] = shared_memory.SharedMemory(name=name)
+
+    vol = np.ndarray(descriptor['shape'], dtype=descriptor['dtype'],
+                     buffer=_attached[name].buf)
+    vol.flags.writeable = False
+    return vol
+
+
+def release_attached(keep=()):
+    """
+    Detach the shared memory blocks of this process, except the ones in keep
+
+    Parameters
+    ----------
+    keep : collection of block names (default ())
+    """
+    for name in list(_attached.keys()):
+        if name not in keep:
+            _attached.pop(name).close()
+
+
+def get_region_key(atet_input, astro=False):
+    """
+    Queries with the same data, masks and resolution share a region
+    """
+    return (atet_input['data_region_location'], str(atet_input['mask_str']),
+            atet_input['dapi_mask_str'], str(atet_input['mouse_number']),
+            tuple(sorted(atet_input['resolution'].items())), astro)
+
+
+def get_channel_keys(query, astro=False):
+    """
+    Layout of the channels of a query
+
+    Returns
+    ----------
+    channel_keys : dict - the synaptic_volumes keys and the query fields
+        holding their channel names
+    """
+    channel_keys = collections.OrderedDict(
+        [('presynaptic', 'preIF'), ('postsynaptic', 'postIF')])
+    if astro:
+        channel_keys['glialvolumes'] = 'glialIF'
+    return channel_keys
+
+
+def load_region(atet_inputs_list, astro=False, num_threads=None):
+    """
+    Read and mask every channel used by the queries of a region and copy
+    them into shared memory. Channels are read num_threads at a time, so
+    the parent holds at most num_threads private copies.
+
+    Parameters
+    ----------
+    atet_inputs_list : list of dicts - inputs of run_synapse_detection that
+        have the same region key
+    astro : bool - the queries are astro queries (default False)
+    num_threads : int (default dataAccess.LOAD_THREADS)
+
+    Returns
+    ----------
+    region : dict - descriptors of the shared channels, volume and mask files
+    blocks : list of SharedMemory
+    """
+    if num_threads is None:
+        num_threads = da.LOAD_THREADS
+
+    atet_input = atet_inputs_list[0]
+    data_region_location = atet_input['data_region_location']
+
+    # astro queries are only masked by the DAPI mask
+    layer_mask_str = -1 if astro else atet_input['mask_str']
+    combined_mask, mask_files = sa.load_combined_mask(
+        layer_mask_str, atet_input['dapi_mask_str'], atet_input['mouse_number'])
+    volume_um3 = sa.get_masked_volume(None, combined_mask, atet_input['resolution'])
+    print(volume_um3)
+
+    channels = []
+    for atet_input in atet_inputs_list:
+        query = atet_input['query']
+        dtype = np.dtype(query.get('precision', 'float64')).str
+        for name_key in get_channel_keys(query, astro).values():
+            for channelname in query[name_key]:
+                if (channelname, dtype) not in channels:
+                    channels.append((channelname, dtype))
+
+    def read_and_share(channel):
+        volume = da.read_channel(data_region_location, channel[0], channel[1])
+        syn.applyMask(volume, combined_mask)
+        return share_volume(volume)
+
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        shared = list(executor.map(read_and_share, channels))
+
+    region = {'volumes': {channel: descriptor for channel, (_, descriptor) in zip(channels, shared)},
+              'volume_um3': volume_um3, 'mask_files': mask_files}
+    blocks = [shm for shm, _ in shared]
+
+    return region, blocks
+
+
+def run_region_queries(atet_inputs_list, region, astro=False):
+    """
+    Worker task, run queries on the shared volumes of their region. Several
+    queries are run in a single pass with the query planner.
+
+    Parameters
+    ----------
+    atet_inputs_list : list of dicts - see SynapseAnalysis.run_synapse_detection,
+        the queries have the same precision
+    region : dict - see load_region
+    astro : bool - a single astro query (default False)
+
+    Returns
+    ----------
+    output_list : list of dicts - output of each query, in input order.
+        'seconds' is the run time of the task divided by its number of queries
+    """
+    start = time.time()
+
+    # blocks of regions that have been released are no longer needed
+    release_attached([descriptor['name'] for descriptor in region['volumes'].values()])
+
+    precision = atet_inputs_list[0]['query'].get('precision', 'float64')
+    dtype = np.dtype(precision).str
+
+    # the views are read only, the probability map (step 1) is written to a
+    # new array and the shared volumes are never copied
+    def load_channel(channelname):
+        return attach_volume(region['volumes'][(channelname, dtype)])
+
+    if len(atet_inputs_list) > 1:
+        output_list = sa.run_query_plan(atet_inputs_list, load_channel, region['volume_um3'],
+                                        precision)
+    else:
+        atet_input = atet_inputs_list[0]
+        query = atet_input['query']
+        synaptic_volumes = {key: [load_channel(channelname) for channelname in query[name_key]]
+                            for key, name_key in get_channel_keys(query, astro).items()}
+
+        source_ids = None
+        if not astro:
+            source_ids = pc.get_source_ids(query, atet_input['data_region_location'],
+                                           region['mask_files'])
+
+        output_list = [sa.detect_and_measure(atet_input, synaptic_volumes,
+                                             region['volume_um3'], source_ids, astro)]
+
+    seconds = (time.time() - start) / len(output_list)
+    for output_dict in output_list:
+        output_dict['seconds'] = seconds
+
+    return output_list
+
+
+def get_region_tasks(inds, atet_inputs_list, queries_per_task):
+    """
+    Split the queries of a region into tasks of queries with the same precision
+
+    Parameters
+    ----------
+    inds : list of ints - indices of the region's inputs in atet_inputs_list
+    atet_inputs_list : list of dicts
+    queries_per_task : int
+
+    Returns
+    ----------
+    tasks : list of lists of ints
+    """
+    groups = collections.OrderedDict()
+    for ind in inds:
+        precision = np.dtype(atet_inputs_list[ind]['query'].get('precision', 'float64')).str
+        groups.setdefault(precision, []).append(ind)
+
+    tasks = []
+    for group in groups.values():
+        for start in range(0, len(group), queries_per_task):
+            tasks.append(group[start:start + queries_per_task])
+
+    return tasks
+
+
+class BatchRunner:
+    """
+    Long lived worker pool for batch runs, use one runner for every mouse
+    of a batch instead of a pool per mouse
+    """
+
+    def __init__(self, num_workers=None, max_loaded_regions=None):
+        """
+        Parameters
+        ----------
+        num_workers : int (default cpu count - 1)
+        max_loaded_regions : int - regions held in shared memory at the same
+            time (default MAX_LOADED_REGIONS)
+        """
+        if num_workers is None:
+            num_workers = max(mp.cpu_count() - 1, 1)
+        if max_loaded_regions is None:
+            max_loaded_regions = MAX_LOADED_REGIONS
+
+        self.num_workers = num_workers
+        self.max_loaded_regions = max(max_loaded_regions, 1)
+
+        # Start the resource tracker first so the workers share it and do
+        # not report the parent's blocks as leaked
+        resource_tracker.ensure_running()
+        self.pool = mp.Pool(num_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def map_synapse_detection(self, atet_inputs_list, astro=False, queries_per_task=None,
+                              on_result=None, journal=None):
+        """
+        Same results as pool.map(SynapseAnalysis.run_synapse_detection,
+        atet_inputs_list), or run_synapse_detection_astro if astro is set
+
+        Parameters
+        ----------
+        atet_inputs_list : list of dicts
+        astro : bool (default False)
+        queries_per_task : int - queries of a region run in a single pass by
+            one worker, astro queries always run one at a time (default
+            spreads each region evenly over the workers)
+        on_result : function - called as on_result(index, output_dict) as the
+            results come in, e.g. to record progress (default None)
+        journal : runJournal.RunJournal - tasks completed in the journal are
+            not run again, new results are added to it (default None)
+
+        Returns
+        ----------
+        result_list : list of dicts - output of each input, in input order
+        """
+        result_list = [None] * len(atet_inputs_list)
+        todo = range(0, len(atet_inputs_list))
+        if journal is not None:
+            todo, done = journal.split(atet_inputs_list)
+            for ind in done:
+                result_list[ind] = journal.get_output(atet_inputs_list[ind])
+
+            user_on_result = on_result
+
+            def on_result(ind, output_dict):
+                journal.add(atet_inputs_list[ind], output_dict)
+                if user_on_result is not None:
+                    user_on_result(ind, output_dict)
+
+        regions = collections.OrderedDict()
+        for ind in todo:
+            regions.setdefault(get_region_key(atet_inputs_list[ind], astro), []).append(ind)
+
+        loaded = collections.deque()
+        try:
+            for n, inds in enumerate(regions.values()):
+                print('loading region ' + str(n + 1) + ' of ' + str(len(regions)))
+                region, blocks = load_region([atet_inputs_list[ind] for ind in inds], astro)
+
+                task_size = queries_per_task
+                if task_size is None:
+                    task_size = int(np.ceil(len(inds) / self.num_workers))
+                if astro:
+                    task_size = 1
+
+                tasks = []
+                for task_inds in get_region_tasks(inds, atet_inputs_list, max(task_size, 1)):
+                    task_inputs = [atet_inputs_list[ind] for ind in task_inds]
+                    tasks.append((task_inds, self.pool.apply_async(
+                        run_region_queries, (task_inputs, region, astro))))
+                loaded.append((blocks, tasks))
+
+                while len(loaded) >= self.max_loaded_regions:
+                    self.finish_region(loaded.popleft(), result_list, on_result)
+
+            while len(loaded) > 0:
+                self.finish_region(loaded.popleft(), result_list, on_result)
+        finally:
+            for blocks, _ in loaded:
+                release_blocks(blocks)
+
+        return result_list
+
+    def finish_region(self, loaded_region, result_list, on_result=None):
+        """
+        Wait for the queries of a region and free its shared memory
+        """
+        blocks, tasks = loaded_region
+        try:
+            for task_inds, task in tasks:
+                for ind, output_dict in zip(task_inds, task.get()):
+                    result_list[ind] = output_dict
+                    if on_result is not None:
+                        on_result(ind, output_dict)
+        finally:
+            release_blocks(blocks)
+
+
+def release_blocks(blocks):
+    """
+    Free shared memory blocks created by share_volume
+    """
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
@@ -2,15 +2,32 @@ import numpy as np
 import fnmatch
 import os
 import json
+import time
+import collections
+import tifffile
+from concurrent.futures import ThreadPoolExecutor
 from skimage import io
 from PIL import Image, ImageSequence
 
-def imreadtiff(fn):
+try:
+    import h5py
+    H5PY_AVAILABLE = True
+except ImportError:
+    H5PY_AVAILABLE = False
+
+# Extensions of the chunked HDF5 volume store
+H5_EXTENSIONS = ('.h5', '.hdf5')
+
+# Number of files read concurrently by the loaders
+LOAD_THREADS = int(os.environ.get('SYNAPSE_LOAD_THREADS', 4))
+
+def imreadtiff(fn, dtype=np.float64):
     """
     Load multipage tiff image file
     Parameters
     ----------
     fn : str - location of tiff stack
+    dtype : numpy dtype of the output (default float64)
 
     Returns
     ----------
@@ -19,14 +36,14 @@ def imreadtiff(fn):
     # Read tiff stack
 
     im = Image.open(fn)
-    output = np.zeros((im.height, im.width, im.n_frames))
+    output = np.zeros((im.height, im.width, im.n_frames), dtype=dtype)
     for n, page in enumerate(ImageSequence.Iterator(im)):
         output[:, :, n] = np.array(page)
 
     return output
 
 
-def imreadtiffseries(folderpath):
+def imreadtiffseries(folderpath, dtype=np.float64, num_threads=None):
     """
     Load a folder of tiff images
     The image filename format is hard coded - to be changed later
@@ -34,11 +51,16 @@ def imreadtiffseries(folderpath):
     ----------
     folderpath : str - location of tiff stack
     numImages : int - number of images in the folder
+    dtype : numpy dtype of the output (default float64)
+    num_threads : int - number of slices read at the same time (default LOAD_THREADS)
 
     Returns
     ----------
     output : numpy 3D array
     """
+    if num_threads is None:
+        num_threads = LOAD_THREADS
+
     # Read first image
     fn = os.path.join(folderpath, '00000.tiff')
     im = io.imread(fn)
@@ -47,18 +69,425 @@ def imreadtiffseries(folderpath):
     numImages = len(fnmatch.filter(os.listdir(folderpath), '*.tiff'))
 
     # Allocate Numpy Array
-    output = np.zeros([im.shape[0], im.shape[1], numImages])
+    output = np.zeros([im.shape[0], im.shape[1], numImages], dtype=dtype)
 
     # Read tiff stack
-    for n in range(0, numImages):
+    def read_slice(n):
         fn = os.path.join(folderpath, str(n).zfill(5))
         fn = fn + '.tiff'
-        im = io.imread(fn)
+        output[:, :, n] = io.imread(fn)
 
-        output[:, :, n] = im
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        list(executor.map(read_slice, range(0, numImages)))
 
     return output
 
+
+class TiffVolume:
+    """
+    Lazily loaded (y, x, z) volume backed by a multipage tiff file or a
+    folder of single page tiff images (00000.tiff, 00001.tiff, ...).
+    Uncompressed pages are memory-mapped, other pages are decoded when first
+    accessed and the most recently used ones are kept. Indexing returns a
+    numpy array in the native dtype of the file, only the pages (and for
+    memory-mapped pages, only the rows) inside the index are read. Rows and
+    columns take ints or slices, z also takes a list of slice indices and
+    always stays the last axis.
+
+    vol = TiffVolume(fn)
+    cutout = vol[startY:endY, startX:endX, startZ:endZ]
+    """
+
+    def __init__(self, fn, cache_size=16):
+        """
+        Parameters
+        ----------
+        fn : str - tiff file or folder of tiff images
+        cache_size : int - number of decoded pages to keep (default 16)
+        """
+        self.fn = fn
+        self.cache_size = cache_size
+        self.page_cache = collections.OrderedDict()
+        self.tiff_files = []
+
+        if os.path.isdir(fn):
+            numImages = len(fnmatch.filter(os.listdir(fn), '*.tiff'))
+            page_fns = [os.path.join(fn, str(n).zfill(5) + '.tiff')
+                        for n in range(0, numImages)]
+            self.pages = [self.open_page(page_fn, 0) for page_fn in page_fns]
+        else:
+            tif = tifffile.TiffFile(fn)
+            self.tiff_files.append(tif)
+            series = tif.series[0]
+            if series.dataoffset is not None and len(series.shape) in (2, 3):
+                # The whole stack is stored contiguously
+                stack = np.memmap(fn, dtype=series.dtype.newbyteorder(tif.byteorder),
+                                  mode='r', offset=series.dataoffset,
+                                  shape=series.shape)
+                if stack.ndim == 2:
+                    stack = stack[np.newaxis]
+                self.pages = list(stack)
+            else:
+                self.pages = [self.open_page(tif, n) for n in range(0, len(tif.pages))]
+
+        first = self.get_page(0)
+        self.shape = (first.shape[0], first.shape[1], len(self.pages))
+        self.dtype = first.dtype
+        self.ndim = 3
+
+    def open_page(self, tif, pageInd):
+        """
+        Memory-map a page if it is stored uncompressed and contiguously,
+        otherwise return a handle that is decoded by get_page
+        """
+        ownsFile = isinstance(tif, str)
+        if ownsFile:
+            tif = tifffile.TiffFile(tif)
+
+        page = tif.pages[pageInd]
+        if page.is_memmappable and len(page.shape) == 2:
+            pageMap = np.memmap(tif.filehandle.path, dtype=page.dtype.newbyteorder(tif.byteorder),
+                                mode='r', offset=page.dataoffsets[0], shape=page.shape)
+            if ownsFile:
+                tif.close()
+            return pageMap
+
+        if ownsFile:
+            self.tiff_files.append(tif)
+        return page
+
+    def get_page(self, z):
+        """
+        Returns slice z as a 2D array (a memory map if possible)
+        """
+        page = self.pages[z]
+        if isinstance(page, np.ndarray):
+            return page
+
+        if z in self.page_cache:
+            self.page_cache.move_to_end(z)
+            return self.page_cache[z]
+
+        try:
+            decoded = page.asarray()
+        except ValueError:
+            # tifffile needs imagecodecs for some compressions, PIL reads them
+            im = Image.open(page.parent.filehandle.path)
+            im.seek(page.index)
+            decoded = np.array(im)
+        self.page_cache[z] = decoded
+        if len(self.page_cache) > self.cache_size:
+            self.page_cache.popitem(last=False)
+
+        return decoded
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        rows, cols, zInds = key
+
+        if isinstance(zInds, (int, np.integer)):
+            return np.array(self.get_page(zInds)[rows, cols])
+
+        zInds = np.arange(self.shape[2])[zInds]
+        slices = [np.asarray(self.get_page(z)[rows, cols]) for z in zInds]
+        if len(slices) == 0:
+            return np.zeros(np.zeros(self.shape[0:2])[rows, cols].shape + (0,),
+                            dtype=self.dtype)
+
+        return np.stack(slices, axis=-1)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :, :], dtype=dtype)
+
+    def astype(self, dtype):
+        """
+        Read the whole volume as dtype
+        """
+        return np.asarray(self[:, :, :], dtype=dtype)
+
+    def close(self):
+        for tif in self.tiff_files:
+            tif.close()
+        self.tiff_files = []
+        self.page_cache.clear()
+
+
+_open_volumes = collections.OrderedDict()
+
+
+def get_tiff_volume(fn, max_open=8):
+    """
+    Returns a TiffVolume for fn, reusing volumes that were opened recently
+    so repeated cutouts share memory maps and decoded pages
+
+    Parameters
+    ----------
+    fn : str - tiff file or folder of tiff images
+    max_open : int - number of volumes to keep open (default 8)
+
+    Returns
+    ----------
+    vol : TiffVolume
+    """
+    fn = os.path.abspath(fn)
+    if fn in _open_volumes:
+        _open_volumes.move_to_end(fn)
+        return _open_volumes[fn]
+
+    vol = TiffVolume(fn)
+    _open_volumes[fn] = vol
+    if len(_open_volumes) > max_open:
+        closeVolume(_open_volumes.popitem(last=False)[1])
+
+    return vol
+
+
+def is_h5_file(fn):
+    """
+    True if fn points to an HDF5 volume store
+    """
+    return isinstance(fn, str) and fn.lower().endswith(H5_EXTENSIONS)
+
+
+def check_h5py():
+    if not H5PY_AVAILABLE:
+        raise ImportError('reading or writing .h5 volumes requires h5py')
+
+
+def get_default_chunks(shape):
+    """
+    Chunk shape of the HDF5 store, small enough in x,y for cutouts and a
+    few slices deep for tiled detection
+
+    Parameters
+    ----------
+    shape : tuple - (y, x, z) shape of the volume
+
+    Returns
+    ----------
+    chunks : tuple
+    """
+    return (min(shape[0], 128), min(shape[1], 128), min(shape[2], 8))
+
+
+def write_h5_volume(h5_fn, name, vol, chunks=None, compression='gzip', compression_opts=4):
+    """
+    Write a volume to an HDF5 store as a chunked, compressed dataset.
+    An existing dataset with the same name is replaced.
+
+    Parameters
+    ----------
+    h5_fn : str - HDF5 file, created if it does not exist
+    name : str - dataset name, e.g. the channel filename
+    vol : 3D array - anything that supports slicing by z, e.g. a TiffVolume
+    chunks : tuple (default get_default_chunks)
+    compression : str (default gzip)
+    compression_opts : int - compression level (default 4)
+    """
+    check_h5py()
+    if chunks is None:
+        chunks = get_default_chunks(vol.shape)
+
+    with h5py.File(h5_fn, 'a') as f:
+        if name in f:
+            del f[name]
+        dset = f.create_dataset(name, shape=vol.shape, dtype=vol.dtype, chunks=chunks,
+                                compression=compression, compression_opts=compression_opts,
+                                shuffle=True)
+        # Write a chunk of slices at a time so the input can stay on disk
+        for zstart in range(0, vol.shape[2], chunks[2]):
+            zend = min(zstart + chunks[2], vol.shape[2])
+            dset[:, :, zstart:zend] = vol[:, :, zstart:zend]
+
+
+def convert_tiffs_to_h5(input_location, channel_names, h5_fn, chunks=None,
+                        compression='gzip', compression_opts=4):
+    """
+    Copy the tiff data of a region into a single HDF5 store, one dataset per
+    channel in its native dtype. Works with multipage tiff files and with
+    folders of single page tiffs. The store can then be passed as the data
+    location of the loaders in this module.
+
+    Parameters
+    ----------
+    input_location : str - folder containing the channels
+    channel_names : list of strs - tiff filenames or folders, used as dataset names
+    h5_fn : str - output HDF5 file
+    chunks : tuple (default get_default_chunks)
+    compression : str (default gzip)
+    compression_opts : int - compression level (default 4)
+
+    Returns
+    ----------
+    h5_fn : str
+    """
+    for channelname in channel_names:
+        print('converting ' + channelname)
+        vol = TiffVolume(os.path.join(input_location, channelname))
+        write_h5_volume(h5_fn, channelname, vol, chunks, compression, compression_opts)
+        vol.close()
+
+    return h5_fn
+
+
+def imreadh5(h5_fn, name, dtype=np.float64):
+    """
+    Load a volume from an HDF5 store
+
+    Parameters
+    ----------
+    h5_fn : str - HDF5 file
+    name : str - dataset name
+    dtype : numpy dtype of the output (default float64)
+
+    Returns
+    ----------
+    output : numpy 3D array
+    """
+    check_h5py()
+    with h5py.File(h5_fn, 'r') as f:
+        dset = f[name]
+        output = np.empty(dset.shape, dtype=dtype)
+        dset.read_direct(output)
+
+    return output
+
+
+def open_volume(filepath, channelname):
+    """
+    Lazily opened volume of a channel, either a TiffVolume or a dataset of
+    an HDF5 store. Both support numpy slicing by (y, x, z) and only read
+    what is indexed. Recently opened volumes are reused.
+
+    Parameters
+    ----------
+    filepath : str - data folder or HDF5 file
+    channelname : str
+
+    Returns
+    ----------
+    vol : TiffVolume or h5py.Dataset
+    """
+    if not is_h5_file(filepath):
+        return get_tiff_volume(os.path.join(filepath, channelname))
+
+    check_h5py()
+    key = (os.path.abspath(filepath), channelname)
+    if key in _open_volumes:
+        _open_volumes.move_to_end(key)
+        return _open_volumes[key]
+
+    vol = h5py.File(filepath, 'r')[channelname]
+    _open_volumes[key] = vol
+    if len(_open_volumes) > 8:
+        closeVolume(_open_volumes.popitem(last=False)[1])
+
+    return vol
+
+
+def closeVolume(vol):
+    if isinstance(vol, TiffVolume):
+        vol.close()
+    else:
+        vol.file.close()
+
+
+def get_stored_bytes(base_dir, channelname):
+    """
+    Size on disk of a channel: the tiff file, the sum of a folder of tiffs
+    or the (compressed) dataset of an HDF5 store
+    """
+    if is_h5_file(base_dir):
+        check_h5py()
+        with h5py.File(base_dir, 'r') as f:
+            return f[channelname].id.get_storage_size()
+
+    fn = channelname if base_dir is None else os.path.join(base_dir, channelname)
+    if os.path.isdir(fn):
+        return sum(os.path.getsize(os.path.join(fn, name)) for name in os.listdir(fn))
+    return os.path.getsize(fn)
+
+
+def read_channel(base_dir, channelname, dtype=np.float64, tiff_reader=imreadtiff,
+                 verbose=True):
+    """
+    Load a channel from a data folder or an HDF5 store and print the number
+    of bytes read and the time it took
+
+    Parameters
+    ----------
+    base_dir : str - location of the data, None if channelname is a full path
+    channelname : str
+    dtype : numpy dtype of the output (default float64)
+    tiff_reader : function - imreadtiff or imreadtiffseries (default imreadtiff)
+    verbose : bool - print the report (default True)
+
+    Returns
+    ----------
+    output : numpy 3D array
+    """
+    start = time.time()
+    if base_dir is None:
+        output = tiff_reader(channelname, dtype)
+    elif is_h5_file(base_dir):
+        output = imreadh5(base_dir, channelname, dtype)
+    else:
+        output = tiff_reader(os.path.join(base_dir, channelname), dtype)
+
+    if verbose:
+        report_read(channelname, get_stored_bytes(base_dir, channelname), time.time() - start)
+
+    return output
+
+
+def report_read(channelname, nbytes, seconds):
+    print('%s: %.1f MB in %.2f s' % (channelname, nbytes / 1024**2, seconds))
+
+
+def load_channels(base_dir, channels, dtype=np.float64, tiff_reader=imreadtiff,
+                  num_threads=None):
+    """
+    Load lists of channels on a thread pool, keeping their layout
+
+    Parameters
+    ----------
+    base_dir : str - location of the data
+    channels : dict - lists of channel names, e.g. {'presynaptic': query['preIF'], ...}
+    dtype : numpy dtype of the output (default float64)
+    tiff_reader : function - see read_channel (default imreadtiff)
+    num_threads : int - number of channels read at the same time (default LOAD_THREADS)
+
+    Returns
+    ----------
+    volumes : dict - same keys as channels, lists of 3D numpy arrays
+    """
+    if num_threads is None:
+        num_threads = LOAD_THREADS
+
+    tasks = [(key, channelname) for key in channels for channelname in channels[key]]
+
+    def read(task):
+        start = time.time()
+        volume = read_channel(base_dir, task[1], dtype, tiff_reader, verbose=False)
+        return volume, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        outputs = list(executor.map(read, tasks))
+
+    # Report once every read is done so the lines are not interleaved
+    volumes = {key: [] for key in channels}
+    for (key, channelname), (volume, seconds) in zip(tasks, outputs):
+        report_read(channelname, get_stored_bytes(base_dir, channelname), seconds)
+        volumes[key].append(volume)
+
+    return volumes
+
+
 def imreadtiffSingleSlice(folderpath, sliceInd):
     """
     Load a single tiff image in a folder of tiff images
@@ -81,125 +510,66 @@ def imreadtiffSingleSlice(folderpath, sliceInd):
 
     return output
 
-def load_tiff_from_astro_query(query, base_dir=None):
+def load_tiff_from_astro_query(query, base_dir=None, num_threads=None):
     """
     Load tiff stacks associated with a query. 
 
     Parameters
     ----------
     query : dict
-        dict object containing filenames associated with pre/post synaptic markers
-    base_dir : str - location of the data 
+        dict object containing filenames associated with pre/post synaptic markers.
+        volumes are loaded as query['precision'] if given (default float64)
+    base_dir : str - location of the data, a folder or an HDF5 store
+    num_threads : int - number of channels read at the same time (default LOAD_THREADS)
 
     Returns
     ----------
     synaptic_volumes : dict
         dict with two (pre/post) lists of synaptic volumes
     """
-    #Glial volumes 
-    glialvolumes = [] 
-    glialIF = query['glialIF']
-    # Loop over every presynaptic channel
-    for n in range(0, len(glialIF)):
-        print(glialIF[n])
-        if base_dir == None: 
-            volume = imreadtiff(glialIF[n])
-        else: 
-            fn = os.path.join(base_dir, glialIF[n])
-            volume = imreadtiff(fn)
-        glialvolumes.append(volume)
-
-    #presynaptic volumes
-    presynapticvolumes = []
-    preIF = query['preIF']
-
-    # Loop over every presynaptic channel
-    for n in range(0, len(preIF)):
-        print(preIF[n])
-        if base_dir == None: 
-            volume = imreadtiff(preIF[n])
-        else: 
-            fn = os.path.join(base_dir, preIF[n])
-            volume = imreadtiff(fn)
-        presynapticvolumes.append(volume)
-
-    #postsynaptic volumes
-    postsynapticvolumes = []
-    postIF = query['postIF']
-
-    # Loop over every postsynaptic channel
-    for n in range(0, len(postIF)):
-        print(postIF[n])
-        if base_dir == None: 
-            volume = imreadtiff(postIF[n])
-        else: 
-            fn = os.path.join(base_dir, postIF[n])
-            volume = imreadtiff(fn)
-        postsynapticvolumes.append(volume)
-
-    synaptic_volumes = {'presynaptic': presynapticvolumes,
-                       'postsynaptic': postsynapticvolumes, 
-                       'glialvolumes': glialvolumes}
+    dtype = query.get('precision', 'float64')
+
+    channels = {'presynaptic': query['preIF'],
+                'postsynaptic': query['postIF'],
+                'glialvolumes': query['glialIF']}
+    synaptic_volumes = load_channels(base_dir, channels, dtype, num_threads=num_threads)
 
     return synaptic_volumes
 
 
-def load_tiff_from_query(query, base_dir=None):
+def load_tiff_from_query(query, base_dir=None, num_threads=None):
     """
     Load tiff stacks associated with a query. 
 
     Parameters
     ----------
     query : dict
-        dict object containing filenames associated with pre/post synaptic markers
-    base_dir : str - location of the data 
+        dict object containing filenames associated with pre/post synaptic markers.
+        volumes are loaded as query['precision'] if given (default float64)
+    base_dir : str - location of the data, a folder or an HDF5 store
+    num_threads : int - number of channels read at the same time (default LOAD_THREADS)
 
     Returns
     ----------
     synaptic_volumes : dict
         dict with two (pre/post) lists of synaptic volumes
     """
+    dtype = query.get('precision', 'float64')
 
-    #presynaptic volumes
-    presynapticvolumes = []
-    preIF = query['preIF']
-
-    # Loop over every presynaptic channel
-    for n in range(0, len(preIF)):
-        print(preIF[n])
-        if base_dir == None: 
-            volume = imreadtiff(preIF[n])
-        else: 
-            fn = os.path.join(base_dir, preIF[n])
-            volume = imreadtiff(fn)
-        presynapticvolumes.append(volume)
-
-    #postsynaptic volumes
-    postsynapticvolumes = []
-    postIF = query['postIF']
-
-    # Loop over every postsynaptic channel
-    for n in range(0, len(postIF)):
-        print(postIF[n])
-        if base_dir == None: 
-            volume = imreadtiff(postIF[n])
-        else: 
-            fn = os.path.join(base_dir, postIF[n])
-            volume = imreadtiff(fn)
-        postsynapticvolumes.append(volume)
-
-    synaptic_volumes = {'presynaptic': presynapticvolumes,
-                       'postsynaptic': postsynapticvolumes}
+    channels = {'presynaptic': query['preIF'],
+                'postsynaptic': query['postIF']}
+    synaptic_volumes = load_channels(base_dir, channels, dtype, num_threads=num_threads)
 
     return synaptic_volumes
 
-def loadTiffSeriesFromQuery(query, filepath):
+def loadTiffSeriesFromQuery(query, filepath, num_threads=None):
     """
     Load tiff stacks associated with a query
     Parameters
     ----------
     query : dict - object containing filenames associated with pre/post synaptic markers
-    filepath : str - location of data
+    filepath : str - location of data, a folder or an HDF5 store
+    num_threads : int - number of slices read at the same time (default LOAD_THREADS)
 
     Returns
     ----------
@@ -208,32 +578,16 @@ def loadTiffSeriesFromQuery(query, filepath):
     """
 
     # query = {'preIF' : preIF, 'preIF_z' : preIF_z, 'postIF' : postIF, 'postIF_z' : postIF_z};
+    dtype = query.get('precision', 'float64')
 
-    #presynaptic volumes
-    presynapticvolumes = []
-    preIF = query['preIF']
-
-    # Loop over every presynaptic channel
-    for n in range(0, len(preIF)):
-
-        #print(preIF[n])
-        fn = os.path.join(filepath, preIF[n])
-        volume = imreadtiffseries(fn)
-        presynapticvolumes.append(volume)
-
-    #postsynaptic volumes
-    postsynapticvolumes = []
-    postIF = query['postIF']
-
-    # Loop over every postsynaptic channel
-    for n in range(0, len(postIF)):
-        #print(postIF[n])
-        fn = os.path.join(filepath, postIF[n])
-        volume = imreadtiffseries(fn)
-        postsynapticvolumes.append(volume)
+    # Channels are read one after the other, the slices of each channel
+    # in parallel
+    def readseries(folderpath, dtype):
+        return imreadtiffseries(folderpath, dtype, num_threads)
 
-    synapticVolumes = {'presynaptic': presynapticvolumes,
-                       'postsynaptic': postsynapticvolumes}
+    channels = {'presynaptic': query['preIF'],
+                'postsynaptic': query['postIF']}
+    synapticVolumes = load_channels(filepath, channels, dtype, readseries, num_threads=1)
 
     return synapticVolumes
 
@@ -258,9 +612,8 @@ def getImageCutoutFromFile(channelname, sliceInd, startX, startY, deltaX, deltaY
     cutout: 2D numpy array
     """
 
-    folderpath = os.path.join(filepath, channelname)
-    img = imreadtiffSingleSlice(folderpath, sliceInd)
-    cutout = img[startY:(startY + deltaY), startX:(startX+deltaX)]
+    vol = open_volume(filepath, channelname)
+    cutout = vol[startY:(startY + deltaY), startX:(startX+deltaX), sliceInd]
 
     return cutout
 
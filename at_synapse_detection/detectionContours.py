@@ -0,0 +1,222 @@
+"""
+Contours of the detections of a label volume, in the annotation format
+(AreaList dicts, see AnnotationJsonSchema).
+
+The contours used to be traced one detection and one z section at a
+time: the detection drawn into its own image, upsampled 2x with cv2.resize
+and traced with cv2.findContours. Here every z section is upsampled once for
+all its labels, the upsampled mask of each label is packed into one canvas
+with a blank pixel between the labels, and the canvas is traced with a
+single findContours call. The contours are the same as with one image per
+label.
+
+iter_label_volume_contours yields the detections CONTOUR_CHUNK_LABELS
+labels at a time, from the bounding box of each chunk, so they can be
+written out without holding the contours of the whole volume.
+"""
+import os
+import numpy as np
+import cv2
+from scipy import ndimage
+
+# Number of labels whose contours are extracted together
+CONTOUR_CHUNK_LABELS = int(os.environ.get('SYNAPSE_CONTOUR_CHUNK_LABELS', 1000))
+
+
+def upsample_labels(label_slice):
+    """
+    2x upsampled label image. A pixel has a label if one of the four
+    diagonal neighbours of its nearest neighbour upsampling has it, which is
+    where the bilinear cv2.resize of the mask of that label is not 0. The
+    labels of measure.label never touch, so no pixel gets two labels
+
+    Parameters
+    ----------
+    label_slice : 2D numpy int array
+
+    Returns
+    ----------
+    up : 2D numpy int array - twice the size of label_slice
+    """
+    rows, cols = label_slice.shape
+    nearest = np.repeat(np.repeat(label_slice, 2, axis=0), 2, axis=1)
+    padded = np.pad(nearest, 1)
+    up = np.zeros_like(nearest)
+    for drow in (0, 2):
+        for dcol in (0, 2):
+            np.maximum(up, padded[drow:drow + 2 * rows, dcol:dcol + 2 * cols], out=up)
+    return up
+
+
+def pack_cells(heights, widths):
+    """
+    Place rectangles on shelves of a canvas, tallest first, with one blank
+    pixel around each rectangle
+
+    Parameters
+    ----------
+    heights, widths : 1D int arrays
+
+    Returns
+    ----------
+    rows, cols : 1D int arrays - top left corner of each rectangle
+    shape : tuple - (height, width) of the canvas
+    """
+    shelf_width = max(int(widths.max()) + 2,
+                      2 * int(np.sqrt(np.sum((heights + 1) * (widths + 1)))))
+    rows = np.zeros(len(heights), dtype=np.int64)
+    cols = np.zeros(len(heights), dtype=np.int64)
+
+    row = 1
+    col = 1
+    shelf_height = 0
+    for ind in np.argsort(-heights, kind='stable'):
+        if col + widths[ind] + 1 > shelf_width:
+            row += shelf_height + 1
+            col = 1
+            shelf_height = 0
+        rows[ind] = row
+        cols[ind] = col
+        col += widths[ind] + 1
+        shelf_height = max(shelf_height, heights[ind])
+
+    return rows, cols, (row + shelf_height + 1, shelf_width)
+
+
+def slice_contours(label_slice, ds_scale, lm_minX=0, lm_minY=0, row_offset=0, col_offset=0):
+    """
+    Contours of every label of a z section
+
+    Parameters
+    ----------
+    label_slice : 2D numpy int array - [y, x]
+    ds_scale : float - downsampling scale
+    lm_minX, lm_minY : float - added to the scaled x, y coordinates
+    row_offset, col_offset : int - position of label_slice in the volume
+
+    Returns
+    ----------
+    labels : list of ints - label of each contour
+    paths : list of (N, 2) float arrays - closed global paths, x, y
+    """
+    objects = ndimage.find_objects(label_slice)
+    labels = np.array([label for label, obj in enumerate(objects, 1) if obj is not None])
+    if len(labels) == 0:
+        return [], []
+
+    bboxes = np.array([[obj[0].start, obj[0].stop, obj[1].start, obj[1].stop]
+                       for obj in objects if obj is not None])
+    heights = 2 * (bboxes[:, 1] - bboxes[:, 0])
+    widths = 2 * (bboxes[:, 3] - bboxes[:, 2])
+    cell_rows, cell_cols, shape = pack_cells(heights, widths)
+
+    up = upsample_labels(label_slice)
+    canvas = np.zeros(shape, dtype=label_slice.dtype)
+    for ind, label in enumerate(labels):
+        cell = canvas[cell_rows[ind]:cell_rows[ind] + heights[ind],
+                      cell_cols[ind]:cell_cols[ind] + widths[ind]]
+        cell[up[2 * bboxes[ind, 0]:2 * bboxes[ind, 1],
+                2 * bboxes[ind, 2]:2 * bboxes[ind, 3]] == label] = label
+
+    contours = cv2.findContours((canvas > 0).astype(np.uint8),
+                                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if len(contours) == 0:
+        return [], []
+    contours = [contour.reshape(-1, 2) for contour in contours]
+
+    # owner of each contour, from its first point
+    starts = np.array([contour[0] for contour in contours])
+    contour_labels = canvas[starts[:, 1], starts[:, 0]]
+    cell_inds = np.searchsorted(labels, contour_labels)
+
+    # close the paths and map all the points back at once
+    lengths = np.array([len(contour) for contour in contours])
+    ends = np.cumsum(lengths + 1)
+    point_inds = np.arange(ends[-1]) - np.repeat(np.arange(len(contours)), lengths + 1)
+    point_inds[ends - 1] = ends - 1 - lengths - np.arange(len(contours))
+    owner = np.repeat(cell_inds, lengths + 1)
+
+    points = np.concatenate(contours)[point_inds]
+    points = points - np.stack([cell_cols[owner], cell_rows[owner]], axis=1)
+    c = .5 * (np.array(points, np.float64) + .5)
+    c[:, 0] += bboxes[owner, 2] + col_offset
+    c[:, 1] += bboxes[owner, 0] + row_offset
+    c = c / ds_scale
+    c[:, 0] = c[:, 0] + lm_minX
+    c[:, 1] = c[:, 1] + lm_minY
+
+    paths = np.split(c, ends[:-1])
+    return contour_labels.tolist(), paths
+
+
+def label_volume_to_contours(label_vol, ds_scale=3 / 100, lm_minX=0, lm_minY=0,
+                             offset=(0, 0, 0), as_lists=True):
+    """
+    Contours of every label of a label volume, the same as
+    processDetections.make_prop_into_contours on each of its regionprops
+
+    Parameters
+    ----------
+    label_vol : 3D numpy int array - [y, x, z], 0 is the background
+    ds_scale : float - downsampling scale (default 3/100)
+    lm_minX, lm_minY : float (default 0)
+    offset : tuple - (row, col, z) position of label_vol (default (0, 0, 0))
+    as_lists : bool - global_path as lists, False keeps the (N, 2) numpy
+        arrays, which annotationJson writes without converting (default True)
+
+    Returns
+    ----------
+    area_lists : list of dicts - AreaList dicts sorted by label
+    """
+    areas = {}
+    zs = np.nonzero(np.any(label_vol != 0, axis=(0, 1)))[0]
+    for z in zs:
+        labels, paths = slice_contours(label_vol[:, :, z], ds_scale, lm_minX, lm_minY,
+                                       offset[0], offset[1])
+        for label, path in zip(labels, paths):
+            areas.setdefault(label, []).append(
+                {'z': int(z + offset[2]), 'global_path': path.tolist() if as_lists else path})
+
+    return [{'areas': areas[label], 'oid': str(label), 'id': int(label)}
+            for label in sorted(areas)]
+
+
+def iter_label_volume_contours(label_vol, ds_scale=3 / 100, lm_minX=0, lm_minY=0,
+                               labels_per_chunk=None, as_lists=True):
+    """
+    Contours of every label of a label volume, a chunk of labels at a time.
+    Yields the same AreaList dicts as label_volume_to_contours, in the same
+    order
+
+    Parameters
+    ----------
+    label_vol : 3D numpy int array - [y, x, z], 0 is the background
+    ds_scale : float - downsampling scale (default 3/100)
+    lm_minX, lm_minY : float (default 0)
+    labels_per_chunk : int (default CONTOUR_CHUNK_LABELS)
+    as_lists : bool - see label_volume_to_contours (default True)
+
+    Yields
+    ----------
+    area_list : dict
+    """
+    if labels_per_chunk is None:
+        labels_per_chunk = CONTOUR_CHUNK_LABELS
+
+    objects = ndimage.find_objects(label_vol)
+    labels = [label for label, obj in enumerate(objects, 1) if obj is not None]
+    for start in range(0, len(labels), labels_per_chunk):
+        chunk = labels[start:start + labels_per_chunk]
+
+        # the labels of measure.label follow the rows of the volume, so a
+        # chunk of consecutive labels covers a band of it
+        bbox = tuple(slice(min(objects[label - 1][axis].start for label in chunk),
+                           max(objects[label - 1][axis].stop for label in chunk))
+                     for axis in range(0, 3))
+        sub_vol = label_vol[bbox]
+        sub_vol = np.where((sub_vol >= chunk[0]) & (sub_vol <= chunk[-1]), sub_vol, 0)
+
+        offset = tuple(axis_slice.start for axis_slice in bbox)
+        for area_list in label_volume_to_contours(sub_vol, ds_scale, lm_minX, lm_minY,
+                                                  offset, as_lists):
+            yield area_list
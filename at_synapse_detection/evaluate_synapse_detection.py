@@ -3,8 +3,10 @@ from functools import partial
 from argschema import ArgSchema, ArgSchemaParser
 import argschema
 import marshmallow as mm
-from at_synapse_detection.AnnotationJsonSchema import AnnotationFile, NumpyArray
-import json
+from at_synapse_detection import annotationOverlap
+from at_synapse_detection import annotationBounds
+from at_synapse_detection import annotationTable
+from at_synapse_detection import annotationJson
 import pandas as pd
 from rtree import index
 from shapely import geometry
@@ -60,27 +62,23 @@ class EvaluateSynapseDetectionOutput(mm.Schema):
     correct_LM = argschema.fields.List(argschema.fields.Str, required=True,
         description= "list of LM synapses oids for which there were more exactly one EM synapses")
 
-def load_annotation_file(annotation_path):
+def load_annotation_file(annotation_path, validate=None):
     """function to read an annotation file from disk
 
     Parameters
     ----------
     annotation_path: str
         path to annotation file on disk
+    validate: str
+        validation level, 'none', 'basic' or 'schema' for the AnnotationFile
+        schema (default annotationJson.VALIDATION)
     
     Returns
     -------
-    list[dict]:
-        A list of dictionaries following the AnnotationFile schema that contains the annotations
+    AnnotationTable:
+        The annotations, iterating over it gives dictionaries following the AreaList schema
     """
-    with open(annotation_path,'r') as fp:
-            annotation_d = json.load(fp)
-    schema = AnnotationFile()
-    annotations,errors = schema.load(annotation_d)      
-    if len(errors)>0:
-        print(errors)
-    assert(len(errors)==0)
-    return annotations["area_lists"]
+    return annotationJson.read_annotation_file(annotation_path, validate)
 
 def get_bounding_box_of_al(al):
     """a function to return a bounding box of an annotation
@@ -118,7 +116,7 @@ def get_annotation_bounds_df(annotations):
 
     Parameters
     ----------
-    annotations: list[dict]
+    annotations: list[dict] or AnnotationTable
         a list of annotation dictionaries that follow to the AreaList schema
     
     Returns
@@ -126,19 +124,9 @@ def get_annotation_bounds_df(annotations):
     pandas.DataFrame:
         A data frame containing the following columns 'oid','minX','minY','minZ','maxX','maxY','maxZ'
     """ 
-    ds=[]
-    for al in annotations:
-        (minX,minY,minZ,maxX,maxY,maxZ)=get_bounding_box_of_al(al)
-        ds.append({
-            'oid':al['oid'],
-            'minX':minX,
-            'minY':minY,
-            'minZ':minZ,
-            'maxX':maxX,
-            'maxY':maxY,
-            'maxZ':maxZ
-        })
-    df = pd.DataFrame(ds)
+    table = annotationTable.AnnotationTable.from_area_lists(annotations)
+    df = annotationBounds.get_annotation_bounds(table.area_bounds(),len(table))
+    df.insert(0,'oid',table.oids)
     return df
 
 def get_bounding_box_of_annotations(annotations):
@@ -254,18 +242,16 @@ def get_edge_annotations(annotations,ann_minX,ann_maxX,ann_minY,ann_maxY,ann_min
     list[bool]:
         list of True/False if annotations are near edge
     """
-    is_edge = np.zeros(len(annotations),np.bool)
-    for k,al in enumerate(annotations):
-        is_edge[k]=is_annotation_near_edge(al,
-                                        ann_minX,
-                                        ann_maxX,
-                                        ann_minY,
-                                        ann_maxY,
-                                        ann_minZ,
-                                        ann_maxZ,
-                                        distance=distance,
-                                        min_edge_sections=min_edge_sections)
-    return is_edge
+    # classified from the bounds of all the areas at once, see annotationBounds
+    return annotationBounds.get_edge_annotations(annotations,
+                                                 ann_minX,
+                                                 ann_maxX,
+                                                 ann_minY,
+                                                 ann_maxY,
+                                                 ann_minZ,
+                                                 ann_maxZ,
+                                                 distance=distance,
+                                                 min_edge_sections=min_edge_sections)
 
 
 def get_index(name='LM_index'):
@@ -350,8 +336,10 @@ class EvaluateSynapseDetection(ArgSchemaParser):
 
     def run(self):
         #print(json.dumps(self.args,indent=4))
-        EM_annotations = load_annotation_file(self.args['EM_annotation_json'])
-        LM_annotations = load_annotation_file(self.args['LM_annotation_json'])
+        EM_annotations = annotationTable.AnnotationTable.from_area_lists(
+            load_annotation_file(self.args['EM_annotation_json']))
+        LM_annotations = annotationTable.AnnotationTable.from_area_lists(
+            load_annotation_file(self.args['LM_annotation_json']))
         
         df = pd.read_csv(self.args['EM_metadata_csv'])
 
@@ -364,7 +352,7 @@ class EvaluateSynapseDetection(ArgSchemaParser):
         ann_maxY=good_df.max().maxY
         ann_minZ=good_df.min().minZ
         ann_maxZ=good_df.max().maxZ
-        good_annotations = [al for al in EM_annotations if al['id'] in good_df.index]
+        good_annotations = EM_annotations.select(np.isin(EM_annotations.ids,good_df.index.values))
 
         (ann_minX,ann_minY,ann_minZ,ann_maxX,ann_maxY,ann_maxZ) = get_bounding_box_of_annotations(good_annotations)
 
@@ -379,20 +367,7 @@ class EvaluateSynapseDetection(ArgSchemaParser):
 
 
 
-        LM_index=get_index('LM_index')
-        LM_bounds=insert_annotations_into_index(LM_index,LM_annotations)
-        EM_index = get_index('EM_index')
-        EM_bounds=insert_annotations_into_index(EM_index,good_annotations)
-
-        overlap_matrix = np.zeros((len(good_annotations),len(LM_annotations)),np.bool)
-        j=0
-        for i,alLM in enumerate(LM_annotations):
-            res=EM_index.intersection(LM_bounds[i])
-            for k in res:
-                alEM=good_annotations[k]
-                overlaps,zsection = do_annotations_overlap(alLM,alEM)
-                if overlaps:
-                    overlap_matrix[k,i]=True
+        overlap_matrix = annotationOverlap.compute_overlap_matrix(good_annotations,LM_annotations)
         bins = np.arange(0,4)
         LM_per_EM = np.sum(overlap_matrix,axis=1)
         EM_per_LM = np.sum(overlap_matrix,axis=0)
@@ -406,12 +381,14 @@ class EvaluateSynapseDetection(ArgSchemaParser):
         d= {}
         d['EM_per_LM']=EM_per_LM_counts
         d['LM_per_EM']=LM_per_EM_counts
-        d['missed_EM']= [al['oid'] for k,al in enumerate(good_annotations) if (EM_edge[k]==False) and (LM_per_EM[k]==0)]
-        d['split_EM']= [al['oid'] for k,al in enumerate(good_annotations) if (EM_edge[k]==False) and (LM_per_EM[k]>1)]
-        d['correct_EM']= [al['oid'] for k,al in enumerate(good_annotations) if (EM_edge[k]==False) and (LM_per_EM[k]==1)]
-        d['false_pos_LM']= [al['oid'] for k,al in enumerate(LM_annotations) if (LM_edge[k]==False) and (EM_per_LM[k]==0)]
-        d['merge_LM']= [al['oid'] for k,al in enumerate(LM_annotations) if (LM_edge[k]==False) and (EM_per_LM[k]>1)]
-        d['correct_LM']= [al['oid'] for k,al in enumerate(LM_annotations) if (LM_edge[k]==False) and (EM_per_LM[k]==1)]
+        EM_oids = good_annotations.oids[EM_edge==False]
+        LM_oids = LM_annotations.oids[LM_edge==False]
+        d['missed_EM']= EM_oids[LM_per_EM[EM_edge==False]==0].tolist()
+        d['split_EM']= EM_oids[LM_per_EM[EM_edge==False]>1].tolist()
+        d['correct_EM']= EM_oids[LM_per_EM[EM_edge==False]==1].tolist()
+        d['false_pos_LM']= LM_oids[EM_per_LM[LM_edge==False]==0].tolist()
+        d['merge_LM']= LM_oids[EM_per_LM[LM_edge==False]>1].tolist()
+        d['correct_LM']= LM_oids[EM_per_LM[LM_edge==False]==1].tolist()
         self.output(d)
         outputdict = {'EM_per_LM': EM_per_LM_counts, 'LM_per_EM': LM_per_EM_counts, 'lm_edge_detections': np.sum(LM_edge), 
                         'em_edge_annotations': np.sum(EM_edge), 'LM_detections': len(LM_edge), 'EM_detections': len(EM_edge) }
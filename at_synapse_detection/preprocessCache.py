@@ -0,0 +1,243 @@
+"""
+Cache of preprocessed channel volumes (steps 1-3 of synapse detection).
+Many queries share channels, e.g. PSD95 is part of every Site3 query, so
+the probability map / convolution / slice factor of a channel only needs
+to be computed once per punctum size and slice span.
+
+Entries are keyed by the channel's source (file path, modification time
+and size, plus any mask applied before detection) and the processing
+parameters. Volumes are kept in memory with least recently used eviction
+and can also be written to a folder of .npy files, which is shared by
+every process pointed at the same folder.
+
+The cache is off unless it is asked for, since every worker of a pool
+would hold its own in memory copies: SYNAPSE_CACHE_GB sets the memory
+budget (default 0) and SYNAPSE_CACHE_DIR the folder of the .npy store. With
+only the folder set, the budget defaults to DEFAULT_CACHE_GB.
+"""
+import os
+import hashlib
+import collections
+import numpy as np
+from at_synapse_detection import dataAccess
+
+# in memory budget when only SYNAPSE_CACHE_DIR is set
+DEFAULT_CACHE_GB = 2.0
+
+
+def file_signature(fn):
+    """
+    Identify the current contents of a file or folder of images without
+    reading it
+
+    Parameters
+    ----------
+    fn : str - file or folder path
+
+    Returns
+    ----------
+    signature : tuple - (absolute path, mtime in ns, size in bytes)
+    """
+    fn = os.path.abspath(fn)
+    if os.path.isdir(fn):
+        entries = [os.stat(os.path.join(fn, name)) for name in sorted(os.listdir(fn))]
+        mtime = max([entry.st_mtime_ns for entry in entries] + [os.stat(fn).st_mtime_ns])
+        size = sum(entry.st_size for entry in entries)
+    else:
+        info = os.stat(fn)
+        mtime = info.st_mtime_ns
+        size = info.st_size
+
+    return (fn, mtime, size)
+
+
+def get_source_ids(query, base_dir=None, mask_files=None):
+    """
+    Source ids of the channels of a query, in the same layout as the output
+    of dataAccess.load_tiff_from_query
+
+    Parameters
+    ----------
+    query : dict
+    base_dir : str - location of the data, a folder or an HDF5 store
+        (default None)
+    mask_files : list of strs - masks applied to the volumes before
+        detection (default None)
+
+    Returns
+    ----------
+    source_ids : dict - two (pre/post) lists of tuples
+    """
+    mask_ids = tuple(file_signature(fn) for fn in (mask_files or []))
+
+    source_ids = {}
+    for key, name_key in [('presynaptic', 'preIF'), ('postsynaptic', 'postIF')]:
+        source_ids[key] = []
+        for fn in query[name_key]:
+            if dataAccess.is_h5_file(base_dir):
+                # the channel is a dataset of the store
+                source_id = file_signature(base_dir) + (fn,)
+            else:
+                if base_dir is not None:
+                    fn = os.path.join(base_dir, fn)
+                source_id = file_signature(fn)
+            source_ids[key].append((source_id,) + mask_ids)
+
+    return source_ids
+
+
+def make_key(source_id, blobsize, IF_z, model='normal', precision='float64'):
+    """
+    Cache key of a preprocessed channel
+
+    Parameters
+    ----------
+    source_id : tuple - see get_source_ids
+    blobsize : int - punctum size
+    IF_z : int - number of slices each blob should span
+    model : str - probability map model, 'normal' or 'rayleigh'
+    precision : str or numpy dtype
+
+    Returns
+    ----------
+    key : str
+    """
+    description = repr((source_id, int(blobsize), int(IF_z), model,
+                        np.dtype(precision).name))
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+class PreprocessCache:
+    """
+    Least recently used cache of preprocessed volumes
+    """
+
+    def __init__(self, max_memory_gb=2.0, spill_dir=None):
+        """
+        Parameters
+        ----------
+        max_memory_gb : float - memory budget of the in memory entries, in
+            GB (10**9 bytes)
+        spill_dir : str - folder for the .npy store, None keeps the cache in
+            memory only (default None)
+        """
+        self.max_bytes = int(max_memory_gb * 10**9)
+        self.spill_dir = spill_dir
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if spill_dir is not None and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def get_spill_fn(self, key):
+        return os.path.join(self.spill_dir, key + '.npy')
+
+    def get(self, key):
+        """
+        Look up a volume. A copy is returned since the detection pipeline
+        modifies its inputs
+
+        Parameters
+        ----------
+        key : str - see make_key
+
+        Returns
+        ----------
+        vol : 3D numpy array or None
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return self.entries[key].copy()
+
+        if self.spill_dir is not None and os.path.isfile(self.get_spill_fn(key)):
+            vol = np.load(self.get_spill_fn(key))
+            self.add_entry(key, vol)
+            self.hits = self.hits + 1
+            return vol.copy()
+
+        self.misses = self.misses + 1
+        return None
+
+    def put(self, key, vol):
+        """
+        Store a copy of a volume, and write it to the .npy store
+
+        Parameters
+        ----------
+        key : str - see make_key
+        vol : 3D numpy array
+        """
+        vol = np.array(vol)
+        if self.spill_dir is not None:
+            # Write to a temporary file first so other processes never
+            # load a partial volume
+            tmp_fn = self.get_spill_fn(key) + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp_fn, 'wb') as f:
+                np.save(f, vol)
+            os.replace(tmp_fn, self.get_spill_fn(key))
+
+        self.add_entry(key, vol)
+
+    def add_entry(self, key, vol):
+        if key in self.entries:
+            self.num_bytes = self.num_bytes - self.entries.pop(key).nbytes
+
+        if vol.nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = vol
+        self.num_bytes = self.num_bytes + vol.nbytes
+
+        # Evict the least recently used volumes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes = self.num_bytes - evicted.nbytes
+
+    def clear(self):
+        """
+        Drop the in memory entries, the .npy store is left in place
+        """
+        self.entries.clear()
+        self.num_bytes = 0
+
+
+def cache_from_environment():
+    """
+    Cache set by SYNAPSE_CACHE_GB and SYNAPSE_CACHE_DIR
+
+    Returns
+    ----------
+    cache : PreprocessCache or None - None if neither is set
+    """
+    spill_dir = os.environ.get('SYNAPSE_CACHE_DIR')
+    default_gb = DEFAULT_CACHE_GB if spill_dir is not None else 0
+    max_memory_gb = float(os.environ.get('SYNAPSE_CACHE_GB', default_gb))
+    if max_memory_gb <= 0 and spill_dir is None:
+        return None
+
+    return PreprocessCache(max_memory_gb=max_memory_gb, spill_dir=spill_dir)
+
+
+_default_cache = cache_from_environment()
+
+
+def get_default_cache():
+    """
+    Cache used by the detection pipeline, None if caching is disabled
+    """
+    return _default_cache
+
+
+def set_default_cache(cache):
+    """
+    Replace the cache used by the detection pipeline
+
+    Parameters
+    ----------
+    cache : PreprocessCache or None - None disables caching
+    """
+    global _default_cache
+    _default_cache = cache
@@ -8,10 +8,12 @@ from at_synapse_detection import SynapseDetection as syn
 from scipy import io
 from shapely import geometry
 import os
-import cv2
 import scipy.ndimage as ndimage
 from at_synapse_detection import evaluate_synapse_detection as esd
-from at_synapse_detection.AnnotationJsonSchema import AnnotationFile, NumpyArray
+from at_synapse_detection import annotationOverlap
+from at_synapse_detection import annotationTable
+from at_synapse_detection import annotationJson
+from at_synapse_detection import detectionContours
 import pandas
 
 
@@ -94,38 +96,6 @@ def createSynapseObject(detection, detection_number, resolution):
     return synapse
 
 
-def detectionsToJSONFormat(listofdetections, resolution):
-    """
-    Take a list of detections and output into a json saveable format
-
-    Parameters:
-    --------------
-    listOfDetections : list - stats object from skiimage.measure.label
-    resolution : dict - dict containing resolution parameters
-
-    Returns:
-    ---------------
-    data : dict - json saveable dict object
-
-    """
-    area_lists = []
-    lm_minX = 0
-    lm_minY = 0
-    ds_scale = 3 / 100
-
-    for n in range(0, len(listofdetections)):
-        detection = listofdetections[n]
-        #synapse = createSynapseObject(detection, n, resolution)
-        synapse = make_prop_into_contours(
-            detection, ds_scale, lm_minX, lm_minY)
-
-        area_lists.append(synapse)
-
-    data = {'area_lists': area_lists}
-
-    return data
-
-
 def writeJSONDetectionFile(filename, output_json):
     """
     Write json file to disk
@@ -148,11 +118,7 @@ def writeJSONDetectionFile2(filename, data):
     output_json : dict
     """
 
-    schema = AnnotationFile()
-    (output_json, errors) = schema.dump(data)
-
-    with open(filename, 'w') as outfile:
-        json.dump(output_json, outfile)
+    annotationJson.write_annotation_file(filename, data['area_lists'])
 
 
 def createPolygonFromBBox(bbox):
@@ -200,8 +166,6 @@ def probMapToJSON(probmapvolume, metadata, query, n):
     else:
         thresh = 0.9
 
-    resolution = metadata['resolution']
-
     jsonFN = metadata['outputJSONlocation']
     jsonFN = os.path.join(jsonFN, 'resultVol')
     jsonFN = jsonFN + str(n) + '.json'
@@ -210,10 +174,15 @@ def probMapToJSON(probmapvolume, metadata, query, n):
     SE = np.ones((2, 2, 2))
     dilated_volume = ndimage.binary_dilation(probmapvolume > thresh, SE)
     labelVol = measure.label(dilated_volume)
-    stats = measure.regionprops(labelVol, probmapvolume)
 
-    data = detectionsToJSONFormat(stats, resolution)
-    writeJSONDetectionFile(jsonFN, data)
+    # contours of a chunk of detections at a time, one findContours call per
+    # z section of the chunk, written as they are made
+    lm_minX = 0
+    lm_minY = 0
+    ds_scale = 3 / 100
+    with annotationJson.AnnotationWriter(jsonFN) as writer:
+        writer.write_all(detectionContours.iter_label_volume_contours(
+            labelVol, ds_scale, lm_minX, lm_minY, as_lists=False))
 
 
 def make_prop_into_contours(prop, ds_scale, lm_minX, lm_minY):
@@ -230,60 +199,11 @@ def make_prop_into_contours(prop, ds_scale, lm_minX, lm_minY):
     """
     #input prob is [y, x, z]
 
-    #the method below assumes prop.coords z, y, x
-
-    coors = []
-    for pt in prop.coords:
-        newpt = [pt[2], pt[0], pt[1]]
-        coors.append(newpt)
+    # the contours of the region's own mask, placed at its bounding box
+    area_lists = detectionContours.label_volume_to_contours(
+        prop.image.astype(np.uint8), ds_scale, lm_minX, lm_minY, offset=prop.bbox[:3])
+    areas = area_lists[0]['areas'] if len(area_lists) > 0 else []
 
-    coors = np.flip(np.copy(coors), 1)
-    zvalues = np.unique(coors[:, 2])
-    areas = []
-    for z in zvalues:
-
-        c2 = coors[coors[:, 2] == z]
-
-        mins = np.min(c2, axis=0)
-        maxs = np.max(c2, axis=0)
-        c2 = c2 - mins
-        rng = maxs - mins
-        width = rng[0] + 1
-        height = rng[1] + 1
-        min_img = np.zeros((height, width), np.uint8)
-        idx = np.ravel_multi_index((c2[:, 1], c2[:, 0]), (height, width))
-        min_img_unravel = np.ravel(min_img)
-        min_img_unravel[idx] = 255
-        min_img = np.reshape(min_img_unravel, (height, width))
-        min_img_up = cv2.resize(min_img, (2 * width, 2 * height))
-        #f, ax = plt.subplots()
-        #ax.imshow(min_img_up, interpolation='nearest',
-        # extent=[mins[0], maxs[0]+1, maxs[1]+1, mins[1]])
-        #ax.imshow(psdvol[z, :, :], interpolation='nearest', cmap=plt.cm.gray)
-        a, cs, b = cv2.findContours(
-            min_img_up, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        csf = []
-        for c in cs:
-
-            c = np.squeeze(c)
-            #c+=.5
-            c = .5 * (np.array(c, np.float64) + .5)
-            c[:, 0] += mins[0]
-            c[:, 1] += mins[1]
-            c = np.vstack((c, c[0, :]))
-            c = c / ds_scale
-            c[:, 0] = c[:, 0] + lm_minX
-            c[:, 1] = c[:, 1] + lm_minY
-            #ax.plot(c[:,0],c[:,1],linewidth=3)
-
-            c = np.array(c)
-            c = c.tolist()
-
-            z = np.array(z)
-            z = z.tolist()
-
-            d = {'z': z, 'global_path': c}
-            areas.append(d)
     d = {'areas': areas, 'oid': str(prop.label), 'id': int(prop.label)}
     return d
 
@@ -293,28 +213,7 @@ def consolidateDetections(detections1, detections2):
     #detections1 == EM
     #detections2 == LM
 
-    LM_index1 = esd.get_index('LM_index1')
-    LM_index2 = esd.get_index('LM_index2')
-
-    LM_bounds1 = esd.insert_annotations_into_index(LM_index1, detections1)
-    LM_bounds2 = esd.insert_annotations_into_index(LM_index2, detections2)
-
-    overlap_matrix = np.zeros((len(detections1), len(detections2)), np.bool)
-
-    for i, anno2 in enumerate(detections2):
-
-        # if i > 100:
-        #     break
-
-        res = LM_index1.intersection(LM_bounds2[i])
-        for k in res:
-            anno1 = detections1[k]
-            try:
-                overlaps, zsection = esd.do_annotations_overlap(anno2, anno1)
-            except:
-                print(anno1['oid'], anno2['oid'])
-            if overlaps:
-                overlap_matrix[k, i] = True
+    overlap_matrix = annotationOverlap.compute_overlap_matrix(detections1, detections2)
 
     #remove all annotations from LM2 which overlap with LM1
 
@@ -346,23 +245,25 @@ def getMissedAnnoIds(missed_annotations):
     return missedAnnoIds
 
 
-def evalsyndetections(args):
+def loadGroundTruth(args):
     """
-    Evaluate glutamatergic synapse detection
+    Load the EM annotations used by evalsyndetections, so that they are
+    only loaded and indexed once when several detection files are evaluated
 
     Parameters
     --------------
     args: dict of strs
-        - contains information needed for evaluation
-    Returns:
-    output: dict
-        - contains evaluation results
-    """
+        - EM_annotation_json, EM_metadata_csv, EM_not_synapse_column, EM_inclass_column
 
+    Returns
+    --------------
+    groundTruth: dict
+        - good_annotations (AnnotationTable), bounds, EM_edge and the geometries
+          of the annotations
+    """
     # Load EM Annotations
-    EM_annotations = esd.load_annotation_file(args['EM_annotation_json'])
-    # Load LM Annotations (detections)
-    LM_annotations = esd.load_annotation_file(args['LM_annotation_json'])
+    EM_annotations = annotationTable.AnnotationTable.from_area_lists(
+        esd.load_annotation_file(args['EM_annotation_json']))
 
     df = pandas.read_csv(args['EM_metadata_csv'])
     # Eliminate annotations which are not synapses or are not glutamatergic
@@ -377,36 +278,54 @@ def evalsyndetections(args):
     ann_maxY = good_df.max().maxY
     ann_minZ = good_df.min().minZ
     ann_maxZ = good_df.max().maxZ
-    good_annotations = [
-        al for al in EM_annotations if al['id'] in good_df.index]
+    good_annotations = EM_annotations.select(
+        np.isin(EM_annotations.ids, good_df.index.values))
 
-    (ann_minX, ann_minY, ann_minZ, ann_maxX, ann_maxY, ann_maxZ) = \
-        esd.get_bounding_box_of_annotations(good_annotations)
+    bounds = esd.get_bounding_box_of_annotations(good_annotations)
+    (ann_minX, ann_minY, ann_minZ, ann_maxX, ann_maxY, ann_maxZ) = bounds
 
-    # Determine LM Edge Annotations
-    LM_edge = esd.get_edge_annotations(
-        LM_annotations, ann_minX, ann_maxX, ann_minY, ann_maxY, ann_minZ, ann_maxZ)
     # Determine EM Edge Annotations
     EM_edge = esd.get_edge_annotations(
         good_annotations, ann_minX, ann_maxX, ann_minY, ann_maxY, ann_minZ, ann_maxZ)
 
-    # Place detections in a spatial index
-    LM_index = esd.get_index('LM_index')
-    LM_bounds = esd.insert_annotations_into_index(LM_index, LM_annotations)
-    EM_index = esd.get_index('EM_index')
-    EM_bounds = esd.insert_annotations_into_index(EM_index, good_annotations)
-
-    overlap_matrix = np.zeros(
-        (len(good_annotations), len(LM_annotations)), np.bool)
-    j = 0
-    for i, alLM in enumerate(LM_annotations):  # Loop over each LM detection
-        # check to see if LM detection overlaps with any EM anno
-        res = EM_index.intersection(LM_bounds[i])
-        for k in res:
-            alEM = good_annotations[k]
-            overlaps, zsection = esd.do_annotations_overlap(alLM, alEM)
-            if overlaps:
-                overlap_matrix[k, i] = True
+    groundTruth = {'good_annotations': good_annotations, 'bounds': bounds, 'EM_edge': EM_edge,
+                   'geometries': annotationOverlap.AnnotationGeometries(good_annotations)}
+
+    return groundTruth
+
+
+def evalsyndetections(args, groundTruth=None):
+    """
+    Evaluate glutamatergic synapse detection
+
+    Parameters
+    --------------
+    args: dict of strs
+        - contains information needed for evaluation
+    groundTruth: dict
+        - output of loadGroundTruth, loaded from args if not given (default None)
+    Returns:
+    output: dict
+        - contains evaluation results
+    """
+
+    if groundTruth is None:
+        groundTruth = loadGroundTruth(args)
+    good_annotations = groundTruth['good_annotations']
+    EM_edge = groundTruth['EM_edge']
+    (ann_minX, ann_minY, ann_minZ, ann_maxX, ann_maxY, ann_maxZ) = groundTruth['bounds']
+
+    # Load LM Annotations (detections)
+    LM_annotations = annotationTable.AnnotationTable.from_area_lists(
+        esd.load_annotation_file(args['LM_annotation_json']))
+
+    # Determine LM Edge Annotations
+    LM_edge = esd.get_edge_annotations(
+        LM_annotations, ann_minX, ann_maxX, ann_minY, ann_maxY, ann_minZ, ann_maxZ)
+
+    # Test the LM detections against the EM annotations, by z section
+    overlap_matrix = annotationOverlap.compute_overlap_matrix(
+        groundTruth['geometries'], LM_annotations)
 
     bins = np.arange(0, 4)  # 3 bins. 0 overlap, 1 overlap, 1+ overlaps
     LM_per_EM = np.sum(overlap_matrix, axis=1)
@@ -423,28 +342,20 @@ def evalsyndetections(args):
 
     # Sort annotations into categories
     # True Positives (EM Detections)
-    detected_annotations = []
-    for counter, synapse in enumerate(good_annotations):
-        if (LM_per_EM[counter] != 0 and EM_edge[counter] == False):
-            detected_annotations.append(synapse)
+    detected_annotations = good_annotations.select(
+        (LM_per_EM != 0) & (EM_edge == False))
 
     # False Negatives (EM Detections)
-    missed_annotations = []
-    for counter, synapse in enumerate(good_annotations):
-        if (LM_per_EM[counter] == 0 and EM_edge[counter] == False):
-            missed_annotations.append(synapse)
+    missed_annotations = good_annotations.select(
+        (LM_per_EM == 0) & (EM_edge == False))
 
     # False Positives (LM Detections)
-    false_positives = []
-    for counter, anno in enumerate(LM_annotations):
-        if (EM_per_LM[counter] == 0 and LM_edge[counter] == False):
-            false_positives.append(anno)
+    false_positives = LM_annotations.select(
+        (EM_per_LM == 0) & (LM_edge == False))
 
     # True Positive (LM Detections)
-    tp_detections = []
-    for counter, anno in enumerate(LM_annotations):
-        if (EM_per_LM[counter] != 0 and LM_edge[counter] == False):
-            tp_detections.append(anno)
+    tp_detections = LM_annotations.select(
+        (EM_per_LM != 0) & (LM_edge == False))
 
     # Collate results into a dict
     output = {'missed_annotations': missed_annotations, 'false_positives': false_positives,
@@ -471,34 +382,72 @@ def combineResultVolumes(listOfQueryNumbers, listOfThresholds, metadata, args):
     queryresult : dict
     """
 
-    resultVolList = []  # list of thresholded result volumes
-
-    for n, queryNum in enumerate(listOfQueryNumbers):
-        # load result volume
-        fn = os.path.join(metadata['outputNPYlocation'], 'resultVol')
-        fn = fn + str(queryNum) + '.npy'
-        resultVol_n = np.load(fn)
-        resultVol_n = resultVol_n > listOfThresholds[n]
-        resultVolList.append(resultVol_n)
+    # union of the thresholded result volumes
+    resultVol = syn.loadthresholdedresultvols(metadata['outputNPYlocation'], 'resultVol',
+                                              listOfQueryNumbers, listOfThresholds)
 
-    resultVol = resultVolList[0]
-    combinedQNum = str(listOfQueryNumbers[0])
-    for volItr in range(1, len(resultVolList)):
-        resultVol = resultVol + resultVolList[volItr]
-        combinedQNum = combinedQNum + str(listOfQueryNumbers[volItr])
+    combinedQNum = ''.join(str(queryNum) for queryNum in listOfQueryNumbers)
 
     combinedQNum = combinedQNum + str(0) + str(0)
 
+    return evaluateDetectionMask(resultVol, metadata, args, "_combined")
+
+
+def evaluateThresholdSweep(queryNumber, listOfThresholds, metadata, args):
+    """
+    Evaluate one query at several thresholds, the result volume and the EM
+    annotations are only loaded once
+
+    Parameters
+    ---------------
+    queryNumber : int
+    listOfThresholds : list of floats
+    metadata : dict
+    args : dict
+
+    Returns
+    ----------------
+    listofevals : list of dicts - evaluation at each threshold
+    """
+    resultVol = syn.loadresultvol(metadata['outputNPYlocation'], 'resultVol', queryNumber,
+                                  sparse=True)
+
+    groundTruth = loadGroundTruth(args)
+
+    listofevals = []
+    for thresh in listOfThresholds:
+        listofevals.append(evaluateDetectionMask(resultVol.to_mask(thresh), metadata, args,
+                                                 "_sweep", groundTruth))
+
+    return listofevals
+
+
+def evaluateDetectionMask(detectionMask, metadata, args, n, groundTruth=None):
+    """
+    Write a detection mask to json annotations and evaluate them
+
+    Parameters
+    ---------------
+    detectionMask : 3D bool numpy array
+    metadata : dict
+    args : dict
+    n : str - suffix of the json file
+    groundTruth : dict - see loadGroundTruth (default None)
+
+    Returns
+    ----------------
+    queryresult : dict
+    """
     # output detections to json file
     query = {'thresh': 0.9}
-    probMapToJSON(resultVol, metadata, query, "_combined")
+    probMapToJSON(detectionMask, metadata, query, n)
 
     jsonFN = metadata['outputJSONlocation']
-    jsonFN = os.path.join(jsonFN, 'resultVol_combined.json')
+    jsonFN = os.path.join(jsonFN, 'resultVol' + str(n) + '.json')
 
     # Evaluate results
     args['LM_annotation_json'] = jsonFN
-    queryresult = evalsyndetections(args)
+    queryresult = evalsyndetections(args, groundTruth)
 
     return queryresult
 
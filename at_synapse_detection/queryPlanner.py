@@ -0,0 +1,206 @@
+"""
+Run a list of queries over the same region in a single pass.
+The queries are turned into a graph of processing steps (load, probability
+map, convolution, slice factor, lookup table, combine). Steps that several
+queries have in common, e.g. the PSD95 channel with the same punctum size
+and slice span, are executed once; only the final combine runs per query.
+"""
+import collections
+import numpy as np
+from at_synapse_detection import SynapseDetection as syn
+
+
+class QueryPlan:
+    """
+    Dependency graph of processing steps. Each step is identified by a key,
+    adding a step that already exists does nothing, which is how steps are
+    shared between queries.
+    """
+
+    def __init__(self):
+        self.steps = collections.OrderedDict()
+        self.outputs = []
+
+    def add_step(self, key, func, deps=(), inplace=False, output=False):
+        """
+        Parameters
+        ----------
+        key : tuple - identifies the step
+        func : function - called with the results of deps
+        deps : list of keys - steps that need to run first
+        inplace : bool - func modifies its inputs. Inputs still needed by
+            other steps are copied first (default False)
+        output : bool - the result is returned by execute (default False)
+
+        Returns
+        ----------
+        key : tuple
+        """
+        if key not in self.steps:
+            self.steps[key] = (func, tuple(deps), inplace)
+        if output and key not in self.outputs:
+            self.outputs.append(key)
+
+        return key
+
+    def execute(self, on_output=None):
+        """
+        Run every step once, in the order they were added. Results are
+        released as soon as the last step that needs them has run.
+
+        Parameters
+        ----------
+        on_output : function - called as on_output(key, result) for output
+            steps, the result is then released instead of returned (default None)
+
+        Returns
+        ----------
+        outputs : dict - result of each output step, empty if on_output is given
+        """
+        # Number of steps that still need each result
+        remaining = {key: 0 for key in self.steps}
+        for func, deps, inplace in self.steps.values():
+            for dep in deps:
+                remaining[dep] = remaining[dep] + 1
+
+        results = {}
+        outputs = {}
+        for n, (key, (func, deps, inplace)) in enumerate(self.steps.items()):
+            print('step ' + str(n + 1) + ' of ' + str(len(self.steps)) + ': ' + str(key))
+
+            inputs = []
+            for dep in deps:
+                remaining[dep] = remaining[dep] - 1
+                if remaining[dep] > 0:
+                    value = results[dep]
+                    if inplace:
+                        value = np.copy(value)
+                else:
+                    value = results.pop(dep)
+                inputs.append(value)
+
+            result = func(*inputs)
+
+            if key in self.outputs:
+                if on_output is not None:
+                    on_output(key, result)
+                else:
+                    outputs[key] = result
+            elif remaining[key] > 0:
+                results[key] = result
+
+        return outputs
+
+
+def get_query_parameters(query):
+    """
+    Punctum size and edge window used by getSynapseDetections
+
+    Parameters
+    ----------
+    query : dict
+
+    Returns
+    ----------
+    blobsize : int
+    edge_win : int
+    """
+    blobsize = 2
+    edge_win = 3
+    if 'punctumSize' in query.keys():
+        blobsize = query['punctumSize']
+        edge_win = int(np.ceil(blobsize * 1.5))
+
+    return blobsize, edge_win
+
+
+def add_channel_steps(plan, channel, blobsize, IF_z, load_channel, lookup_table):
+    """
+    Add steps 1-3 (and optionally the lookup table) of one channel
+
+    Parameters
+    ----------
+    plan : QueryPlan
+    channel : str - channel filename
+    blobsize : int
+    IF_z : int
+    load_channel : function - load_channel(channel) returns the raw volume
+    lookup_table : bool - add a lookup table step after step 3
+
+    Returns
+    ----------
+    key : tuple - key of the last step
+    """
+    load_key = plan.add_step(('load', channel), lambda: load_channel(channel))
+
+    prob_key = plan.add_step(('probmap', channel), syn.getProbMap, [load_key], inplace=True)
+
+    def convolve(vol):
+        return syn.convolveVolume(vol, blobsize, inplace=True)
+    key = plan.add_step(('convolve', channel, blobsize), convolve, [prob_key], inplace=True)
+
+    if IF_z > 1:
+        def factor(vol):
+            return np.multiply(vol, syn.computeFactor(vol, int(IF_z)), out=vol)
+        key = plan.add_step(('factor', channel, blobsize, int(IF_z)), factor, [key],
+                            inplace=True)
+
+    if lookup_table:
+        def table(vol):
+            return syn.createLookupTables([vol])[0]
+        key = plan.add_step(('table',) + key[1:], table, [key], inplace=True)
+
+    return key
+
+
+def plan_queries(listOfQueries, load_channel, precision='float64'):
+    """
+    Build the plan of a list of queries over the same region
+
+    Parameters
+    ----------
+    listOfQueries : list of dicts
+    load_channel : function - load_channel(channel) returns the raw (masked)
+        volume of a channel filename
+    precision : str - dtype of the loaded volumes (default float64)
+
+    Returns
+    ----------
+    plan : QueryPlan - the output of query n has the key ('combine', n)
+    """
+    plan = QueryPlan()
+    lookup_table = np.dtype(precision) == np.float64
+
+    for n, query in enumerate(listOfQueries):
+        blobsize, edge_win = get_query_parameters(query)
+        backend = syn.getKernelBackend(query)
+        if not lookup_table:
+            backend = 'numpy'
+
+        pre = list(zip(query['preIF'], query['preIF_z']))
+        post = list(zip(query['postIF'], query['postIF_z']))
+        if len(post) == 0:
+            base, adjacent = pre, post
+        else:
+            base, adjacent = post, pre
+
+        # The first base channel is used as is, the other channels are
+        # only searched through their lookup tables
+        deps = []
+        for m, (channel, IF_z) in enumerate(base + adjacent):
+            deps.append(add_channel_steps(plan, channel, blobsize, IF_z, load_channel,
+                                          lookup_table and m > 0))
+
+        def combine(*volumes, num_base=len(base), edge_win=edge_win, blobsize=blobsize,
+                    backend=backend):
+            if len(volumes) == 1:
+                # a single channel query returns its input, which other
+                # queries may still share
+                return np.copy(volumes[0])
+            return syn.combinePrePostVolumes(
+                list(volumes[:num_base]), list(volumes[num_base:]), edge_win, blobsize,
+                backend, lookupTables=lookup_table)
+
+        plan.add_step(('combine', n), combine, deps, output=True)
+
+    return plan
@@ -0,0 +1,347 @@
+"""
+Run synapse detection for a whole study from a manifest file
+
+    python -m at_synapse_detection.runBatch manifest.json [--executor process]
+
+The manifest is a json file describing the mice, regions, query files,
+masks, resolution and threshold of a batch; every (mouse, region, query)
+is one task. String fields are templates filled in with the mouse number,
+region name and sheet name, and 'hosts' overrides fields on a given
+machine:
+
+    {
+        "query_fn": "queries/{mouse_number}ss_queries.json",
+        "data_location": "/Users/anish/Documents/yi_mice/{mouse_number}ss_stacks/",
+        "dapi_mask_location": "/Users/anish/Documents/yi_mice/dapi-masks/{mouse_number}ss_stacks/{region_name}",
+        "layer_mask": -1,
+        "sheet_name": "{mouse_number}ss_fragX",
+        "output_foldername": "results_{sheet_name}",
+        "resolution": {"res_xy_nm": 100, "res_z_nm": 70},
+        "thresh": 0.9,
+        "regions": ["F000", "F001", "F002", "F003"],
+        "mice": [1, 22, 2, {"mouse_number": 6, "regions": ["F003"]}],
+        "hosts": {"Galicia": {"data_location": "/data5TB/yi_mice/{mouse_number}ss_stacks"}}
+    }
+
+Each completed task is appended to a run journal (see runJournal), a
+restarted batch skips the tasks found there whose inputs and result
+volumes are unchanged. The results of each mouse are written to
+<sheet_name>.xlsx in the output location, as the driver scripts do.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import numpy as np
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import antibodyAnalysis as aa
+from at_synapse_detection import batchRunner as br
+from at_synapse_detection import runJournal as rj
+
+try:
+    from dask.distributed import Client, LocalCluster, as_completed
+    DASK_AVAILABLE = True
+except ImportError:
+    DASK_AVAILABLE = False
+
+EXECUTORS = ['serial', 'process', 'cluster']
+
+# Default values of the optional manifest fields
+MANIFEST_DEFAULTS = {'layer_mask': -1, 'thresh': 0.9, 'astro': False,
+                     'resolution': {'res_xy_nm': 100, 'res_z_nm': 70},
+                     'sheet_name': '{mouse_number}ss',
+                     'output_foldername': 'results_{sheet_name}',
+                     'executor': 'process', 'num_workers': None, 'queries_per_task': None,
+                     'excel': True, 'output_location': '.'}
+
+
+def load_manifest(fn, hostname=None):
+    """
+    Read a manifest and apply the overrides of this machine
+
+    Parameters
+    ----------
+    fn : str - json file
+    hostname : str (default socket.gethostname())
+
+    Returns
+    ----------
+    manifest : dict
+    """
+    with open(fn) as f:
+        manifest = json.load(f)
+
+    return apply_host_overrides(manifest, hostname)
+
+
+def apply_host_overrides(manifest, hostname=None):
+    """
+    Merge manifest['hosts'][hostname] into the manifest
+
+    Parameters
+    ----------
+    manifest : dict
+    hostname : str (default socket.gethostname())
+
+    Returns
+    ----------
+    manifest : dict - a new dict
+    """
+    if hostname is None:
+        hostname = socket.gethostname()
+
+    merged = dict(MANIFEST_DEFAULTS)
+    merged.update({key: value for key, value in manifest.items() if key != 'hosts'})
+    merged.update(manifest.get('hosts', {}).get(hostname, {}))
+
+    return merged
+
+
+def fill_template(value, fields):
+    """
+    Fill in the {mouse_number}, {region_name} and {sheet_name} of a string
+    """
+    if isinstance(value, str):
+        return value.format(**fields)
+    return value
+
+
+def get_mouse_settings(manifest, mouse):
+    """
+    Settings of one mouse, the manifest with the mouse's overrides
+
+    Parameters
+    ----------
+    manifest : dict
+    mouse : int or dict - mouse number, or dict with 'mouse_number' and overrides
+
+    Returns
+    ----------
+    settings : dict - sheet_name, query_fn and output_foldername are filled in
+    """
+    settings = dict(manifest)
+    if isinstance(mouse, dict):
+        settings.update(mouse)
+    else:
+        settings['mouse_number'] = mouse
+
+    fields = {'mouse_number': settings['mouse_number']}
+    settings['sheet_name'] = fill_template(settings['sheet_name'], fields)
+    fields['sheet_name'] = settings['sheet_name']
+    for key in ['query_fn', 'data_location', 'output_foldername', 'output_location']:
+        settings[key] = fill_template(settings[key], fields)
+
+    return settings
+
+
+def get_task_id(mouse_number, region_name, nQuery):
+    return str(mouse_number) + '/' + region_name + '/Q' + str(nQuery)
+
+
+def get_batch_tasks(manifest):
+    """
+    Expand a manifest into the inputs of run_synapse_detection
+
+    Parameters
+    ----------
+    manifest : dict - see load_manifest
+
+    Returns
+    ----------
+    mice : list of dicts - settings of each mouse (see get_mouse_settings),
+        with the 'task_ids' and 'foldernames' of its tasks
+    atet_inputs_list : list of dicts - one per task, with a 'task_id'
+    """
+    mice = []
+    atet_inputs_list = []
+    for mouse in manifest['mice']:
+        settings = get_mouse_settings(manifest, mouse)
+        mouse_number = settings['mouse_number']
+        listOfQueries = syn.loadQueriesJSON(settings['query_fn'])
+
+        settings['task_ids'] = []
+        settings['foldernames'] = []
+        queryID = 0
+        for region_name in settings['regions']:
+            fields = {'mouse_number': mouse_number, 'region_name': region_name,
+                      'sheet_name': settings['sheet_name']}
+            data_location = settings['data_location']
+            layer_mask = fill_template(settings['layer_mask'], fields)
+            dapi_mask_str = fill_template(settings['dapi_mask_location'], fields)
+
+            for nQuery, query in enumerate(listOfQueries):
+                task_id = get_task_id(mouse_number, region_name, nQuery)
+                settings['task_ids'].append(task_id)
+                settings['foldernames'].append(region_name + '-Q' + str(nQuery))
+
+                atet_inputs_list.append({
+                    'task_id': task_id, 'query': query, 'queryID': queryID, 'nQuery': nQuery,
+                    'resolution': settings['resolution'], 'thresh': settings['thresh'],
+                    'data_region_location': os.path.join(data_location, region_name),
+                    'data_location': data_location,
+                    'output_foldername': settings['output_foldername'],
+                    'region_name': region_name, 'mask_str': layer_mask,
+                    'dapi_mask_str': dapi_mask_str, 'mouse_number': mouse_number})
+                queryID = queryID + 1
+
+        mice.append(settings)
+
+    return mice, atet_inputs_list
+
+
+def timed_task(func, atet_input):
+    """
+    Run a task and add its run time to the output
+    """
+    start = time.time()
+    output_dict = func(atet_input)
+    output_dict['seconds'] = time.time() - start
+    return output_dict
+
+
+def run_serial(atet_inputs_list, astro, on_result):
+    """
+    Run the tasks one after the other in this process
+    """
+    func = sa.run_synapse_detection_astro if astro else sa.run_synapse_detection
+    result_list = []
+    for ind, atet_input in enumerate(atet_inputs_list):
+        output_dict = timed_task(func, atet_input)
+        on_result(ind, output_dict)
+        result_list.append(output_dict)
+
+    return result_list
+
+
+def run_process(atet_inputs_list, astro, on_result, num_workers=None, queries_per_task=None):
+    """
+    Run the tasks on a pool of worker processes, see batchRunner
+    """
+    with br.BatchRunner(num_workers) as runner:
+        return runner.map_synapse_detection(atet_inputs_list, astro, queries_per_task,
+                                            on_result)
+
+
+def run_cluster(atet_inputs_list, astro, on_result, num_workers=None, address=None):
+    """
+    Run the tasks on a dask cluster, a local one if no scheduler address is given
+    """
+    if not DASK_AVAILABLE:
+        raise ImportError('the cluster executor needs dask.distributed')
+
+    func = sa.run_synapse_detection_astro if astro else sa.run_synapse_detection
+    if address is not None:
+        client = Client(address)
+    else:
+        client = Client(LocalCluster(n_workers=num_workers, threads_per_worker=1))
+
+    result_list = [None] * len(atet_inputs_list)
+    try:
+        futures = {client.submit(timed_task, func, atet_input, pure=False): ind
+                   for ind, atet_input in enumerate(atet_inputs_list)}
+        for future in as_completed(futures):
+            ind = futures[future]
+            result_list[ind] = future.result()
+            on_result(ind, result_list[ind])
+    finally:
+        client.close()
+
+    return result_list
+
+
+def run_batch(manifest, executor=None, journal_fn=None):
+    """
+    Run every task of a manifest and write the results of each mouse
+
+    Parameters
+    ----------
+    manifest : dict - see load_manifest
+    executor : str - 'serial', 'process' or 'cluster' (default manifest['executor'])
+    journal_fn : str - run journal, completed tasks found there are not
+        run again (default None)
+
+    Returns
+    ----------
+    mouse_dfs : dict - sheet name: dataframe of the mouse
+    """
+    if executor is None:
+        executor = manifest['executor']
+    if executor not in EXECUTORS:
+        raise ValueError('unknown executor: ' + str(executor))
+
+    mice, atet_inputs_list = get_batch_tasks(manifest)
+
+    journal = rj.RunJournal(journal_fn, manifest['astro'])
+    todo_inds, _ = journal.split(atet_inputs_list)
+    todo = [atet_inputs_list[ind] for ind in todo_inds]
+    num_done = [len(atet_inputs_list) - len(todo)]
+
+    def on_result(ind, output_dict):
+        record = journal.add(todo[ind], output_dict)
+        num_done[0] = num_done[0] + 1
+        print('done ' + record['task_id'] + ' in %.1f s' % (record['seconds'] or 0) +
+              ' (' + str(num_done[0]) + ' of ' + str(len(atet_inputs_list)) + ')')
+
+    if len(todo) > 0:
+        if executor == 'serial':
+            run_serial(todo, manifest['astro'], on_result)
+        elif executor == 'process':
+            run_process(todo, manifest['astro'], on_result, manifest['num_workers'],
+                        manifest['queries_per_task'])
+        else:
+            run_cluster(todo, manifest['astro'], on_result, manifest['num_workers'],
+                        manifest.get('scheduler_address'))
+
+    outputs = {atet_input['task_id']: journal.get_output(atet_input)
+               for atet_input in atet_inputs_list}
+
+    mouse_dfs = {}
+    for settings in mice:
+        result_list = [outputs[task_id] for task_id in settings['task_ids']]
+        sorted_queryresult = sa.organize_result_lists(result_list)
+        mouse_df = sa.create_synapse_df(sorted_queryresult, settings['foldernames'])
+        print(mouse_df)
+        mouse_dfs[settings['sheet_name']] = mouse_df
+
+        seconds = [output['seconds'] for output in result_list if output['seconds'] is not None]
+        if len(seconds) > 0:
+            print('%s: %.1f s per task, %.1f s in total' %
+                  (settings['sheet_name'], np.mean(seconds), np.sum(seconds)))
+
+        if settings['excel']:
+            fn = os.path.join(settings['output_location'], settings['sheet_name'] + '.xlsx')
+            aa.write_dfs_to_excel([mouse_df], settings['sheet_name'], fn)
+
+    return mouse_dfs
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run synapse detection from a manifest')
+    parser.add_argument('manifest', help='json manifest of the batch')
+    parser.add_argument('--executor', choices=EXECUTORS, default=None,
+                        help='overrides the executor of the manifest')
+    parser.add_argument('--num-workers', type=int, default=None)
+    parser.add_argument('--journal', default=None,
+                        help='run journal (default <manifest>.journal.jsonl)')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the journal of a previous run')
+    args = parser.parse_args(args)
+
+    manifest = load_manifest(args.manifest)
+    if args.num_workers is not None:
+        manifest['num_workers'] = args.num_workers
+
+    journal_fn = args.journal
+    if journal_fn is None:
+        journal_fn = args.manifest + '.journal.jsonl'
+    if args.restart and os.path.isfile(journal_fn):
+        os.remove(journal_fn)
+
+    run_batch(manifest, args.executor, journal_fn)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
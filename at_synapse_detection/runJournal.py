@@ -0,0 +1,216 @@
+"""
+Run journal of a detection batch. Every completed (region, query) task is
+appended to a json lines file with its result volume and measurements, so
+a batch that crashed or ran out of memory is restarted where it stopped.
+
+A task is only skipped on restart if its inputs (query, threshold,
+resolution, channel and mask files) hash to the recorded value and its
+result volume is still on disk unchanged; otherwise it is run again.
+"""
+import os
+import json
+import hashlib
+from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import preprocessCache as pc
+from at_synapse_detection import dataAccess as da
+
+
+def get_task_id(atet_input):
+    """
+    Journal key of a task, atet_input['task_id'] if given, else the location
+    of its result volume
+    """
+    if 'task_id' in atet_input:
+        return str(atet_input['task_id'])
+
+    return os.path.join(atet_input['data_location'], atet_input['output_foldername'],
+                        atet_input['region_name'], 'query_' + str(atet_input['queryID']))
+
+
+def get_input_files(atet_input, astro=False):
+    """
+    Channel and mask files read by a task
+
+    Returns
+    ----------
+    fns : list of strs
+    """
+    query = atet_input['query']
+    name_keys = ['preIF', 'postIF'] + (['glialIF'] if astro else [])
+
+    if da.is_h5_file(atet_input['data_region_location']):
+        # every channel is a dataset of the store
+        fns = [atet_input['data_region_location']]
+    else:
+        fns = [os.path.join(atet_input['data_region_location'], channelname)
+               for name_key in name_keys for channelname in query.get(name_key, [])]
+    if not astro and atet_input['mask_str'] != -1:
+        fns.append(atet_input['mask_str'])
+    fns.append(os.path.join(atet_input['dapi_mask_str'],
+                            str(atet_input['mouse_number']) + 'ss-DAPI-mask.tiff'))
+
+    return fns
+
+
+def get_signature(fn):
+    """
+    preprocessCache.file_signature as a list, None if the file is missing
+    """
+    if fn is None or not os.path.exists(fn):
+        return None
+    return list(pc.file_signature(fn))
+
+
+def input_hash(atet_input, astro=False):
+    """
+    Hash of everything the result of a task depends on
+
+    Parameters
+    ----------
+    atet_input : dict - see SynapseAnalysis.run_synapse_detection
+    astro : bool (default False)
+
+    Returns
+    ----------
+    digest : str
+    """
+    fields = {'query': atet_input['query'], 'thresh': atet_input.get('thresh', 0.9),
+              'resolution': atet_input['resolution'], 'astro': astro,
+              'files': [get_signature(fn) for fn in get_input_files(atet_input, astro)]}
+    encoded = json.dumps(fields, sort_keys=True, default=str).encode('utf-8')
+
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def output_to_record(atet_input, output_dict, astro=False):
+    """
+    Journal entry of a completed task
+    """
+    queryresult = output_dict['queryresult']
+    output_fn = output_dict.get('output_fn')
+    return {'task_id': get_task_id(atet_input), 'queryID': output_dict['queryID'],
+            'input_hash': input_hash(atet_input, astro),
+            'output_fn': output_fn, 'output_signature': get_signature(output_fn),
+            'num_synapses': int(queryresult.num_synapses),
+            'synapse_density': float(queryresult.synapse_density),
+            'volume_um3': float(queryresult.volume_um3),
+            'seconds': output_dict.get('seconds')}
+
+
+def record_to_output(atet_input, record):
+    """
+    Rebuild the output of run_synapse_detection from a journal entry
+    """
+    queryresult = sa.SynapseAnalysis(atet_input['query'])
+    queryresult.num_synapses = record['num_synapses']
+    queryresult.synapse_density = record['synapse_density']
+    queryresult.volume_um3 = record['volume_um3']
+    return {'queryID': record['queryID'], 'query': atet_input['query'],
+            'queryresult': queryresult, 'output_fn': record.get('output_fn'),
+            'seconds': record.get('seconds')}
+
+
+def read_journal(fn):
+    """
+    Entries of a journal file, the last entry of a task wins
+
+    Returns
+    ----------
+    records : dict - task id: record
+    """
+    records = {}
+    if fn is None or not os.path.isfile(fn):
+        return records
+
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                continue
+            records[record['task_id']] = record
+
+    return records
+
+
+class RunJournal:
+    """
+    Append only journal of the completed tasks of a batch
+    """
+
+    def __init__(self, fn, astro=False):
+        """
+        Parameters
+        ----------
+        fn : str - json lines file, created on the first completed task.
+            None keeps the journal in memory only
+        astro : bool - the tasks are astro queries (default False)
+        """
+        self.fn = fn
+        self.astro = astro
+        self.records = read_journal(fn)
+
+    def __len__(self):
+        return len(self.records)
+
+    def is_done(self, atet_input):
+        """
+        The task has a journal entry with the same inputs and its result
+        volume is unchanged
+        """
+        record = self.records.get(get_task_id(atet_input))
+        if record is None:
+            return False
+        if record['input_hash'] != input_hash(atet_input, self.astro):
+            return False
+        if record.get('output_fn') is not None and \
+                get_signature(record['output_fn']) != record['output_signature']:
+            return False
+
+        return True
+
+    def get_output(self, atet_input):
+        """
+        Output of a completed task, see record_to_output
+        """
+        return record_to_output(atet_input, self.records[get_task_id(atet_input)])
+
+    def add(self, atet_input, output_dict):
+        """
+        Record a completed task, the entry is on disk when add returns
+        """
+        record = output_to_record(atet_input, output_dict, self.astro)
+        self.records[record['task_id']] = record
+        if self.fn is None:
+            return record
+
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        return record
+
+    def split(self, atet_inputs_list):
+        """
+        Split a batch into the tasks still to run and the completed ones
+
+        Returns
+        ----------
+        todo : list of ints - indices of the tasks to run
+        done : list of ints - indices of the completed tasks
+        """
+        todo = []
+        done = []
+        for ind, atet_input in enumerate(atet_inputs_list):
+            if self.is_done(atet_input):
+                done.append(ind)
+            else:
+                todo.append(ind)
+
+        print(str(len(done)) + ' of ' + str(len(atet_inputs_list)) + ' tasks already done')
+        return todo, done
@@ -0,0 +1,279 @@
+"""
+Sparse (coordinate list) storage of result volumes. Only voxels where the
+base channel passed the combine threshold are non-zero, so the result of a
+query is stored as the (row, col, z) coordinates and float32 values of its
+non-zero voxels plus the volume shape.
+
+Measurements over a list of thresholds (sweep_components) are computed from
+a single maximum spanning forest of the voxel graph: the components above
+any threshold are the components of the forest edges above it, so each
+extra threshold only costs a labeling of the (much smaller) forest.
+Building the forest costs more than labeling the grid once, so a dense
+volume swept at only a few thresholds is labeled on the grid at every
+threshold instead (sweep_components_grid), see GRID_LABEL_RATIO.
+"""
+import os
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from at_synapse_detection import componentStats as cs
+
+# Labeling a dense volume at every threshold is used instead of the
+# spanning forest if it touches fewer than this many voxels per voxel
+# above the lowest threshold. 0 always uses the forest
+GRID_LABEL_RATIO = float(os.environ.get('SYNAPSE_GRID_LABEL_RATIO', 64))
+
+
+def get_neighbour_edges(shape, rows, cols, zs):
+    """
+    Pairs of voxels of a coordinate list that touch with full (26)
+    connectivity, each pair is listed once
+
+    Parameters
+    ----------
+    shape : tuple - shape of the dense volume
+    rows, cols, zs : 1D int arrays - coordinates of the voxels
+
+    Returns
+    ----------
+    edge_src, edge_dst : 1D int arrays - indices of the voxels of each pair
+    """
+    numVoxels = len(rows)
+    nrows, ncols, nz = shape
+    coords = [np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64),
+              np.asarray(zs, dtype=np.int64)]
+    linear = (coords[0] * ncols + coords[1]) * nz + coords[2]
+
+    # Each voxel is linked to the neighbours with a larger linear index,
+    # found by binary search in the sorted coordinate list. Coordinates
+    # from np.nonzero are already sorted
+    if np.all(linear[1:] > linear[:-1]):
+        order = np.arange(numVoxels)
+        sorted_linear = linear
+    else:
+        order = np.argsort(linear, kind='stable')
+        sorted_linear = linear[order]
+    edge_src = []
+    edge_dst = []
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                if (dr, dc, dz) <= (0, 0, 0):
+                    continue
+                nr = coords[0] + dr
+                nc = coords[1] + dc
+                nzs = coords[2] + dz
+                valid = (nr >= 0) & (nr < nrows) & (nc >= 0) & (nc < ncols) & \
+                    (nzs >= 0) & (nzs < nz)
+                neighbour = (nr * ncols + nc) * nz + nzs
+                pos = np.searchsorted(sorted_linear, neighbour)
+                pos[pos == numVoxels] = 0
+                found = valid & (sorted_linear[pos] == neighbour)
+                edge_src.append(np.flatnonzero(found))
+                edge_dst.append(order[pos[found]])
+
+    return np.concatenate(edge_src), np.concatenate(edge_dst)
+
+
+def sweep_components_grid(vol, thresholds):
+    """
+    Sizes of the connected components (26 connectivity) of the voxels above
+    each threshold, labeling the dense volume once per threshold
+
+    Parameters
+    ----------
+    vol : 3D numpy array
+    thresholds : list of floats
+
+    Returns
+    ----------
+    sizes_list : list of 1D int arrays - see sweep_components
+    """
+    sizes_list = []
+    for thresh in thresholds:
+        label_vol, num_labels = cs.label_components(vol > thresh)
+        sizes_list.append(cs.component_sizes(label_vol, num_labels))
+
+    return sizes_list
+
+
+def sweep_components(vol, thresholds):
+    """
+    Sizes of the connected components (26 connectivity) of the voxels above
+    each threshold, the same as measure.label(vol > thresh) for every
+    threshold but with a single neighbour search. Dense volumes with
+    len(thresholds) * vol.size <= GRID_LABEL_RATIO * (voxels above the
+    lowest threshold) go to sweep_components_grid
+
+    Parameters
+    ----------
+    vol : 3D numpy array or SparseResultVolume
+    thresholds : list of floats
+
+    Returns
+    ----------
+    sizes_list : list of 1D int arrays - number of voxels of each component,
+        one array per threshold, in the order of thresholds
+    """
+    thresholds = [float(thresh) for thresh in thresholds]
+    if len(thresholds) == 0:
+        return []
+
+    min_thresh = min(thresholds)
+    if isinstance(vol, SparseResultVolume):
+        sparse_vol = vol.threshold(min_thresh)
+    else:
+        above = vol > min_thresh
+        if len(thresholds) * vol.size <= GRID_LABEL_RATIO * np.count_nonzero(above):
+            # few thresholds of a dense volume, faster on the grid
+            return sweep_components_grid(vol, thresholds)
+
+        # keep the values exact, no rounding to float32
+        rows, cols, zs = np.nonzero(above)
+        sparse_vol = SparseResultVolume(vol.shape, rows, cols, zs, vol[rows, cols, zs])
+
+    values = sparse_vol.values
+    numVoxels = len(values)
+    if numVoxels == 0:
+        return [np.zeros(0, dtype=np.int64) for thresh in thresholds]
+
+    # An edge exists above a threshold if both of its voxels are above it
+    edge_src, edge_dst = get_neighbour_edges(
+        sparse_vol.shape, sparse_vol.rows, sparse_vol.cols, sparse_vol.zs)
+    edge_value = np.minimum(values[edge_src], values[edge_dst])
+
+    # Maximum spanning forest. Edges are weighted by their rank, strongest
+    # first, so equal values tie and no weight is zero
+    unique_values, inverse = np.unique(edge_value, return_inverse=True)
+    weights = (len(unique_values) - inverse).astype(np.float64)
+    forest = minimum_spanning_tree(coo_matrix((weights, (edge_src, edge_dst)),
+                                              shape=(numVoxels, numVoxels))).tocoo()
+    forest_value = unique_values[len(unique_values) - forest.data.astype(np.int64)]
+
+    sizes_list = []
+    for thresh in thresholds:
+        keep = values > thresh
+        keep_edges = forest_value > thresh
+        graph = coo_matrix((np.ones(np.count_nonzero(keep_edges), dtype=np.int8),
+                            (forest.row[keep_edges], forest.col[keep_edges])),
+                           shape=(numVoxels, numVoxels))
+        _, labels = connected_components(graph, directed=False)
+        sizes = np.bincount(labels[keep])
+        sizes_list.append(sizes[sizes > 0])
+
+    return sizes_list
+
+
+class SparseResultVolume:
+    """
+    Coordinate list representation of a (y, x, z) result volume
+    """
+
+    def __init__(self, shape, rows, cols, zs, values):
+        """
+        Parameters
+        ----------
+        shape : tuple - shape of the dense volume
+        rows, cols, zs : 1D int arrays - coordinates of the non-zero voxels,
+            in C (row major) order
+        values : 1D array - values of the non-zero voxels
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.zs = np.asarray(zs, dtype=np.int32)
+        self.values = np.asarray(values)
+        self.ndim = 3
+
+    @classmethod
+    def from_dense(cls, vol, dtype=np.float32):
+        """
+        Parameters
+        ----------
+        vol : 3D numpy array
+        dtype : numpy dtype of the stored values (default float32). Values
+            are rounded, so a voxel within float32 precision of a threshold
+            can land on the other side of it
+
+        Returns
+        ----------
+        sparse_vol : SparseResultVolume
+        """
+        rows, cols, zs = np.nonzero(vol)
+        return cls(vol.shape, rows, cols, zs, vol[rows, cols, zs].astype(dtype))
+
+    @classmethod
+    def load(cls, fn):
+        """
+        Read a volume written by save
+        """
+        with np.load(fn) as data:
+            return cls(data['shape'], data['rows'], data['cols'], data['zs'], data['values'])
+
+    def save(self, fn):
+        """
+        Write the volume to a compressed .npz file
+        """
+        np.savez_compressed(fn, shape=np.array(self.shape), rows=self.rows, cols=self.cols,
+                            zs=self.zs, values=self.values)
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def to_dense(self, dtype=None):
+        """
+        Returns the dense 3D numpy array
+        """
+        if dtype is None:
+            dtype = self.values.dtype
+        vol = np.zeros(self.shape, dtype=dtype)
+        vol[self.rows, self.cols, self.zs] = self.values
+        return vol
+
+    def threshold(self, thresh):
+        """
+        Voxels with values above thresh, as a new SparseResultVolume
+        """
+        keep = self.values > thresh
+        return SparseResultVolume(self.shape, self.rows[keep], self.cols[keep],
+                                  self.zs[keep], self.values[keep])
+
+    def to_mask(self, thresh=None):
+        """
+        Dense boolean volume of the voxels above thresh (all non-zero voxels
+        if thresh is None)
+        """
+        sparse_vol = self if thresh is None else self.threshold(thresh)
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[sparse_vol.rows, sparse_vol.cols, sparse_vol.zs] = True
+        return mask
+
+    def label(self, thresh=None):
+        """
+        Connected components of the voxels above thresh with full (26)
+        connectivity, the same as measure.label on the dense mask. Computed
+        on the coordinates, the dense volume is never allocated.
+
+        Parameters
+        ----------
+        thresh : float (default None, every non-zero voxel)
+
+        Returns
+        ----------
+        num_labels : int
+        labels : 1D int array - component of each voxel of the thresholded volume
+        sparse_vol : SparseResultVolume - the thresholded volume
+        """
+        sparse_vol = self if thresh is None else self.threshold(thresh)
+        numVoxels = sparse_vol.nnz
+        if numVoxels == 0:
+            return 0, np.zeros(0, dtype=np.int64), sparse_vol
+
+        edge_src, edge_dst = get_neighbour_edges(
+            self.shape, sparse_vol.rows, sparse_vol.cols, sparse_vol.zs)
+        graph = coo_matrix((np.ones(len(edge_src), dtype=np.int8), (edge_src, edge_dst)),
+                           shape=(numVoxels, numVoxels))
+        num_labels, labels = connected_components(graph, directed=False)
+
+        return num_labels, labels, sparse_vol
@@ -0,0 +1,293 @@
+"""
+Compiled (numba) versions of the synapse detection search loops.
+The functions have the same signatures as the ones in SynapseDetection
+and are selected through the 'numba' kernel backend.
+"""
+import numpy as np
+
+try:
+    import numba
+    from numba import prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+
+def jit(parallel=False):
+    """
+    Compile the decorated function with numba in nopython mode if numba is
+    installed, otherwise leave it as a plain python function
+
+    Parameters
+    ----------
+    parallel : bool - allow prange loops to run in parallel (default False)
+    """
+    def decorator(func):
+        if NUMBA_AVAILABLE:
+            return numba.njit(parallel=parallel, cache=True)(func)
+        return func
+    return decorator
+
+
+@jit()
+def _boxMean(lookupTable, rstart, cstart, search_win, zItr):
+    """
+    Mean of a search_win x search_win box read from a summed area table
+    """
+    sumIF1 = lookupTable[int(rstart + search_win), int(cstart + search_win), zItr] + \
+        lookupTable[int(rstart), int(cstart), zItr] - \
+        lookupTable[int(rstart + search_win), int(cstart), zItr] - \
+        lookupTable[int(rstart), int(cstart + search_win), zItr]
+
+    return sumIF1 / (search_win * search_win)
+
+
+@jit()
+def _searchAdjacentChannel(adjacentTables, numAdjacent, search_win, cInd, rInd, zInd):
+    """
+    See SynapseDetection.searchAdjacentChannel
+    """
+    searchgrid = np.zeros((27, numAdjacent))
+    numSlices = adjacentTables[0].shape[2]
+
+    if numSlices == 1:
+        zstart = 0
+        zend = 1
+    elif zInd == 0:
+        zstart = 0
+        zend = 2
+    elif zInd == (numSlices - 1):
+        zstart = numSlices - 2
+        zend = numSlices
+    else:
+        zstart = zInd - 1
+        zend = zInd + 2
+
+    ind = 0
+    for zItr in range(zstart, zend):
+        rstart = rInd - 1.5 * search_win
+        for row in range(0, 3):
+            cstart = cInd - 1.5 * search_win
+            for col in range(0, 3):
+                for volItr in range(0, numAdjacent):
+                    searchgrid[ind, volItr] = _boxMean(
+                        adjacentTables[volItr], rstart, cstart, search_win, zItr)
+                ind = ind + 1
+                cstart = cstart + search_win
+            rstart = rstart + search_win
+
+    # Find the max of the first presynaptic channel (same tie and nan
+    # handling as np.argmax)
+    max_ind = 0
+    for ind in range(1, 27):
+        if np.isnan(searchgrid[max_ind, 0]):
+            break
+        if searchgrid[ind, 0] > searchgrid[max_ind, 0] or np.isnan(searchgrid[ind, 0]):
+            max_ind = ind
+
+    result = searchgrid[max_ind, 0]
+    for volItr in range(1, numAdjacent):
+        result = result * searchgrid[max_ind, volItr]
+    return result
+
+
+@jit()
+def _searchColocalizeChannel(baseTables, numBase, search_win, cInd, rInd, zInd):
+    """
+    See SynapseDetection.searchColocalizeChannel
+    """
+    rstart = rInd - search_win / 2
+    cstart = cInd - search_win / 2
+
+    output = 1.0
+    for volItr in range(1, numBase):
+        output = output * _boxMean(baseTables[volItr], rstart, cstart, search_win, int(zInd))
+    return output
+
+
+@jit(parallel=True)
+def _combineVolumes(baseTables, numBase, adjacentTables, numAdjacent, glialTables,
+                    numGlial, edge_win, search_win, outputVol):
+    """
+    Loop over every voxel, in parallel over z. numGlial > 0 selects the
+    astro combination rule.
+    """
+    baseVol = baseTables[0]
+    for zInd in prange(0, baseVol.shape[2]):
+        for rInd in range(edge_win, baseVol.shape[0] - edge_win):
+            for cInd in range(edge_win, baseVol.shape[1] - edge_win):
+
+                if (baseVol[rInd, cInd, zInd] < 0.5):
+                    continue
+
+                if numAdjacent > 0:
+                    adjResult = _searchAdjacentChannel(
+                        adjacentTables, numAdjacent, search_win, cInd, rInd, zInd)
+                    if numGlial > 0:
+                        adjResult2 = _searchAdjacentChannel(
+                            glialTables, numGlial, search_win, cInd, rInd, zInd)
+                        outputVol[rInd, cInd, zInd] = baseVol[rInd, cInd, zInd] * \
+                            adjResult * adjResult2
+                    elif numBase > 1:
+                        coresult = _searchColocalizeChannel(
+                            baseTables, numBase, search_win, cInd, rInd, zInd)
+                        outputVol[rInd, cInd, zInd] = baseVol[rInd, cInd, zInd] * \
+                            coresult * adjResult
+                    else:
+                        outputVol[rInd, cInd, zInd] = baseVol[rInd, cInd, zInd] * adjResult
+                else:
+                    coresult = _searchColocalizeChannel(
+                        baseTables, numBase, search_win, cInd, rInd, zInd)
+                    outputVol[rInd, cInd, zInd] = baseVol[rInd, cInd, zInd] * coresult
+
+    return outputVol
+
+
+def _asTables(volList, fallback):
+    """
+    Convert a list of volumes into a tuple of float64 C arrays so numba
+    sees a homogeneous tuple. Empty lists are replaced by a one element
+    placeholder tuple, the caller passes the real length separately.
+    """
+    if len(volList) == 0:
+        volList = [fallback]
+    return tuple(np.ascontiguousarray(vol, dtype=np.float64) for vol in volList)
+
+
+def createLookupTables(inputVol):
+    """
+    Create Look Up tables (see SynapseDetection.createLookupTables)
+
+    Parameters
+    ----------
+    inputVol : list of 3D Numpy Arrays
+
+    Returns
+    ----------
+    inputVol : list of 3D Numpy Arrays
+    """
+    for volItr in range(0, len(inputVol)):
+        inputVol[volItr][:] = np.cumsum(np.cumsum(inputVol[volItr], 1), 0)
+
+    return inputVol
+
+
+def searchAdjacentChannel(adjacentVolList, search_win, cInd, rInd, zInd):
+    """
+    Compiled version of SynapseDetection.searchAdjacentChannel
+
+    Parameters
+    ----------
+    adjaventVolList : list of numpy 3D volumes
+    search_win : ind - search window
+    cInd : ind
+    rInd : ind
+    zInd : ind
+
+    Returns
+    ----------
+    result : double - max signal in the 3D search region
+    """
+    adjacentTables = _asTables(adjacentVolList, None)
+    return _searchAdjacentChannel(adjacentTables, len(adjacentTables), search_win,
+                                  cInd, rInd, zInd)
+
+
+def searchColocalizeChannel(baseVolList, search_win, cInd, rInd, zInd):
+    """
+    Compiled version of SynapseDetection.searchColocalizeChannel
+
+    Parameters
+    ----------
+    baseVolList : list of volumes who's markers are supposed to colocalize with each other
+    search_win : ind - search window
+    cInd : ind
+    rInd : ind
+    zInd : ind
+
+    Returns
+    ----------
+    output : double - product of colocalization across channels
+    """
+    baseTables = _asTables(baseVolList, None)
+    return _searchColocalizeChannel(baseTables, len(baseTables), search_win,
+                                    cInd, rInd, zInd)
+
+
+def combinePrePostVolumes(baseVolList, adjacentVolList, edge_win, search_win, lookupTables=False):
+    """
+    Compiled version of SynapseDetection.combinePrePostVolumes
+
+    Parameters
+    ----------
+    baseVol : 3D numpy array
+    adjacentVolList : Adjacent volumes list. pass empty array if no
+                      adjacent synaptic volumes are present in the dataset
+    edge_win : int - edge to ignore
+    search_win - search_win must be even
+    lookupTables : bool - baseVolList[1:] and adjacentVolList are already
+        lookup tables (default False)
+
+    Returns
+    ----------
+    outputVol : 3D Numpy Array - Final Probability Map
+    """
+
+    if len(baseVolList) == 1 and len(adjacentVolList) == 0:
+        print('return input')
+        return baseVolList[0]
+
+    return _combinePrePostVolumes(baseVolList, adjacentVolList, [], edge_win, search_win,
+                                  lookupTables)
+
+
+def combinePrePostVolumes_astro(baseVolList, adjacentVolList, glialvolumes, edge_win, search_win):
+    """
+    Compiled version of SynapseDetection.combinePrePostVolumes_astro
+
+    Parameters
+    ----------
+    baseVol : 3D numpy array
+    adjacentVolList : Adjacent volumes list. pass empty array if no
+                      adjacent synaptic volumes are present in the dataset
+    glialvolumes : list of 3D numpy arrays
+    edge_win : int - edge to ignore
+    search_win - search_win must be even
+
+    Returns
+    ----------
+    outputVol : 3D Numpy Array - Final Probability Map
+    """
+    if len(adjacentVolList) == 0:
+        glialvolumes = []
+
+    return _combinePrePostVolumes(baseVolList, adjacentVolList, glialvolumes, edge_win, search_win)
+
+
+def _combinePrePostVolumes(baseVolList, adjacentVolList, glialvolumes, edge_win, search_win,
+                           lookupTables=False):
+    """
+    Shared driver for combinePrePostVolumes and combinePrePostVolumes_astro
+    """
+    # Allocate memory
+    outputVol = np.zeros(baseVolList[0].shape)
+
+    if not lookupTables:
+        # If there are multiple volumes associated with the same synaptic side
+        if len(baseVolList) > 1:
+            baseVolList[1:] = createLookupTables(baseVolList[1:])
+
+        # Create lookup tables
+        if len(adjacentVolList) > 0:
+            adjacentVolList = createLookupTables(adjacentVolList)
+        if len(glialvolumes) > 0:
+            glialvolumes = createLookupTables(glialvolumes)
+
+    baseTables = _asTables(baseVolList, None)
+    adjacentTables = _asTables(adjacentVolList, baseTables[0])
+    glialTables = _asTables(glialvolumes, baseTables[0])
+
+    return _combineVolumes(baseTables, len(baseVolList), adjacentTables, len(adjacentVolList),
+                           glialTables, len(glialvolumes), int(edge_win), search_win,
+                           outputVol)
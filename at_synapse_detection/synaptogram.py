@@ -529,11 +529,9 @@ def getImageRawCutoutFromFile(channelname, sliceInd, startX, startY, deltaX, del
     cutout: 2D numpy array
     """
 
-    folderpath = os.path.join(filepath, channelname)
-    img = da.imreadtiffSingleSlice(folderpath, sliceInd)
-    img.astype(np.float64)
+    vol = da.open_volume(filepath, channelname)
     #probimg = syn.getProbMap(img)
-    cutout = img[startY:(startY + deltaY), startX:(startX + deltaX)]
+    cutout = vol[startY:(startY + deltaY), startX:(startX + deltaX), sliceInd]
     return cutout
 
 
@@ -556,9 +554,8 @@ def getImageProbMapCutoutFromFile(channelname, sliceInd, startX, startY, deltaX,
     cutout: 2D numpy array
     """
 
-    folderpath = os.path.join(filepath, channelname)
-    img = da.imreadtiffSingleSlice(folderpath, sliceInd)
-    img.astype(np.float64)
+    # the probability map needs the statistics of the whole slice
+    img = da.open_volume(filepath, channelname)[:, :, sliceInd]
 
     probimg = syn.getProbMap(img)
     cutout = probimg[startY:(startY + deltaY), startX:(startX + deltaX)]
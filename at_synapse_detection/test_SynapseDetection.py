@@ -0,0 +1,253 @@
+import numpy as np
+from scipy import signal
+from scipy import stats
+from at_synapse_detection import SynapseDetection as syn
+
+
+def prob_map_loop(data):
+    # getProbMap before the row block rewrite
+    for zInd in range(0, data.shape[2]):
+        data[:, :, zInd] = stats.norm.cdf(
+            data[:, :, zInd], np.mean(data[:, :, zInd]), np.std(data[:, :, zInd]))
+    return data
+
+
+def prob_map_rayleigh_loop(data):
+    # getProbMap_rayleigh before the row block rewrite
+    for zInd in range(0, data.shape[2]):
+        phat = np.sqrt(0.5 * np.mean(np.power(data[:, :, zInd], 2)))
+        data[:, :, zInd] = 1 - np.exp(-1 * np.power(data[:, :, zInd], 2) / (2 * np.power(phat, 2)))
+    return data
+
+
+def make_channel(seed):
+    rng = np.random.RandomState(seed)
+    vol = rng.gamma(2.0, 100.0, size=(150, 37, 5))
+    # no spread in this slice, the probabilities are undefined
+    vol[:, :, 3] = 0
+    return vol
+
+
+def test_slice_statistics():
+    vol = make_channel(4)
+    means, stds = syn.getSliceStatistics(vol)
+    assert np.allclose(means, vol.mean(axis=(0, 1)), rtol=1e-14, atol=0)
+    assert np.allclose(stds, vol.std(axis=(0, 1)), rtol=1e-12, atol=0)
+    assert stds[3] == 0
+
+
+def test_prob_maps_match_slice_loops():
+    vol = make_channel(5)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = prob_map_loop(vol.copy())
+        expected_rayleigh = prob_map_rayleigh_loop(vol.copy())
+        assert np.all(np.isnan(expected[:, :, 3]))
+        assert np.all(np.isnan(expected_rayleigh[:, :, 3]))
+
+        for numThreads in [1, 4]:
+            result = syn.getProbMap(vol.copy(), numThreads=numThreads)
+            assert np.array_equal(np.isnan(result), np.isnan(expected))
+            assert np.allclose(result, expected, rtol=0, atol=1e-14, equal_nan=True)
+
+            result = syn.getProbMap_rayleigh(vol.copy(), numThreads=numThreads)
+            assert np.array_equal(np.isnan(result), np.isnan(expected_rayleigh))
+            assert np.allclose(result, expected_rayleigh, rtol=0, atol=1e-14, equal_nan=True)
+
+            # a read only input, e.g. a shared memory volume, gets a new array
+            readOnly = vol.copy()
+            readOnly.flags.writeable = False
+            result = syn.getProbMap(readOnly, numThreads=numThreads)
+            assert not np.shares_memory(result, readOnly)
+            assert np.array_equal(readOnly, vol)
+            assert np.allclose(result, expected, rtol=0, atol=1e-14, equal_nan=True)
+
+            out = np.empty_like(vol)
+            data = vol.copy()
+            assert syn.getProbMap(data, numThreads=numThreads, out=out) is out
+            assert np.array_equal(data, vol)
+            assert np.allclose(out, expected, rtol=0, atol=1e-14, equal_nan=True)
+
+
+def convolve_volume_loop(vol, kernelLength):
+    # convolveVolume before the running sum box filter
+    vol = np.log(vol)
+    kernel = np.ones([kernelLength, kernelLength])
+    for n in range(0, vol.shape[2]):
+        img = vol[:, :, n]
+        if (kernelLength % 2 == 0):
+            img = signal.convolve2d(img, kernel, 'full')
+            start = int(kernelLength / 2)
+            vol[:, :, n] = img[start:int(img.shape[0] - kernelLength / 2 + 1),
+                               start:int(img.shape[1] - kernelLength / 2 + 1)]
+        else:
+            vol[:, :, n] = signal.convolve2d(img, kernel, 'same')
+
+    return np.exp(vol / kernel.size)
+
+
+def test_convolve_volume_matches_convolve2d():
+    rng = np.random.RandomState(0)
+    vol = rng.uniform(0.01, 1, size=(23, 17, 3))
+    # zero probabilities give -inf in log space
+    vol[5, 6, 0] = 0
+    vol[20:, 0:3, 2] = 0
+
+    for kernelLength in [1, 2, 3, 4, 5]:
+        expected = convolve_volume_loop(vol.copy(), kernelLength)
+        for inplace in [False, True]:
+            result = syn.convolveVolume(vol.copy(), kernelLength, inplace=inplace)
+            assert np.array_equal(result == 0, expected == 0)
+            assert np.allclose(result, expected, rtol=0, atol=1e-12)
+
+
+def compute_factor_loop(vol, numslices):
+    # computeFactor before the span generalisation, numslices 2 or 3
+    factorVol = np.ones(vol.shape)
+    if (numslices == 1):
+        return factorVol
+
+    for n in range(0, vol.shape[2]):
+        if n == 0:
+            diff = np.exp(-1 * (np.power((vol[:, :, n] - vol[:, :, n + 1]), 2)))
+        elif n == (vol.shape[2] - 1):
+            diff = np.exp(-1 * (np.power((vol[:, :, n] - vol[:, :, n - 1]), 2)))
+        else:
+            if (numslices == 3):
+                diff = np.exp((-1 * (np.power((vol[:, :, n] - vol[:, :, n + 1]), 2) +
+                                     np.power((vol[:, :, n] - vol[:, :, n - 1]), 2))))
+            elif (numslices == 2):
+                diff = np.exp(-1 * (np.power((vol[:, :, n] - vol[:, :, n + 1]), 2)))
+        factorVol[:, :, n] = diff
+
+    return factorVol
+
+
+def test_compute_factor_matches_loop():
+    rng = np.random.RandomState(1)
+    vol = rng.uniform(0, 1, size=(11, 9, 5))
+
+    for numslices in [1, 2, 3]:
+        expected = compute_factor_loop(vol, numslices)
+        for numThreads in [1, 3]:
+            result = syn.computeFactor(vol, numslices, numThreads=numThreads)
+            assert np.allclose(result, expected, rtol=0, atol=1e-15)
+
+    two_slices = vol[:, :, :2]
+    for numslices in [2, 3]:
+        assert np.allclose(syn.computeFactor(two_slices, numslices),
+                           compute_factor_loop(two_slices, numslices), rtol=0, atol=1e-15)
+
+
+def test_compute_factor_wide_spans():
+    assert syn.getFactorOffsets(2) == [1]
+    assert syn.getFactorOffsets(3) == [1, -1]
+    assert syn.getFactorOffsets(4) == [1, -1, 2]
+    assert syn.getFactorOffsets(5) == [1, -1, 2, -2]
+    assert syn.getFactorOffsets(6) == [1, -1, 2, -2, 3]
+
+    rng = np.random.RandomState(2)
+    vol = rng.uniform(0, 1, size=(6, 5, 3))
+    v = [vol[:, :, n] for n in range(0, 3)]
+
+    def sq(a, b):
+        return np.square(a - b)
+
+    # span 4 covers one slice before and two after, cut at the edges
+    expected = np.stack([np.exp(-(sq(v[0], v[1]) + sq(v[0], v[2]))),
+                         np.exp(-(sq(v[1], v[2]) + sq(v[1], v[0]))),
+                         np.exp(-sq(v[2], v[1]))], axis=2)
+    assert np.allclose(syn.computeFactor(vol, 4), expected, rtol=0, atol=1e-15)
+
+    # spans 5 and 6 reach every other slice of a three slice stack, the
+    # offsets of 3 are left out
+    expected = np.stack([np.exp(-(sq(v[0], v[1]) + sq(v[0], v[2]))),
+                         np.exp(-(sq(v[1], v[2]) + sq(v[1], v[0]))),
+                         np.exp(-(sq(v[2], v[1]) + sq(v[2], v[0])))], axis=2)
+    for numslices in [5, 6]:
+        assert np.allclose(syn.computeFactor(vol, numslices), expected, rtol=0, atol=1e-15)
+
+    # a single slice has nothing to compare against
+    assert np.array_equal(syn.computeFactor(vol[:, :, :1], 5), np.ones((6, 5, 1)))
+
+
+def test_float32_precision_deviation():
+    rng = np.random.RandomState(3)
+    channels = {name: rng.gamma(2.0, 100.0, size=(40, 40, 6)) for name in ['a', 'b', 'c']}
+    queries = [{'preIF': ['a', 'c'], 'preIF_z': [2, 3], 'postIF': ['b'], 'postIF_z': [2]},
+               {'preIF': ['a'], 'preIF_z': [2], 'postIF': ['b'], 'postIF_z': [3],
+                'punctumSize': 3}]
+    original = {name: np.copy(vol) for name, vol in channels.items()}
+
+    for query in queries:
+        volumes = {'presynaptic': [channels[name] for name in query['preIF']],
+                   'postsynaptic': [channels[name] for name in query['postIF']]}
+        results = {}
+        for precision in ['float64', 'float32']:
+            copies = {key: [np.copy(vol) for vol in volumes[key]] for key in volumes.keys()}
+            results[precision] = syn.getSynapseDetections(copies, dict(query, precision=precision))
+        # float32 runs on the cast channels and the shared work buffer
+        assert results['float64'].dtype == np.float64
+        assert results['float32'].dtype == np.float32
+
+        expected = np.max(np.abs(results['float32'].astype(np.float64) - results['float64']))
+        deviation = syn.getPrecisionDeviation(volumes, query)
+        assert deviation == expected
+        # the probabilities are in [0, 1], float32 keeps them to about 1e-7
+        assert deviation < 1e-5
+
+    # getPrecisionDeviation runs on copies of the channels
+    assert all(np.array_equal(channels[name], original[name]) for name in channels)
+
+
+def test_tiled_detections_match_untiled():
+    rng = np.random.RandomState(6)
+    shape = (30, 26, 6)
+    channels = [rng.gamma(2.0, 100.0, size=shape) for n in range(0, 3)]
+    queries = [{'preIF': ['a'], 'preIF_z': [2], 'postIF': ['b'], 'postIF_z': [2]},
+               {'preIF': ['a', 'c'], 'preIF_z': [1, 3], 'postIF': ['b'], 'postIF_z': [2],
+                'punctumSize': 3},
+               {'preIF': ['c'], 'preIF_z': [3], 'postIF': [], 'postIF_z': [],
+                'punctumSize': 2}]
+
+    for query in queries:
+        query['backend'] = 'numpy'
+        volumes = {'presynaptic': [channels[n] for n in range(0, len(query['preIF']))],
+                   'postsynaptic': [channels[2] for name in query['postIF']]}
+        originals = {key: [np.copy(vol) for vol in volumes[key]] for key in volumes}
+        expected = syn.getSynapseDetections(
+            {key: [np.copy(vol) for vol in volumes[key]] for key in volumes}, dict(query))
+        assert np.count_nonzero(expected) > 0
+
+        blobsize = query.get('punctumSize', 2)
+        halo = syn.getTileHalo(blobsize, int(np.ceil(blobsize * 1.5)),
+                               max(query['preIF_z'] + query['postIF_z']))
+        # a budget of about four tiles in x,y, below the smallest xy tile
+        # of the larger halo, which then splits z instead
+        budget = 8 * 7 * shape[2] * (shape[0] / 2 + 2 * halo[0]) ** 2 / 1e9
+        budgetShape = syn.getTileShape(shape, 3, halo, budget)
+        assert len(syn.getTiles(shape, budgetShape, halo)) > 1
+
+        # xy tiles, a z split, tiles smaller than the halo
+        for tileShape in [(13, 11, 6), (30, 26, 2), (3, 4, 1), None]:
+            result = syn.getSynapseDetectionsTiled(volumes, query, memory_budget_gb=budget,
+                                                   tileShape=tileShape)
+            assert np.allclose(result, expected, rtol=0, atol=1e-12)
+
+        for key in volumes:
+            assert all(np.array_equal(vol, original)
+                       for vol, original in zip(volumes[key], originals[key]))
+
+
+def test_tiles_cover_the_volume_once():
+    shape = (17, 9, 5)
+    halo = (4, 2)
+    for tileShape in [(5, 4, 2), (17, 9, 5), (2, 2, 1)]:
+        count = np.zeros(shape, dtype=np.int64)
+        for readInds, writeInds, cropInds in syn.getTiles(shape, tileShape, halo):
+            count[writeInds] += 1
+            padded = np.zeros(shape)[readInds]
+            assert padded[cropInds].shape == count[writeInds].shape
+            for axis, pad in zip(range(0, 3), [halo[0], halo[0], halo[1]]):
+                assert writeInds[axis].start - readInds[axis].start == \
+                    min(pad, writeInds[axis].start)
+        assert np.all(count == 1)
@@ -0,0 +1,37 @@
+import numpy as np
+from shapely import geometry
+from at_synapse_detection import annotationBounds
+from at_synapse_detection.test_annotationOverlap import make_annotations
+
+
+def is_annotation_near_edge(al, ann_minX, ann_maxX, ann_minY, ann_maxY, ann_minZ, ann_maxZ,
+                            distance, min_edge_sections):
+    boundary = geometry.Polygon([[ann_minX, ann_minY], [ann_minX, ann_maxY],
+                                 [ann_maxX, ann_maxY], [ann_maxX, ann_minY]])
+    b2 = boundary.buffer(-distance)
+    for area in al['areas']:
+        if not b2.contains(geometry.Polygon(area['global_path'])):
+            return True
+    zvals = np.unique([area['z'] for area in al['areas']])
+    return len(zvals) < min_edge_sections and (ann_minZ in zvals or ann_maxZ in zvals)
+
+
+def test_edge_annotations_match_polygon_tests():
+    annotations = make_annotations(300, 2)
+    # degenerate areas and an annotation without areas
+    annotations[0]['areas'][0]['global_path'] = [[500, 500], [520, 500], [500, 500]]
+    annotations[1]['areas'][0]['global_path'] = [[100, 500], [120, 500], [100, 500]]
+    annotations.append({'areas': [], 'oid': 'empty', 'id': 300})
+
+    area_bounds = annotationBounds.get_area_bounds(annotations)
+    bounds = annotationBounds.get_annotation_bounds(area_bounds, len(annotations))
+    assert np.isclose(bounds['maxX'][5], np.max([np.max(np.array(area['global_path'])[:, 0])
+                                                 for area in annotations[5]['areas']]))
+    assert np.isnan(bounds['minX'][300])
+
+    for distance, min_edge_sections in [(100, 4), (30, 2), (600, 4)]:
+        args = (0, 1000, 0, 1000, 1, 4, distance, min_edge_sections)
+        expected = [is_annotation_near_edge(al, *args) for al in annotations]
+        is_edge = annotationBounds.get_edge_annotations(annotations, *args[:6], distance=distance,
+                                                        min_edge_sections=min_edge_sections)
+        assert np.array_equal(is_edge, expected)
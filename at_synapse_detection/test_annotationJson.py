@@ -0,0 +1,68 @@
+import json
+import numpy as np
+import pytest
+from at_synapse_detection import annotationJson
+from at_synapse_detection import annotationTable as at
+from at_synapse_detection.test_annotationOverlap import make_annotations
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_write_read_round_trip(tmpdir, monkeypatch, use_orjson):
+    if use_orjson and not annotationJson.ORJSON_AVAILABLE:
+        pytest.skip('orjson is not installed')
+    monkeypatch.setattr(annotationJson, 'ORJSON_AVAILABLE', use_orjson)
+    annotations = make_annotations(40, 6)
+    annotations.append({'areas': [], 'oid': 'empty', 'id': 40})
+    fn = str(tmpdir.join('annotations.json'))
+
+    table = at.AnnotationTable.from_area_lists(annotations)
+    assert annotationJson.write_annotation_file(fn, table) == 41
+    with open(fn) as f:
+        assert json.load(f) == {'area_lists': annotations}
+
+    read_table = annotationJson.read_annotation_file(fn, validate='basic')
+    assert read_table.to_area_lists() == annotations
+
+    # numpy paths written one detection at a time
+    with annotationJson.AnnotationWriter(fn) as writer:
+        for al in annotations:
+            writer.write({'oid': al['oid'], 'id': np.int64(al['id']),
+                          'areas': [{'z': np.float64(area['z']),
+                                     'global_path': np.array(area['global_path'])}
+                                    for area in al['areas']]})
+    assert annotationJson.read_annotation_file(fn).to_area_lists() == annotations
+
+
+def test_basic_validation(tmpdir):
+    fn = str(tmpdir.join('annotations.json'))
+    bad_files = [{'area_lists': [{'id': 'a', 'areas': []}]},
+                 {'area_lists': [{'id': 1, 'areas': [{'z': 0, 'global_path': [[0, 0, 0]]}]}]},
+                 {'area_lists': [{'id': 1, 'areas': [{'z': 0, 'global_path': [[0, 0], [1]]}]}]}]
+    for annotation_d in bad_files:
+        with open(fn, 'w') as f:
+            json.dump(annotation_d, f)
+        with pytest.raises(ValueError):
+            annotationJson.read_annotation_file(fn, validate='basic')
+    with pytest.raises(ValueError):
+        annotationJson.read_annotation_file(fn, validate='everything')
+
+
+def test_failed_write_leaves_no_file(tmpdir):
+    fn = str(tmpdir.join('annotations.json'))
+    annotations = make_annotations(10, 7)
+    with pytest.raises(RuntimeError):
+        with annotationJson.AnnotationWriter(fn) as writer:
+            for ind, al in enumerate(annotations):
+                if ind == 5:
+                    raise RuntimeError('detection failed')
+                writer.write(al)
+    assert tmpdir.listdir() == []
+
+    # an existing complete file is not replaced by a failed write
+    annotationJson.write_annotation_file(fn, annotations)
+    with pytest.raises(RuntimeError):
+        with annotationJson.AnnotationWriter(fn) as writer:
+            writer.write(annotations[0])
+            raise RuntimeError('detection failed')
+    assert [path.basename for path in tmpdir.listdir()] == ['annotations.json']
+    assert annotationJson.read_annotation_file(fn).to_area_lists() == annotations
@@ -0,0 +1,45 @@
+import numpy as np
+from shapely import geometry
+from at_synapse_detection import annotationOverlap
+
+
+def make_annotations(num_annotations, seed):
+    rng = np.random.RandomState(seed)
+    annotations = []
+    for ind in range(0, num_annotations):
+        x, y = rng.uniform(0, 1000, size=2)
+        z = rng.randint(0, 5)
+        areas = []
+        for dz in range(0, rng.randint(1, 3)):
+            w, h = rng.uniform(5, 40, size=2)
+            path = [[x, y], [x + w, y], [x + w, y + h], [x, y + h], [x, y]]
+            areas.append({'z': float(z + dz), 'global_path': path})
+        annotations.append({'areas': areas, 'oid': str(ind), 'id': ind})
+    return annotations
+
+
+def do_annotations_overlap(al1, al2):
+    for area2 in al2['areas']:
+        for area1 in al1['areas']:
+            if int(area1['z']) == int(area2['z']) and \
+                    geometry.Polygon(area1['global_path']).intersects(
+                        geometry.Polygon(area2['global_path'])):
+                return True
+    return False
+
+
+def test_overlap_matrix_matches_pairwise_tests():
+    annotations1 = make_annotations(120, 0)
+    annotations2 = make_annotations(150, 1)
+
+    expected = np.array([[do_annotations_overlap(al2, al1) for al2 in annotations2]
+                         for al1 in annotations1])
+    assert np.any(expected)
+
+    geometries1 = annotationOverlap.AnnotationGeometries(annotations1)
+    for num_threads in [1, 3]:
+        overlap_matrix = annotationOverlap.compute_overlap_matrix(
+            geometries1, annotations2, num_threads)
+        assert np.array_equal(overlap_matrix, expected)
+
+    assert annotationOverlap.compute_overlap_matrix([], annotations2).shape == (0, 150)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from at_synapse_detection import annotationTable as at
+from at_synapse_detection import annotationBounds
+from at_synapse_detection import annotationOverlap
+from at_synapse_detection.test_annotationOverlap import make_annotations
+
+
+def test_table_round_trip_and_views():
+    annotations = make_annotations(50, 3)
+    annotations.append({'areas': [], 'oid': 'empty', 'id': 50})
+    table = at.AnnotationTable.from_area_lists(annotations)
+
+    assert len(table) == 51
+    assert table.num_areas == sum(len(al['areas']) for al in annotations)
+    assert table.to_area_lists() == annotations
+    assert table.to_json_dict() == {'area_lists': annotations}
+
+    al = table[7]
+    assert al['oid'] == '7' and len(al['areas']) == len(annotations[7]['areas'])
+    assert np.shares_memory(al['areas'][0]['global_path'], table.coords)
+    assert [al['id'] for al in table] == list(range(0, 51))
+
+    selected = table.select(table.ids % 3 == 0)
+    assert selected.to_area_lists() == annotations[::3]
+    both = at.AnnotationTable.concatenate([selected, table.select([1, 2])])
+    assert both.to_area_lists() == annotations[::3] + annotations[1:3]
+
+
+def test_table_matches_list_evaluation():
+    annotations1 = make_annotations(200, 4)
+    annotations2 = make_annotations(200, 5)
+    table1 = at.AnnotationTable.from_area_lists(annotations1)
+    table2 = at.AnnotationTable.from_area_lists(annotations2)
+
+    assert table1.area_bounds().equals(annotationBounds.get_area_bounds(annotations1))
+    args = (0, 1000, 0, 1000, 1, 4)
+    assert np.array_equal(annotationBounds.get_edge_annotations(table1, *args),
+                          annotationBounds.get_edge_annotations(annotations1, *args))
+    assert np.array_equal(annotationOverlap.compute_overlap_matrix(table1, table2),
+                          annotationOverlap.compute_overlap_matrix(annotations1, annotations2))
+
+
+def test_list_and_array_paths_give_the_same_table():
+    annotations = make_annotations(30, 8)
+    annotations.append({'id': 30, 'areas': [{'global_path': [[1.0, 2.0], [3.0, 4.0]]}]})
+    array_annotations = [{'oid': al.get('oid'), 'id': al['id'],
+                          'areas': [dict(area, global_path=np.array(area['global_path']))
+                                    for area in al['areas']]}
+                         for al in annotations]
+
+    table = at.AnnotationTable.from_area_lists(annotations, validate='basic')
+    array_table = at.AnnotationTable.from_area_lists(array_annotations, validate='basic')
+    for name in ['coords', 'area_offsets', 'annotation_offsets', 'ids']:
+        assert np.array_equal(getattr(table, name), getattr(array_table, name))
+    # an area without a z is kept with a NaN z
+    assert np.array_equal(table.area_z, array_table.area_z, equal_nan=True)
+    assert np.isnan(table.area_z[-1]) and np.all(np.isfinite(table.area_z[:-1]))
+
+    for paths in [[[0, 0, 0]], np.zeros((1, 3)), [[0, 0], [1]]]:
+        with pytest.raises(ValueError):
+            at.AnnotationTable.from_area_lists([{'id': 0, 'areas': [{'global_path': paths}]}])
+    with pytest.raises(ValueError):
+        at.AnnotationTable.from_area_lists([{'id': 'a', 'areas': []}], validate='basic')
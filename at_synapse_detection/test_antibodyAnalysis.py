@@ -0,0 +1,25 @@
+import numpy as np
+from at_synapse_detection import antibodyAnalysis as aa
+from at_synapse_detection import SynapseDetection as syn
+
+
+def test_compute_snr_matches_masked_statistics():
+    rng = np.random.RandomState(0)
+    raw = rng.gamma(2.0, 500.0, size=(70, 60, 5))
+    raw[rng.rand(*raw.shape) < 0.05] = 0
+    processed = rng.rand(*raw.shape)
+
+    values = raw[(processed > 0.8) & (raw != 0)]
+    signal_mean, signal_std = aa.compute_SNR(raw, processed, 0.8, rowBlockSize=16)
+    assert np.isclose(signal_mean, np.mean(values))
+    assert np.isclose(signal_std, np.std(values))
+    assert np.isnan(aa.compute_SNR(raw, processed, 1.0)[0])
+
+
+def test_process_keeps_input():
+    raw = np.random.RandomState(1).gamma(2.0, 500.0, size=(30, 30, 4))
+    vol = np.copy(raw)
+    expected = syn.processSynapticVolume(np.copy(raw), 2, 2)
+    result = syn.processSynapticVolume(vol, 2, 2, keepInput=True)
+    assert np.array_equal(vol, raw)
+    assert np.allclose(result, expected)
@@ -0,0 +1,88 @@
+import numpy as np
+import tifffile
+from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import batchRunner as br
+
+
+def make_region(tmpdir, region_name, seed):
+    rng = np.random.RandomState(seed)
+    region_dir = tmpdir.mkdir(region_name)
+    # puncta at the same place in every channel
+    puncta = [(rng.randint(0, 3), rng.randint(6, 32), rng.randint(6, 28)) for n in range(0, 15)]
+    for channel in ['a.tif', 'b.tif', 'c.tif']:
+        stack = rng.gamma(2.0, 500.0, size=(4, 40, 36))
+        for z, r, c in puncta:
+            stack[z:z + 2, r:r + 3, c:c + 3] += 20000
+        stack = stack.astype(np.uint16)
+        tifffile.imwrite(str(region_dir.join(channel)), stack, photometric='minisblack')
+
+    dapi_dir = tmpdir.mkdir('dapi_' + region_name)
+    dapi_mask = (rng.rand(4, 40, 36) < 0.1).astype(np.uint8)
+    tifffile.imwrite(str(dapi_dir.join('1ss-DAPI-mask.tiff')), dapi_mask,
+                     photometric='minisblack')
+
+    return str(region_dir), str(dapi_dir)
+
+
+def test_batch_runner_matches_run_synapse_detection(tmpdir):
+    queries = [{'preIF': ['a.tif'], 'preIF_z': [2], 'postIF': ['b.tif'], 'postIF_z': [2],
+                'backend': 'numpy'},
+               {'preIF': ['c.tif'], 'preIF_z': [1], 'postIF': ['b.tif'], 'postIF_z': [2],
+                'backend': 'numpy'}]
+
+    atet_inputs_list = []
+    for region_num in range(0, 3):
+        region_name = 'F00' + str(region_num)
+        data_region_location, dapi_mask_str = make_region(tmpdir, region_name, region_num)
+        for nQuery, query in enumerate(queries):
+            atet_inputs_list.append({
+                'query': query, 'queryID': len(atet_inputs_list), 'nQuery': nQuery,
+                'resolution': {'res_xy_nm': 100, 'res_z_nm': 70},
+                'data_region_location': data_region_location, 'data_location': str(tmpdir),
+                'output_foldername': 'results', 'region_name': region_name, 'mask_str': -1,
+                'dapi_mask_str': dapi_mask_str, 'mouse_number': 1})
+
+    expected = [sa.run_synapse_detection(atet_input) for atet_input in atet_inputs_list]
+    assert any(result['queryresult'].num_synapses > 0 for result in expected)
+
+    with br.BatchRunner(num_workers=2, max_loaded_regions=2) as runner:
+        for queries_per_task in [1, 2]:
+            result_list = runner.map_synapse_detection(atet_inputs_list,
+                                                       queries_per_task=queries_per_task)
+
+            for result, expected_result in zip(result_list, expected):
+                assert result['queryID'] == expected_result['queryID']
+                assert result['queryresult'].num_synapses == \
+                    expected_result['queryresult'].num_synapses
+                assert result['queryresult'].volume_um3 == \
+                    expected_result['queryresult'].volume_um3
+
+
+def test_tasks_leave_shared_volumes_unchanged(tmpdir):
+    data_region_location, dapi_mask_str = make_region(tmpdir, 'F000', 0)
+    queries = [{'preIF': ['a.tif'], 'preIF_z': [2], 'postIF': ['b.tif'], 'postIF_z': [2],
+                'backend': 'numpy'},
+               {'preIF': ['c.tif'], 'preIF_z': [1], 'postIF': ['b.tif'], 'postIF_z': [2],
+                'backend': 'numpy', 'precision': 'float32'}]
+    atet_inputs_list = [{'query': query, 'queryID': n, 'nQuery': n,
+                         'resolution': {'res_xy_nm': 100, 'res_z_nm': 70},
+                         'data_region_location': data_region_location,
+                         'data_location': str(tmpdir), 'output_foldername': 'results',
+                         'region_name': 'F000', 'mask_str': -1,
+                         'dapi_mask_str': dapi_mask_str, 'mouse_number': 1}
+                        for n, query in enumerate(queries)]
+
+    region, blocks = br.load_region(atet_inputs_list)
+    try:
+        before = {channel: np.array(br.attach_volume(descriptor))
+                  for channel, descriptor in region['volumes'].items()}
+        # a single query and the query planner
+        br.run_region_queries(atet_inputs_list[:1], region)
+        br.run_region_queries(atet_inputs_list[1:], region)
+        br.run_region_queries(atet_inputs_list[:1] * 2, region)
+
+        for channel, descriptor in region['volumes'].items():
+            assert np.array_equal(br.attach_volume(descriptor), before[channel])
+    finally:
+        br.release_attached()
+        br.release_blocks(blocks)
@@ -0,0 +1,21 @@
+import numpy as np
+from skimage import measure
+from at_synapse_detection import componentStats as cs
+
+
+def test_component_table_matches_regionprops():
+    rng = np.random.RandomState(0)
+    intensity = rng.rand(40, 35, 6)
+    mask = intensity > 0.7
+
+    table = cs.measure_components(mask, intensity)
+    stats = measure.regionprops(measure.label(mask), intensity)
+    assert len(table) == len(stats)
+    assert np.array_equal(table['label'], [stat.label for stat in stats])
+    assert np.array_equal(table['area'], [stat.area for stat in stats])
+    bbox_columns = ['min_row', 'min_col', 'min_z', 'max_row', 'max_col', 'max_z']
+    assert np.array_equal(table[bbox_columns].values, [stat.bbox for stat in stats])
+    assert np.allclose(table['mean_intensity'], [stat.intensity_mean for stat in stats])
+
+    empty = cs.measure_components(np.zeros((5, 5, 2), dtype=bool))
+    assert len(empty) == 0 and 'max_z' in empty.columns
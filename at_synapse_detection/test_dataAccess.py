@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+import tifffile
+from PIL import Image
+from at_synapse_detection import dataAccess as da
+
+
+def test_tiff_volume_matches_imreadtiff(tmpdir):
+    stack = (np.random.RandomState(0).rand(4, 30, 20) * 5000).astype(np.uint16)
+    tifffile.imwrite(str(tmpdir.join('contiguous.tif')), stack, photometric='minisblack')
+    pages = [Image.fromarray(page) for page in stack]
+    pages[0].save(str(tmpdir.join('pages.tif')), save_all=True, append_images=pages[1:])
+    pages[0].save(str(tmpdir.join('lzw.tif')), save_all=True, append_images=pages[1:],
+                  compression='tiff_lzw')
+
+    for name in ['contiguous.tif', 'pages.tif', 'lzw.tif']:
+        fn = str(tmpdir.join(name))
+        vol = da.TiffVolume(fn)
+        expected = da.imreadtiff(fn)
+        assert vol.shape == expected.shape
+        assert vol.dtype == np.uint16
+        assert np.array_equal(vol[3:17, 5:9, 2], expected[3:17, 5:9, 2])
+        assert np.array_equal(vol[:, 2:18:3, 1:3], expected[:, 2:18:3, 1:3])
+        assert np.array_equal(vol.astype(np.float64), expected)
+
+
+def test_h5_store_matches_tiffs(tmpdir):
+    pytest.importorskip('h5py')
+    stack = (np.random.RandomState(1).rand(5, 30, 20) * 5000).astype(np.uint16)
+    tifffile.imwrite(str(tmpdir.join('a.tif')), stack, photometric='minisblack')
+    h5_fn = da.convert_tiffs_to_h5(str(tmpdir), ['a.tif'], str(tmpdir.join('region.h5')))
+
+    query = {'preIF': ['a.tif'], 'preIF_z': [2], 'postIF': [], 'postIF_z': []}
+    expected = da.load_tiff_from_query(query, str(tmpdir))['presynaptic'][0]
+    assert np.array_equal(da.load_tiff_from_query(query, h5_fn)['presynaptic'][0], expected)
+    assert np.array_equal(da.getImageCutoutFromFile('a.tif', 3, 4, 2, 10, 12, h5_fn),
+                          expected[2:14, 4:14, 3])
+
+
+def test_detection_from_h5_store(tmpdir):
+    pytest.importorskip('h5py')
+    from at_synapse_detection import SynapseAnalysis as sa
+    from at_synapse_detection import batchRunner as br
+    from at_synapse_detection.test_batchRunner import make_region
+
+    data_region_location, dapi_mask_str = make_region(tmpdir, 'F000', 0)
+    h5_fn = da.convert_tiffs_to_h5(data_region_location, ['a.tif', 'b.tif'],
+                                   str(tmpdir.join('F000.h5')))
+    query = {'preIF': ['a.tif'], 'preIF_z': [2], 'postIF': ['b.tif'], 'postIF_z': [2],
+             'backend': 'numpy'}
+    atet_input = {'query': query, 'queryID': 0, 'nQuery': 0,
+                  'resolution': {'res_xy_nm': 100, 'res_z_nm': 70},
+                  'data_region_location': data_region_location, 'data_location': str(tmpdir),
+                  'output_foldername': 'results', 'region_name': 'F000', 'mask_str': -1,
+                  'dapi_mask_str': dapi_mask_str, 'mouse_number': 1}
+    expected = sa.run_synapse_detection(dict(atet_input))['queryresult']
+
+    h5_input = dict(atet_input, data_region_location=h5_fn, output_foldername='results_h5')
+    result = sa.run_synapse_detection(h5_input)['queryresult']
+    assert result.num_synapses == expected.num_synapses > 0
+    assert result.volume_um3 == expected.volume_um3
+
+    with br.BatchRunner(num_workers=1) as runner:
+        result = runner.map_synapse_detection([h5_input])[0]['queryresult']
+    assert result.num_synapses == expected.num_synapses
+
+    region_input = {key: value for key, value in h5_input.items()
+                    if key not in ['query', 'nQuery']}
+    result = sa.run_synapse_detection_region(region_input, [query])[0]['queryresult']
+    assert result.num_synapses == expected.num_synapses
+    assert result.volume_um3 == expected.volume_um3
+
+
+def write_channels(tmpdir):
+    rng = np.random.RandomState(2)
+    names = ['a.tif', 'b.tif', 'c.tif', 'g.tif']
+    for name in names:
+        stack = (rng.rand(6, 25, 18) * 5000).astype(np.uint16)
+        tifffile.imwrite(str(tmpdir.join(name)), stack, photometric='minisblack')
+
+        series_dir = tmpdir.mkdir(name[0] + '_series')
+        for n, page in enumerate(stack):
+            Image.fromarray(page).save(str(series_dir.join(str(n).zfill(5) + '.tiff')))
+
+    return names
+
+
+def test_threaded_loaders_match_sequential_reads(tmpdir):
+    write_channels(tmpdir)
+    base_dir = str(tmpdir)
+    query = {'preIF': ['c.tif', 'a.tif', 'c.tif'], 'preIF_z': [2, 1, 3],
+             'postIF': ['b.tif'], 'postIF_z': [2], 'glialIF': ['g.tif', 'a.tif']}
+
+    def read_sequential(keys, dtype=np.float64):
+        return {key: [da.imreadtiff(str(tmpdir.join(name)), dtype) for name in query[name_key]]
+                for key, name_key in keys}
+
+    keys = [('presynaptic', 'preIF'), ('postsynaptic', 'postIF')]
+    astro_keys = keys + [('glialvolumes', 'glialIF')]
+    for num_threads in [1, 4]:
+        for loader, loader_keys in [(da.load_tiff_from_query, keys),
+                                    (da.load_tiff_from_astro_query, astro_keys)]:
+            for precision in ['float64', 'float32']:
+                expected = read_sequential(loader_keys, precision)
+                volumes = loader(dict(query, precision=precision), base_dir,
+                                 num_threads=num_threads)
+                assert list(volumes.keys()) == [key for key, name_key in loader_keys]
+                for key in volumes:
+                    assert len(volumes[key]) == len(expected[key])
+                    for vol, expected_vol in zip(volumes[key], expected[key]):
+                        assert vol.dtype == np.dtype(precision)
+                        assert np.array_equal(vol, expected_vol)
+
+
+def test_threaded_series_match_serial_reads(tmpdir):
+    write_channels(tmpdir)
+    query = {'preIF': ['c_series', 'a_series'], 'preIF_z': [2, 1],
+             'postIF': ['b_series'], 'postIF_z': [2]}
+
+    for name in ['a_series', 'b_series']:
+        folder = str(tmpdir.join(name))
+        serial = da.imreadtiffseries(folder, num_threads=1)
+        assert serial.shape == (25, 18, 6)
+        assert np.array_equal(serial, da.imreadtiff(str(tmpdir.join(name[0] + '.tif'))))
+        threaded = da.imreadtiffseries(folder, num_threads=4)
+        for n in range(0, serial.shape[2]):
+            assert np.array_equal(threaded[:, :, n], serial[:, :, n])
+            assert np.array_equal(threaded[:, :, n], da.imreadtiffSingleSlice(folder, n))
+
+    for num_threads in [1, 4]:
+        volumes = da.loadTiffSeriesFromQuery(query, str(tmpdir), num_threads=num_threads)
+        assert list(volumes.keys()) == ['presynaptic', 'postsynaptic']
+        for key, name_key in [('presynaptic', 'preIF'), ('postsynaptic', 'postIF')]:
+            assert len(volumes[key]) == len(query[name_key])
+            for vol, name in zip(volumes[key], query[name_key]):
+                expected = da.imreadtiffseries(str(tmpdir.join(name)), num_threads=1)
+                assert np.array_equal(vol, expected)
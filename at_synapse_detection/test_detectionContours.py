@@ -0,0 +1,64 @@
+import numpy as np
+import cv2
+from scipy import ndimage
+from skimage import measure
+from at_synapse_detection import detectionContours as dc
+
+
+def make_prop_into_contours(prop, ds_scale, lm_minX, lm_minY):
+    # processDetections.make_prop_into_contours before the batch extractor
+    coors = np.flip(np.copy(prop.coords[:, [2, 0, 1]]), 1)
+    areas = []
+    for z in np.unique(coors[:, 2]):
+        c2 = coors[coors[:, 2] == z]
+        mins = np.min(c2, axis=0)
+        maxs = np.max(c2, axis=0)
+        c2 = c2 - mins
+        width = maxs[0] - mins[0] + 1
+        height = maxs[1] - mins[1] + 1
+        min_img = np.zeros((height, width), np.uint8)
+        min_img[c2[:, 1], c2[:, 0]] = 255
+        min_img_up = cv2.resize(min_img, (2 * width, 2 * height))
+        cs = cv2.findContours(min_img_up, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        for c in cs:
+            c = np.squeeze(c)
+            c = .5 * (np.array(c, np.float64) + .5)
+            c[:, 0] += mins[0]
+            c[:, 1] += mins[1]
+            c = np.vstack((c, c[0, :]))
+            c = c / ds_scale
+            c[:, 0] = c[:, 0] + lm_minX
+            c[:, 1] = c[:, 1] + lm_minY
+            areas.append({'z': int(z), 'global_path': c.tolist()})
+    return {'areas': areas, 'oid': str(prop.label), 'id': int(prop.label)}
+
+
+def test_label_volume_contours_match_per_region_contours():
+    rng = np.random.RandomState(0)
+    probmap = ndimage.gaussian_filter(rng.uniform(size=(80, 70, 6)), (2, 2, 0.5))
+    mask = ndimage.binary_dilation(probmap > np.percentile(probmap, 85), np.ones((2, 2, 2)))
+    label_vol = measure.label(mask)
+
+    expected = [make_prop_into_contours(prop, 3 / 100, 5, 7)
+                for prop in measure.regionprops(label_vol)]
+    area_lists = dc.label_volume_to_contours(label_vol, 3 / 100, 5, 7)
+
+    assert len(area_lists) == label_vol.max()
+    assert area_lists == expected
+
+    prop = measure.regionprops(label_vol)[3]
+    area_list = dc.label_volume_to_contours(prop.image.astype(np.int32), 3 / 100, 5, 7,
+                                            offset=prop.bbox[:3])[0]
+    assert area_list['areas'] == expected[3]['areas']
+
+
+def test_chunked_contours_match_whole_volume():
+    rng = np.random.RandomState(2)
+    probmap = ndimage.gaussian_filter(rng.uniform(size=(90, 60, 5)), (2, 2, 0.5))
+    label_vol = measure.label(probmap > np.percentile(probmap, 80))
+    expected = dc.label_volume_to_contours(label_vol, 3 / 100, 5, 7)
+    assert len(expected) > 20
+
+    for labels_per_chunk in [1, 7, 1000]:
+        chunks = dc.iter_label_volume_contours(label_vol, 3 / 100, 5, 7, labels_per_chunk)
+        assert list(chunks) == expected
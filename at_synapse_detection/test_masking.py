@@ -0,0 +1,46 @@
+import copy
+import numpy as np
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import SynapseAnalysis as sa
+
+
+def make_masks(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    layer_mask = np.ones(shape[:2], dtype=np.uint8)
+    layer_mask[:, :shape[1] // 2] = 0
+    dapi_mask = (rng.rand(*shape) < 0.1).astype(np.uint8)
+    return layer_mask, dapi_mask
+
+
+def test_mask_volumes_in_place():
+    shape = (20, 18, 3)
+    layer_mask, dapi_mask = make_masks(shape)
+    combined_mask = sa.merge_DAPI_L4_masks(layer_mask, dapi_mask)
+    expected_mask = np.stack([layer_mask.astype(bool)] * shape[2], axis=2) & ~dapi_mask.astype(bool)
+    assert np.array_equal(combined_mask, expected_mask)
+
+    volume = np.random.RandomState(1).rand(*shape)
+    expected = volume * expected_mask
+    synaptic_volumes = sa.mask_synaptic_volumes({'presynaptic': [volume]}, combined_mask)
+    assert synaptic_volumes['presynaptic'][0] is volume
+    assert np.array_equal(volume, expected)
+
+
+def test_tiled_detections_with_mask():
+    shape = (80, 70, 4)
+    layer_mask, dapi_mask = make_masks(shape)
+    combined_mask = sa.merge_DAPI_L4_masks(layer_mask, dapi_mask)
+
+    rng = np.random.RandomState(2)
+    synaptic_volumes = {'presynaptic': [rng.gamma(2.0, 100.0, size=shape)],
+                        'postsynaptic': [rng.gamma(2.0, 100.0, size=shape)]}
+    query = {'preIF': ['a'], 'preIF_z': [2], 'postIF': ['b'], 'postIF_z': [2],
+             'punctumSize': 2, 'backend': 'numpy'}
+
+    masked_volumes = sa.mask_synaptic_volumes(copy.deepcopy(synaptic_volumes),
+                                              combined_mask)
+    expected = syn.getSynapseDetections(masked_volumes, query)
+    result = syn.getSynapseDetectionsTiled(synaptic_volumes, query, tileShape=(20, 20, 4),
+                                           mask=combined_mask)
+    assert np.allclose(result, expected, rtol=0, atol=1e-9)
+    assert np.count_nonzero(expected) > 0
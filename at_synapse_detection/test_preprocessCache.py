@@ -0,0 +1,64 @@
+import copy
+import numpy as np
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import preprocessCache as pc
+
+
+def test_cache_evicts_least_recently_used():
+    vol = np.zeros((10, 10, 10))
+    cache = pc.PreprocessCache(max_memory_gb=2.5 * vol.nbytes / 10**9)
+    for key in ['a', 'b', 'c']:
+        cache.put(key, vol)
+    assert list(cache.entries.keys()) == ['b', 'c']
+    assert cache.get('a') is None
+
+    cache.get('b')
+    cache.put('d', vol)
+    assert list(cache.entries.keys()) == ['b', 'd']
+
+
+def test_cache_reads_npy_store(tmpdir):
+    vol = np.random.RandomState(0).rand(8, 8, 3)
+    cache = pc.PreprocessCache(spill_dir=str(tmpdir))
+    cache.put('a', vol)
+
+    other = pc.PreprocessCache(spill_dir=str(tmpdir))
+    assert np.array_equal(other.get('a'), vol)
+
+
+def test_detections_with_cache(tmpdir):
+    rng = np.random.RandomState(0)
+    for name in ['pre.tif', 'post.tif']:
+        tmpdir.join(name).write('')
+    query = {'preIF': ['pre.tif'], 'preIF_z': [2], 'postIF': ['post.tif'], 'postIF_z': [3]}
+    volumes = {'presynaptic': [rng.gamma(2.0, 100.0, size=(30, 30, 5))],
+               'postsynaptic': [rng.gamma(2.0, 100.0, size=(30, 30, 5))]}
+
+    previous = pc.get_default_cache()
+    pc.set_default_cache(pc.PreprocessCache())
+    try:
+        sourceIds = pc.get_source_ids(query, str(tmpdir))
+        expected = syn.getSynapseDetections(copy.deepcopy(volumes), query)
+        first = syn.getSynapseDetections(copy.deepcopy(volumes), query, sourceIds=sourceIds)
+        second = syn.getSynapseDetections(copy.deepcopy(volumes), query, sourceIds=sourceIds)
+        assert pc.get_default_cache().hits == 2
+    finally:
+        pc.set_default_cache(previous)
+
+    assert np.array_equal(first, expected)
+    assert np.array_equal(second, expected)
+
+
+def test_cache_is_opt_in(tmpdir, monkeypatch):
+    monkeypatch.delenv('SYNAPSE_CACHE_GB', raising=False)
+    monkeypatch.delenv('SYNAPSE_CACHE_DIR', raising=False)
+    assert pc.cache_from_environment() is None
+
+    monkeypatch.setenv('SYNAPSE_CACHE_GB', '1.5')
+    assert pc.cache_from_environment().max_bytes == 1.5 * 10**9
+
+    monkeypatch.delenv('SYNAPSE_CACHE_GB')
+    monkeypatch.setenv('SYNAPSE_CACHE_DIR', str(tmpdir))
+    cache = pc.cache_from_environment()
+    assert cache.spill_dir == str(tmpdir)
+    assert cache.max_bytes == pc.DEFAULT_CACHE_GB * 10**9
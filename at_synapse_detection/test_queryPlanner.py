@@ -0,0 +1,45 @@
+import copy
+import numpy as np
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import queryPlanner as qp
+
+
+def test_shared_steps_run_once():
+    calls = []
+
+    def step(name):
+        def func(*inputs):
+            calls.append(name)
+            return np.ones(3) * len(calls)
+        return func
+
+    plan = qp.QueryPlan()
+    plan.add_step(('load',), step('load'))
+    plan.add_step(('a',), step('a'), [('load',)], inplace=True)
+    plan.add_step(('load',), step('load'))
+    plan.add_step(('b',), step('b'), [('load',)], output=True)
+    plan.add_step(('c',), step('c'), [('a',), ('load',)], output=True)
+
+    outputs = plan.execute()
+    assert calls == ['load', 'a', 'b', 'c']
+    assert sorted(outputs.keys()) == [('b',), ('c',)]
+
+
+def test_plan_matches_detections():
+    rng = np.random.RandomState(0)
+    channels = {name: rng.gamma(2.0, 100.0, size=(30, 30, 5)) for name in ['a', 'b', 'c']}
+    queries = [{'preIF': ['a'], 'preIF_z': [2], 'postIF': ['b'], 'postIF_z': [2],
+                'backend': 'numpy'},
+               {'preIF': ['a', 'c'], 'preIF_z': [2, 3], 'postIF': ['b'], 'postIF_z': [2],
+                'backend': 'numpy'},
+               {'preIF': ['c'], 'preIF_z': [2], 'postIF': [], 'postIF_z': [],
+                'punctumSize': 3, 'backend': 'numpy'}]
+
+    plan = qp.plan_queries(queries, lambda name: np.copy(channels[name]))
+    outputs = plan.execute()
+
+    for n, query in enumerate(queries):
+        volumes = {'presynaptic': [np.copy(channels[name]) for name in query['preIF']],
+                   'postsynaptic': [np.copy(channels[name]) for name in query['postIF']]}
+        expected = syn.getSynapseDetections(volumes, copy.deepcopy(query))
+        assert np.array_equal(outputs[('combine', n)], expected)
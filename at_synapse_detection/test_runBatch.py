@@ -0,0 +1,46 @@
+import json
+import numpy as np
+from at_synapse_detection import runBatch
+from at_synapse_detection import runJournal as rj
+from at_synapse_detection.test_batchRunner import make_region
+
+
+def make_manifest(tmpdir):
+    data_dir = tmpdir.mkdir('1ss_stacks')
+    for region_num in range(0, 2):
+        make_region(data_dir, 'F00' + str(region_num), region_num)
+
+    queries = [{'preIF': ['a.tif'], 'preIF_z': [2], 'postIF': ['b.tif'], 'postIF_z': [2]},
+               {'preIF': ['c.tif'], 'preIF_z': [1], 'postIF': ['b.tif'], 'postIF_z': [2]}]
+    query_fn = str(tmpdir.join('1ss_queries.json'))
+    with open(query_fn, 'w') as f:
+        json.dump({'listOfQueries': queries}, f)
+
+    manifest = {'query_fn': str(tmpdir.join('{mouse_number}ss_queries.json')),
+                'data_location': '/missing/{mouse_number}ss_stacks',
+                'dapi_mask_location': str(data_dir.join('dapi_{region_name}')),
+                'sheet_name': '{mouse_number}ss_test', 'regions': ['F000', 'F001'],
+                'mice': [1], 'excel': False,
+                'hosts': {'testhost': {'data_location': str(data_dir)}}}
+    return runBatch.apply_host_overrides(manifest, 'testhost')
+
+
+def test_run_batch_resumes(tmpdir):
+    manifest = make_manifest(tmpdir)
+    mice, atet_inputs_list = runBatch.get_batch_tasks(manifest)
+    assert len(atet_inputs_list) == 4
+    assert mice[0]['output_foldername'] == 'results_1ss_test'
+
+    journal_fn = str(tmpdir.join('journal.jsonl'))
+    expected = runBatch.run_batch(manifest, 'serial', journal_fn)['1ss_test']
+    assert np.sum(expected['Synapse Count']) > 0
+
+    # drop the last task, only that one is run again
+    with open(journal_fn) as f:
+        lines = f.readlines()
+    with open(journal_fn, 'w') as f:
+        f.writelines(lines[:-1])
+
+    result = runBatch.run_batch(manifest, 'process', journal_fn)['1ss_test']
+    assert result.equals(expected)
+    assert len(rj.read_journal(journal_fn)) == 4
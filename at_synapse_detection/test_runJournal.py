@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import tifffile
+from at_synapse_detection import batchRunner as br
+from at_synapse_detection import runJournal as rj
+from at_synapse_detection.test_batchRunner import make_region
+
+
+def make_inputs(tmpdir):
+    query = {'preIF': ['a.tif'], 'preIF_z': [2], 'postIF': ['b.tif'], 'postIF_z': [2],
+             'backend': 'numpy'}
+    atet_inputs_list = []
+    for region_num in range(0, 2):
+        region_name = 'F00' + str(region_num)
+        data_region_location, dapi_mask_str = make_region(tmpdir, region_name, region_num)
+        atet_inputs_list.append({
+            'query': query, 'queryID': region_num, 'nQuery': 0,
+            'resolution': {'res_xy_nm': 100, 'res_z_nm': 70},
+            'data_region_location': data_region_location, 'data_location': str(tmpdir),
+            'output_foldername': 'results', 'region_name': region_name, 'mask_str': -1,
+            'dapi_mask_str': dapi_mask_str, 'mouse_number': 1})
+    return atet_inputs_list
+
+
+def test_journal_skips_completed_tasks(tmpdir):
+    atet_inputs_list = make_inputs(tmpdir)
+    journal_fn = str(tmpdir.join('journal.jsonl'))
+
+    with br.BatchRunner(num_workers=1) as runner:
+        expected = runner.map_synapse_detection(atet_inputs_list,
+                                                journal=rj.RunJournal(journal_fn))
+        assert all(os.path.isfile(output['output_fn']) for output in expected)
+
+        journal = rj.RunJournal(journal_fn)
+        assert journal.split(atet_inputs_list) == ([], [0, 1])
+        result_list = runner.map_synapse_detection(atet_inputs_list, journal=journal)
+        for result, expected_result in zip(result_list, expected):
+            assert result['queryresult'].num_synapses == \
+                expected_result['queryresult'].num_synapses
+
+        # a changed channel and a deleted result volume are run again
+        fn = os.path.join(atet_inputs_list[0]['data_region_location'], 'b.tif')
+        tifffile.imwrite(fn, np.zeros((4, 40, 36), dtype=np.uint16), photometric='minisblack')
+        os.remove(expected[1]['output_fn'])
+        assert rj.RunJournal(journal_fn).split(atet_inputs_list) == ([0, 1], [])
+
+        result_list = runner.map_synapse_detection(atet_inputs_list,
+                                                   journal=rj.RunJournal(journal_fn))
+        assert result_list[0]['queryresult'].num_synapses == 0
+        assert result_list[1]['queryresult'].num_synapses == \
+            expected[1]['queryresult'].num_synapses
+        assert rj.RunJournal(journal_fn).split(atet_inputs_list) == ([], [0, 1])
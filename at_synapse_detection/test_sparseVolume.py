@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pytest
+from skimage import measure
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import sparseVolume
+from at_synapse_detection.sparseVolume import SparseResultVolume
+
+
+def make_result_volume(shape, density, seed=0):
+    rng = np.random.RandomState(seed)
+    vol = rng.rand(*shape).astype(np.float32)
+    vol[rng.rand(*shape) > density] = 0
+    return vol
+
+
+@pytest.mark.parametrize('shape', [(40, 35, 6), (30, 30, 1)])
+@pytest.mark.parametrize('thresh', [0, 0.5])
+def test_label_matches_dense(shape, thresh):
+    vol = make_result_volume(shape, 0.3)
+    sparse_vol = SparseResultVolume.from_dense(vol)
+
+    num_labels, labels, thresholded = sparse_vol.label(thresh)
+    expected = measure.label(vol > thresh)
+    assert num_labels == expected.max()
+
+    # same partition of the voxels
+    expected_labels = expected[thresholded.rows, thresholded.cols, thresholded.zs]
+    assert len(set(zip(labels, expected_labels))) == num_labels
+
+    assert sa.compute_measurements(sparse_vol, {}, 1.0, thresh).num_synapses == \
+        sa.compute_measurements(vol, {}, 1.0, thresh).num_synapses
+
+
+def test_sparse_result_roundtrip(tmpdir):
+    vol = make_result_volume((30, 25, 4), 0.1)
+    syn.saveresultvol(vol, str(tmpdir), 'resultVol', 0, fileFormat='sparse')
+    syn.saveresultvol(2 * vol, str(tmpdir), 'resultVol', 1, fileFormat='npy')
+
+    assert np.array_equal(syn.loadresultvol(str(tmpdir), 'resultVol', 0), vol)
+    mask = syn.loadthresholdedresultvols(str(tmpdir), 'resultVol', [0, 1], [0.5, 1.5])
+    assert np.array_equal(mask, (vol > 0.5) | (2 * vol > 1.5))
+
+
+def test_result_format_switch_replaces_old_result(tmpdir):
+    vol = make_result_volume((30, 25, 4), 0.1)
+    syn.saveresultvol(vol, str(tmpdir), 'resultVol', 0, fileFormat='sparse')
+    fn = syn.saveresultvol(2 * vol, str(tmpdir), 'resultVol', 0, fileFormat='npy')
+    assert os.listdir(str(tmpdir)) == [os.path.basename(fn)]
+    assert np.array_equal(syn.loadresultvol(str(tmpdir), 'resultVol', 0), 2 * vol)
+
+    # a stale file left by another writer is older than the new result
+    SparseResultVolume.from_dense(vol).save(str(tmpdir.join('resultVol0.npz')))
+    os.utime(str(tmpdir.join('resultVol0.npz')), ns=(0, 0))
+    assert np.array_equal(syn.loadresultvol(str(tmpdir), 'resultVol', 0), 2 * vol)
+
+
+def test_sweep_matches_labeling_each_threshold():
+    vol = make_result_volume((40, 35, 6), 0.6, seed=3).astype(np.float64)
+    thresholds = [0.9, 0.2, 0.5, 0.7]
+
+    for volume in [vol, SparseResultVolume.from_dense(vol, dtype=np.float64)]:
+        queryresults = sa.compute_threshold_sweep(volume, {}, 2.0, thresholds)
+        for thresh, queryresult in zip(thresholds, queryresults):
+            expected = measure.label(vol > thresh)
+            expected_sizes = np.bincount(expected.ravel())[1:]
+            assert queryresult.thresh == thresh
+            assert queryresult.num_synapses == expected.max()
+            assert queryresult.synapse_density == expected.max() / 2.0
+            assert np.isclose(queryresult.synapse_size, np.mean(expected_sizes))
+            assert np.isclose(queryresult.synapse_size_std, np.std(expected_sizes))
+
+
+@pytest.mark.parametrize('grid_label_ratio', [0, 10**9])
+def test_sweep_forest_and_grid_agree(monkeypatch, grid_label_ratio):
+    # 0 always builds the spanning forest, a large ratio always labels the grid
+    monkeypatch.setattr(sparseVolume, 'GRID_LABEL_RATIO', grid_label_ratio)
+    vol = make_result_volume((40, 35, 6), 0.6, seed=4).astype(np.float64)
+    thresholds = [0.9, 0.2, 0.5, 0.7, 0.2]
+
+    sizes_list = sparseVolume.sweep_components(vol, thresholds)
+    assert len(sizes_list) == len(thresholds)
+    for thresh, sizes in zip(thresholds, sizes_list):
+        expected = np.bincount(measure.label(vol > thresh).ravel())[1:]
+        assert np.array_equal(np.sort(sizes), np.sort(expected))
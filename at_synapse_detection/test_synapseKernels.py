@@ -0,0 +1,73 @@
+import copy
+import numpy as np
+import pytest
+from at_synapse_detection import SynapseDetection as syn
+from at_synapse_detection import synapseKernels
+
+backends = ['numpy', pytest.param('numba', marks=pytest.mark.skipif(
+    not synapseKernels.NUMBA_AVAILABLE, reason='numba is not installed'))]
+
+
+def make_volumes(num_volumes, shape, blobsize=2, seed=0):
+    """
+    Random volumes run through steps 1-3 of the detection pipeline
+    """
+    rng = np.random.RandomState(seed)
+    volumes = []
+    for n in range(0, num_volumes):
+        vol = rng.gamma(2.0, 100.0, size=shape)
+        vol = syn.getProbMap(vol)
+        vol = syn.convolveVolume(vol, blobsize)
+        if shape[2] > 1:
+            vol = vol * syn.computeFactor(vol, 2)
+        volumes.append(vol)
+    return volumes
+
+
+@pytest.mark.parametrize('backend', backends)
+@pytest.mark.parametrize('shape', [(30, 27, 4), (24, 24, 1)])
+@pytest.mark.parametrize('num_base,num_adjacent,blobsize', [
+    (1, 1, 2), (2, 0, 2), (1, 2, 3), (2, 2, 2), (3, 1, 4)])
+def test_combine_matches_reference(backend, shape, num_base, num_adjacent, blobsize):
+    edge_win = int(np.ceil(blobsize * 1.5))
+    base = make_volumes(num_base, shape, blobsize, seed=1)
+    adjacent = make_volumes(num_adjacent, shape, blobsize, seed=2)
+
+    expected = syn.combinePrePostVolumes(copy.deepcopy(base), copy.deepcopy(adjacent),
+                                         edge_win, blobsize, backend='python')
+    result = syn.combinePrePostVolumes(copy.deepcopy(base), copy.deepcopy(adjacent),
+                                       edge_win, blobsize, backend=backend)
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_combine_astro_matches_reference(backend):
+    shape = (30, 30, 4)
+    base = make_volumes(1, shape, seed=1)
+    adjacent = make_volumes(1, shape, seed=2)
+    glial = make_volumes(1, shape, seed=3)
+
+    expected = syn.combinePrePostVolumes_astro(copy.deepcopy(base), copy.deepcopy(adjacent),
+                                               copy.deepcopy(glial), 3, 2, backend='python')
+    result = syn.combinePrePostVolumes_astro(copy.deepcopy(base), copy.deepcopy(adjacent),
+                                             copy.deepcopy(glial), 3, 2, backend=backend)
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.skipif(not synapseKernels.NUMBA_AVAILABLE, reason='numba is not installed')
+def test_search_functions_match_reference():
+    volumes = syn.createLookupTables(make_volumes(2, (20, 20, 3)))
+    for zInd in range(0, 3):
+        for rInd in range(3, 17):
+            for cInd in range(3, 17):
+                assert synapseKernels.searchAdjacentChannel(volumes, 2, cInd, rInd, zInd) == \
+                    syn.searchAdjacentChannel(volumes, 2, cInd, rInd, zInd)
+                assert synapseKernels.searchColocalizeChannel(volumes, 2, cInd, rInd, zInd) == \
+                    syn.searchColocalizeChannel(volumes, 2, cInd, rInd, zInd)
+
+
+def test_query_selects_backend():
+    assert syn.getKernelBackend({'vectorized': True}) == 'numpy'
+    assert syn.getKernelBackend({'backend': 'python', 'vectorized': True}) == 'python'
+    with pytest.raises(ValueError):
+        syn.getKernelBackend({'backend': 'cuda'})
@@ -6,6 +6,7 @@ uses metadata generated from populate_metadata.ipynb
 from at_synapse_detection import dataAccess as da
 from at_synapse_detection import SynapseDetection as syn
 from at_synapse_detection import processDetections as pd
+from at_synapse_detection import preprocessCache as pc
 
 
 def main():
@@ -31,10 +32,12 @@ def main():
 
         # Load the data
         synapticVolumes = da.loadTiffSeriesFromQuery(query, datalocation)
+        sourceIds = pc.get_source_ids(query, datalocation)
 
         # Run Synapse Detection
-        # Takes ~5 minutes to run
-        resultVol = syn.getSynapseDetections(synapticVolumes, query)
+        # Takes ~5 minutes to run, channels shared with earlier
+        # queries are taken from the preprocessing cache
+        resultVol = syn.getSynapseDetections(synapticVolumes, query, sourceIds=sourceIds)
 
         # Save the probability map to file, if you want
         syn.saveresultvol(resultVol, outputNPYlocation, 'resultVol', n)
@@ -65,18 +68,17 @@ def main():
     listOfQueries_to_text = []
     listofevals = []
     thresh_list = [0.7, 0.8, 0.9]
-    # Evaluate each query individually
+    # Evaluate each query individually, each result volume is loaded
+    # once for the whole threshold list
     for n, query in enumerate(listOfQueries):
         listOfThresholds.append(query['thresh'])
-        
+
         for thresh in thresh_list:
             listOfThresholds_to_text.append(thresh)
-            query['thresh'] = thresh
-            print(query)
-            listOfQueries_to_text.append(query)
-            queryresult = pd.combineResultVolumes(
-                [n], [thresh], metadata, evalparam)
-            listofevals.append(queryresult)
+            listOfQueries_to_text.append(dict(query, thresh=thresh))
+        print(query)
+        listofevals.extend(pd.evaluateThresholdSweep(
+            n, thresh_list, metadata, evalparam))
 
     pd.printEvalToText(listofevals, listOfQueries_to_text,
                        listOfThresholds_to_text)
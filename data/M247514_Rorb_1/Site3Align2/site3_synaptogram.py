@@ -11,18 +11,9 @@ from at_synapse_detection import processDetections as pd
 def generateResultTiffStacks(listOfQueryNumbers, listOfThresholds, data_location, outputNPYlocation): 
     """
     """
-    resultVolList = []  # list of thresholded result volumes
-    for n, queryNum in enumerate(listOfQueryNumbers):
-        # load result volume
-        fn = os.path.join(outputNPYlocation, 'resultVol')
-        fn = fn + str(queryNum) + '.npy'
-        resultVol_n = np.load(fn)
-        resultVol_n = resultVol_n > listOfThresholds[n]
-        resultVolList.append(resultVol_n)
-
-    resultVol = resultVolList[0]
-    for volItr in range(1, len(resultVolList)):
-        resultVol = resultVol + resultVolList[volItr]
+    # union of the thresholded result volumes
+    resultVol = syn.loadthresholdedresultvols(outputNPYlocation, 'resultVol',
+                                              listOfQueryNumbers, listOfThresholds)
 
     folderpath = os.path.join(data_location, 'results')
     if not os.path.isdir(folderpath):
@@ -8,13 +8,14 @@ from at_synapse_detection import dataAccess as da
 from at_synapse_detection import SynapseDetection as syn
 from at_synapse_detection import antibodyAnalysis as aa
 from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import batchRunner as br
+from at_synapse_detection import runJournal as rj
 import socket
-import multiprocessing as mp
 import copy
 import numpy as np
 
 
-def run_list_of_queries(mouse_number, mouse_project_str, sheet_name):
+def run_list_of_queries(mouse_number, mouse_project_str, sheet_name, runner):
     """
     run queries in a parallel manner
 
@@ -23,6 +24,7 @@ def run_list_of_queries(mouse_number, mouse_project_str, sheet_name):
     mouse_number : int 
     mouse_project_str : str
     sheet_name : str 
+    runner : batchRunner.BatchRunner - worker pool shared by every mouse
 
     """
 
@@ -48,10 +50,6 @@ def run_list_of_queries(mouse_number, mouse_project_str, sheet_name):
     thresh = 0.9
 
     result_list = []
-    num_workers = mp.cpu_count() - 1
-
-    print(num_workers)
-    pool = mp.Pool(num_workers)
 
     atet_inputs_list = []
     mask_location_str = -1
@@ -78,11 +76,10 @@ def run_list_of_queries(mouse_number, mouse_project_str, sheet_name):
 
             queryID = queryID + 1
 
-    # Run processes
-    result_list = pool.map(sa.run_synapse_detection, atet_inputs_list)
-
-    pool.close()
-    pool.join()
+    # Run processes, the channels of each region are only read once. Tasks
+    # completed by a previous run are read from the journal
+    journal = rj.RunJournal(sheet_name + '_journal.jsonl')
+    result_list = runner.map_synapse_detection(atet_inputs_list, journal=journal)
 
     print('Get process results from the output queue')
     sorted_queryresult = sa.organize_result_lists(result_list)
@@ -96,6 +93,8 @@ def run_list_of_queries(mouse_number, mouse_project_str, sheet_name):
 
 
 def main():
+    # one worker pool for every mouse
+    runner = br.BatchRunner()
 
     if len(sys.argv) < 4:
         print('Run All Combinations')
@@ -106,38 +105,38 @@ def main():
         # python run_fragX.py 4 '4ss_inhibitory' '4ss_inhibitory_fragX'
 
         # run_list_of_queries(
-        #     mouse_number=1, mouse_project_str='1ss_inhibitory', sheet_name='1ss_inhibitory_fragX')
+        #     mouse_number=1, mouse_project_str='1ss_inhibitory', sheet_name='1ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=22, mouse_project_str='22ss_inhibitory', sheet_name='22ss_inhibitory_fragX')
+        #     mouse_number=22, mouse_project_str='22ss_inhibitory', sheet_name='22ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=2, mouse_project_str='2ss_inhibitory', sheet_name='2ss_inhibitory_fragX')
+        #     mouse_number=2, mouse_project_str='2ss_inhibitory', sheet_name='2ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=3, mouse_project_str='3ss_inhibitory', sheet_name='3ss_inhibitory_fragX')
+        #     mouse_number=3, mouse_project_str='3ss_inhibitory', sheet_name='3ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=4, mouse_project_str='4ss_inhibitory', sheet_name='4ss_inhibitory_fragX')
+        #     mouse_number=4, mouse_project_str='4ss_inhibitory', sheet_name='4ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=6, mouse_project_str='6ss_inhibitory', sheet_name='6ss_inhibitory_fragX')
+        #     mouse_number=6, mouse_project_str='6ss_inhibitory', sheet_name='6ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=5, mouse_project_str='5ss_inhibitory', sheet_name='5ss_inhibitory_fragX')
+        #     mouse_number=5, mouse_project_str='5ss_inhibitory', sheet_name='5ss_inhibitory_fragX', runner=runner)
         # run_list_of_queries(
-        #     mouse_number=7, mouse_project_str='7ss_inhibitory', sheet_name='7ss_inhibitory_fragX')
+        #     mouse_number=7, mouse_project_str='7ss_inhibitory', sheet_name='7ss_inhibitory_fragX', runner=runner)
 
         run_list_of_queries(
-            mouse_number=1, mouse_project_str='1ss', sheet_name='1ss_fragX')
+            mouse_number=1, mouse_project_str='1ss', sheet_name='1ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=22, mouse_project_str='22ss', sheet_name='22ss_fragX')
+            mouse_number=22, mouse_project_str='22ss', sheet_name='22ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=2, mouse_project_str='2ss', sheet_name='2ss_fragX')
+            mouse_number=2, mouse_project_str='2ss', sheet_name='2ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=3, mouse_project_str='3ss', sheet_name='3ss_fragX')
+            mouse_number=3, mouse_project_str='3ss', sheet_name='3ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=4, mouse_project_str='4ss', sheet_name='4ss_fragX')
+            mouse_number=4, mouse_project_str='4ss', sheet_name='4ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=6, mouse_project_str='6ss', sheet_name='6ss_fragX')
+            mouse_number=6, mouse_project_str='6ss', sheet_name='6ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=5, mouse_project_str='5ss', sheet_name='5ss_fragX')
+            mouse_number=5, mouse_project_str='5ss', sheet_name='5ss_fragX', runner=runner)
         run_list_of_queries(
-            mouse_number=7, mouse_project_str='7ss', sheet_name='7ss_fragX')
+            mouse_number=7, mouse_project_str='7ss', sheet_name='7ss_fragX', runner=runner)
 
     else:
         print('we have arguments')
@@ -145,7 +144,9 @@ def main():
         mouse_number = sys.argv[1]
         mouse_project_str = sys.argv[2]
         sheet_name = sys.argv[3]
-        run_list_of_queries(mouse_number, mouse_project_str, sheet_name)
+        run_list_of_queries(mouse_number, mouse_project_str, sheet_name, runner)
+
+    runner.close()
 
 
 if __name__ == '__main__':
@@ -8,17 +8,22 @@ from at_synapse_detection import dataAccess as da
 from at_synapse_detection import SynapseDetection as syn
 from at_synapse_detection import antibodyAnalysis as aa
 from at_synapse_detection import SynapseAnalysis as sa
+from at_synapse_detection import batchRunner as br
+from at_synapse_detection import runJournal as rj
 import socket
-import multiprocessing as mp
 import copy
 import numpy as np
 
 
-def run_queries_layer4():
+def run_queries_layer4(runner):
     """
     Run queries on L4 of the data 
     F000 for 2ss, 3ss, 4ss, 5ss
     F003 for 6ss, 7ss
+
+    Parameters
+    -----------------
+    runner : batchRunner.BatchRunner
     """
 
     mouse_id_list = [2, 3, 4, 5, 6, 7]
@@ -29,10 +34,6 @@ def run_queries_layer4():
     resolution = {'res_xy_nm': 100, 'res_z_nm': 70}
     thresh = 0.9
 
-    num_workers = mp.cpu_count() - 1
-    print(num_workers)
-    pool = mp.Pool(num_workers)
-
     atet_inputs_list = []
     result_list = []
     foldernames = []
@@ -75,11 +76,10 @@ def run_queries_layer4():
             atet_inputs_list.append(atet_input)
             queryID = queryID + 1
 
-    # Run processes
-    result_list = pool.map(sa.run_synapse_detection, atet_inputs_list)
-
-    pool.close()
-    pool.join()
+    # Run processes, the channels of each region are only read once. Tasks
+    # completed by a previous run are read from the journal
+    journal = rj.RunJournal(sheet_name + '_journal.jsonl')
+    result_list = runner.map_synapse_detection(atet_inputs_list, journal=journal)
 
     print('Get process results from the output queue')
     sorted_queryresult = sa.organize_result_lists(result_list)
@@ -92,11 +92,15 @@ def run_queries_layer4():
     aa.write_dfs_to_excel(df_list, sheet_name, fn)
 
 
-def run_inhibitory_queries_layer4():
+def run_inhibitory_queries_layer4(runner):
     """
     Run queries on L4 of the data 
     F000 for 2ss, 3ss, 4ss, 5ss
     F003 for 6ss, 7ss
+
+    Parameters
+    -----------------
+    runner : batchRunner.BatchRunner
     """
 
     mouse_id_list = [2, 3, 4, 5, 6, 7]
@@ -107,10 +111,6 @@ def run_inhibitory_queries_layer4():
     resolution = {'res_xy_nm': 100, 'res_z_nm': 70}
     thresh = 0.9
 
-    num_workers = mp.cpu_count() - 1
-    print(num_workers)
-    pool = mp.Pool(num_workers)
-
     atet_inputs_list = []
     result_list = []
     foldernames = []
@@ -153,11 +153,10 @@ def run_inhibitory_queries_layer4():
             atet_inputs_list.append(atet_input)
             queryID = queryID + 1
 
-    # Run processes
-    result_list = pool.map(sa.run_synapse_detection, atet_inputs_list)
-
-    pool.close()
-    pool.join()
+    # Run processes, the channels of each region are only read once. Tasks
+    # completed by a previous run are read from the journal
+    journal = rj.RunJournal(sheet_name + '_journal.jsonl')
+    result_list = runner.map_synapse_detection(atet_inputs_list, journal=journal)
 
     print('Get process results from the output queue')
     sorted_queryresult = sa.organize_result_lists(result_list)
@@ -171,8 +170,9 @@ def run_inhibitory_queries_layer4():
 
 
 def main():
-    # run_queries_layer4()
-    run_inhibitory_queries_layer4()
+    with br.BatchRunner() as runner:
+        # run_queries_layer4(runner)
+        run_inhibitory_queries_layer4(runner)
 
 
 if __name__ == '__main__':
@@ -10,5 +10,7 @@ setup(name='at_synapse_detection',
       author_email='aksimhal@duke.edu',
       packages=find_packages(),
       url='https://github.com/aksimhal/SynapseAnalysis',
-      install_requires=required)
+      install_requires=required,
+      entry_points={'console_scripts': [
+          'synapse-batch = at_synapse_detection.runBatch:main']})
 